@@ -0,0 +1,136 @@
+'''
+Run the benchmark suite against an in-process app.
+
+    python -m bench --users 100 --topics 20 --votes 1000 -c 16 -n 500 \\
+        --output bench.json --baseline baseline.json
+'''
+import argparse
+import asyncio
+import sys
+import httpx
+from vote.config import get_vote_config, set_vote_config
+from vote.main import create_app
+from .seed import SeedConfig, seed
+from .scenarios import make_scenarios, max_requests
+from .runner import Report, run_scenario, new_report, format_report, compare
+
+SCENARIOS = [
+    'signup',
+    'login',
+    'topic-list',
+    'vote',
+    'my-vote',
+    'vote-result',
+]
+
+
+async def run(args: argparse.Namespace) -> Report:
+    cfg = get_vote_config()
+    update = {
+        'log': cfg.log.copy(update={'level': args.log_level}),
+        # all simulated clients share one IP and a few users
+        'admission': cfg.admission.copy(update={
+            'user_rate': 0,
+            'ip_rate': 0,
+        }),
+    }
+    if args.backend is not None:
+        update['db'] = cfg.db.copy(update={'backend': args.backend})
+    set_vote_config(cfg.copy(update=update))
+    app = create_app()
+    async with app.router.lifespan_context(app):
+        data = await seed(
+            app,
+            SeedConfig(
+                users=args.users,
+                topics=args.topics,
+                options=args.options,
+                votes=args.votes,
+                seed=args.seed,
+            ),
+        )
+        scenarios = make_scenarios(data, args.seed)
+        limits = max_requests(data)
+        results = {}
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+                transport=transport,
+                base_url='http://bench',
+        ) as client:
+            for name in args.scenario or SCENARIOS:
+                warmup = args.warmup
+                requests = args.requests
+                limit = limits.get(name)
+                if limit is not None:
+                    warmup = min(warmup, limit)
+                    requests = min(requests, limit - warmup)
+                if requests <= 0:
+                    print(f'skip {name}: not enough data', file=sys.stderr)
+                    continue
+                results[name] = await run_scenario(
+                    client,
+                    scenarios[name],
+                    requests,
+                    args.concurrency,
+                    warmup,
+                )
+    params = {
+        k: v
+        for k, v in vars(args).items()
+        if k not in ('output', 'baseline', 'threshold')
+    }
+    return new_report(params, results)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--topics', type=int, default=20)
+    parser.add_argument('--options', type=int, default=4)
+    parser.add_argument('--votes', type=int, default=1000)
+    parser.add_argument('-n', '--requests', type=int, default=500)
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--backend',
+        choices=['surreal', 'memory'],
+        help='override `[db] backend` of vote.toml',
+    )
+    parser.add_argument(
+        '--log-level',
+        default='WARNING',
+        help='access logs of every request would skew the results',
+    )
+    parser.add_argument(
+        '-s',
+        '--scenario',
+        action='append',
+        choices=SCENARIOS,
+        help='scenario to run, can be repeated, default all',
+    )
+    parser.add_argument('-o', '--output', help='write report as JSON')
+    parser.add_argument('--baseline', help='report JSON to compare with')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.1,
+        help='fail if throughput / p95 is this much worse than baseline',
+    )
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    print(format_report(report))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(report.json(indent=2))
+    if args.baseline is not None:
+        baseline = Report.parse_file(args.baseline)
+        diff, regressed = compare(baseline, report, args.threshold)
+        print()
+        print(diff)
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+from datetime import datetime, timezone
+from typing import Any
+import asyncio
+import math
+import time
+import httpx
+from pydantic import BaseModel
+from .scenarios import Scenario
+
+
+class ScenarioResult(BaseModel):
+    requests: int
+    errors: int
+    # seconds
+    duration: float
+    # requests per second
+    throughput: float
+    # latencies in milliseconds
+    mean: float
+    p50: float
+    p95: float
+    p99: float
+
+
+class Report(BaseModel):
+    created_at: datetime
+    params: dict[str, Any]
+    results: dict[str, ScenarioResult]
+
+
+def percentile(values: list[float], q: float) -> float:
+    '''
+    Nearest-rank percentile of sorted `values`.
+    '''
+    if not values:
+        return 0.0
+    rank = math.ceil(q / 100 * len(values))
+    return values[max(0, rank - 1)]
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    scenario: Scenario,
+    requests: int,
+    concurrency: int,
+    warmup: int = 0,
+) -> ScenarioResult:
+    '''
+    Send `requests` requests from `concurrency` workers. Warm-up requests
+    are sent first and not measured.
+    '''
+    for i in range(warmup):
+        await scenario(client, i)
+    latencies: list[float] = []
+    errors = 0
+    counter = iter(range(warmup, warmup + requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                resp = await scenario(client, i)
+                ok = resp.is_success
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - start
+    latencies.sort()
+    ms = [t * 1000 for t in latencies]
+    return ScenarioResult(
+        requests=requests,
+        errors=errors,
+        duration=duration,
+        throughput=requests / duration if duration else 0.0,
+        mean=sum(ms) / len(ms) if ms else 0.0,
+        p50=percentile(ms, 50),
+        p95=percentile(ms, 95),
+        p99=percentile(ms, 99),
+    )
+
+
+def new_report(
+    params: dict[str, Any],
+    results: dict[str, ScenarioResult],
+) -> Report:
+    return Report(
+        created_at=datetime.now(timezone.utc),
+        params=params,
+        results=results,
+    )
+
+
+def format_report(report: Report) -> str:
+    lines = [
+        f'{"scenario":<12} {"reqs":>6} {"errs":>5} {"req/s":>9} '
+        f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}',
+    ]
+    for name, r in report.results.items():
+        lines.append(f'{name:<12} {r.requests:>6} {r.errors:>5} '
+                     f'{r.throughput:>9.1f} {r.p50:>8.2f} {r.p95:>8.2f} '
+                     f'{r.p99:>8.2f}')
+    return '\n'.join(lines)
+
+
+def compare(
+    baseline: Report,
+    current: Report,
+    threshold: float,
+) -> tuple[str, bool]:
+    '''
+    Diff throughput and p95 against a baseline. Return the formatted diff
+    and whether any scenario is worse than `threshold` (e.g. 0.1 for 10%).
+    '''
+    lines = [f'{"scenario":<12} {"req/s":>9} {"p95 ms":>9}']
+    regressed = False
+    if baseline.params != current.params:
+        lines.insert(0, 'warning: params differ from the baseline')
+    for name, r in current.results.items():
+        base = baseline.results.get(name)
+        if base is None:
+            continue
+        tput = r.throughput / base.throughput - 1 if base.throughput else 0
+        p95 = r.p95 / base.p95 - 1 if base.p95 else 0
+        worse = tput < -threshold or p95 > threshold
+        regressed |= worse
+        lines.append(f'{name:<12} {tput:>+9.1%} {p95:>+9.1%}'
+                     f'{"  <- regression" if worse else ""}')
+    return '\n'.join(lines), regressed
@@ -0,0 +1,93 @@
+from typing import Awaitable, Callable
+import itertools
+import random
+import httpx
+from .seed import Dataset, PASSWORD
+
+# send the i-th request of a scenario
+Scenario = Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]]
+
+
+def _auth(data: Dataset, username: str) -> dict[str, str]:
+    return {'Authorization': f'Bearer {data.tokens[username]}'}
+
+
+def make_scenarios(data: Dataset, seed: int = 0) -> dict[str, Scenario]:
+    '''
+    Build request generators over the seeded dataset. Requests are picked
+    by a seeded RNG so two runs with the same sizes send the same load.
+    '''
+    rng = random.Random(seed)
+
+    async def signup(client: httpx.AsyncClient, i: int):
+        username = f's{data.run_id}n{i}'
+        return await client.post(
+            '/user/signup',
+            json={
+                'username': username,
+                'email': f'{username}@example.com',
+                'password': PASSWORD,
+            },
+        )
+
+    async def login(client: httpx.AsyncClient, i: int):
+        return await client.post(
+            '/auth/token',
+            data={
+                'username': rng.choice(data.usernames),
+                'password': PASSWORD,
+            },
+        )
+
+    async def topic_list(client: httpx.AsyncClient, i: int):
+        return await client.get('/topic/', params={'limit': 50})
+
+    # every (user, open topic) pair can only vote once
+    open_pairs = [(u, t, opts) for t, opts in data.open_topics
+                  for u in data.usernames]
+    rng.shuffle(open_pairs)
+    next_pair = itertools.cycle(open_pairs)
+
+    async def vote(client: httpx.AsyncClient, i: int):
+        username, topic_id, options = next(next_pair)
+        return await client.post(
+            '/vote/',
+            json={
+                'topic_id': topic_id,
+                'option_id': rng.choice(options),
+            },
+            headers=_auth(data, username),
+        )
+
+    async def my_vote(client: httpx.AsyncClient, i: int):
+        username, topic_id = rng.choice(data.votes)
+        return await client.get(
+            f'/topic/{topic_id}/my-vote',
+            headers=_auth(data, username),
+        )
+
+    async def vote_result(client: httpx.AsyncClient, i: int):
+        topic_id, _ = rng.choice(data.ended_topics)
+        return await client.get(f'/topic/{topic_id}/vote-result')
+
+    return {
+        'signup': signup,
+        'login': login,
+        'topic-list': topic_list,
+        'vote': vote,
+        'my-vote': my_vote,
+        'vote-result': vote_result,
+    }
+
+
+def max_requests(data: Dataset) -> dict[str, int | None]:
+    '''
+    Requests a scenario can send before it starts repeating itself (a
+    second vote of the same user is only a 409) or has nothing to request.
+    `None` means unlimited.
+    '''
+    return {
+        'vote': len(data.open_topics) * len(data.usernames),
+        'my-vote': None if data.votes else 0,
+        'vote-result': None if data.ended_topics else 0,
+    }
@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta, timezone
+import random
+import secrets
+from fastapi import FastAPI
+from pydantic import BaseModel
+from vote.api import acquire_topic_repository
+from vote.config import get_vote_config
+from vote.db import user_repository, vote_repository
+from vote.domain.auth import AuthService
+from vote.domain.topic import CreateTopicInput, CreateOptionInput
+from vote.domain.user import AddUserInput, get_password_digest
+from vote.domain.vote import BatchVoteInput
+
+PASSWORD = 'bench'
+
+
+class SeedConfig(BaseModel):
+    users: int = 100
+    topics: int = 20
+    options: int = 4
+    votes: int = 1000
+    seed: int = 0
+
+
+class Dataset(BaseModel):
+    '''
+    Records created for one benchmark run. Half of the topics are in
+    progress (for new votes), the others are ended and hold the seeded
+    votes (for vote results / my-vote).
+    '''
+    run_id: str
+    usernames: list[str] = []
+    tokens: dict[str, str] = {}
+    open_topics: list[tuple[str, list[str]]] = []
+    ended_topics: list[tuple[str, list[str]]] = []
+    votes: list[tuple[str, str]] = []
+
+
+async def seed(app: FastAPI, config: SeedConfig) -> Dataset:
+    '''
+    Write test data through repositories, so seeding cost (e.g. bcrypt)
+    isn't part of the benchmark. The app's lifespan should be running.
+    '''
+    rng = random.Random(config.seed)
+    cfg = get_vote_config()
+    # keep usernames unique across runs on the same DB, and short
+    # enough for the 16 chars limit
+    data = Dataset(run_id=secrets.token_hex(3))
+    digest = get_password_digest(PASSWORD, cfg.password.rounds)
+    auth_svc = AuthService(cfg.auth)
+    now = datetime.now(timezone.utc)
+    async with app.state.db_pool.acquire() as db:
+        user_repo = user_repository(db)
+        for i in range(config.users):
+            username = f'b{data.run_id}u{i}'
+            await user_repo.add(
+                AddUserInput(
+                    username=username,
+                    email=f'{username}@example.com',
+                    password_digest=digest,
+                    roles=[],
+                    created_at=now,
+                    disabled=False,
+                ))
+            user = await user_repo.get_by_username(username)
+            data.usernames.append(username)
+            data.tokens[username] = auth_svc.sign_user(
+                user,
+                expires_after=timedelta(hours=1),
+            )
+    async with acquire_topic_repository(app) as topic_repo:
+        for i in range(config.topics):
+            ended = i % 2 == 1
+            # ended ones are moved to the past after votes are written,
+            # votes of ended topics are rejected
+            input = CreateTopicInput(
+                description=f'bench {data.run_id} #{i}',
+                starts_at=now - timedelta(days=2),
+                ends_at=now + timedelta(days=1),
+                options=[
+                    CreateOptionInput(label=f'option {j}', description='')
+                    for j in range(config.options)
+                ],
+            )
+            id = await topic_repo.add(input)
+            topic = await topic_repo.get_by_id(id)
+            options = [o.id for o in topic.options]
+            if ended:
+                data.ended_topics.append((id, options))
+            else:
+                data.open_topics.append((id, options))
+        await topic_repo.refresh_stages(now)
+    if not data.ended_topics:
+        return data
+    pairs = [(u, t) for u in data.usernames for t, _ in data.ended_topics]
+    pairs = rng.sample(pairs, min(config.votes, len(pairs)))
+    options = dict(data.ended_topics)
+    votes = [
+        BatchVoteInput(
+            username=u,
+            topic_id=t,
+            option_id=rng.choice(options[t]),
+        ) for u, t in pairs
+    ]
+    async with app.state.db_pool.acquire() as db:
+        repo = vote_repository(db)
+        size = cfg.vote.batch_size
+        for start in range(0, len(votes), size):
+            await repo.add_many(votes[start:start + size])
+    data.votes = pairs
+    async with acquire_topic_repository(app) as topic_repo:
+        for id, _ in data.ended_topics:
+            topic = await topic_repo.get_by_id(id)
+            topic.ends_at = now - timedelta(days=1)
+            await topic_repo.save(topic)
+        await topic_repo.refresh_stages(now)
+    return data
@@ -0,0 +1,132 @@
+'''
+Per-item cost of serializing topic pages, the validating pydantic path
+(`parse_obj` + `.json()`) against `vote.api.serialization.dumps` of the
+rows as they come from the DB.
+
+    python -m bench.serialization --topics 5000 --repeat 5
+'''
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable
+import argparse
+import json
+import secrets
+import sys
+import time
+from vote.api.serialization import dumps
+from vote.api.topic import (
+    TopicDetailResponse,
+    TopicListResponse,
+    TopicResponse,
+)
+from vote.domain.topic import Topic
+
+
+def make_rows(n: int, options: int) -> list[dict[str, Any]]:
+    '''
+    Topic rows like SurrealDB returns them, datetimes are strings.
+    '''
+    now = datetime.now(timezone.utc)
+    rows = []
+    for i in range(n):
+        at = now - timedelta(minutes=i)
+        ends_at = at + timedelta(days=1)
+        opts = [{
+            'id': secrets.token_urlsafe(32),
+            'label': f'option {j}',
+            'description': '',
+        } for j in range(options)]
+        rows.append({
+            'id': f'topic:{secrets.token_hex(10)}',
+            'description': f'benchmark topic {i}',
+            'starts_at': at.isoformat(),
+            'ends_at': ends_at.isoformat(),
+            'created_at': at.isoformat(),
+            'updated_at': at.isoformat(),
+            'options': opts,
+            'stage': 'IN_PROGRESS',
+        })
+    return rows
+
+
+def list_pydantic(rows: list[dict[str, Any]]) -> bytes:
+    resp = TopicListResponse(
+        items=[TopicResponse.parse_obj(r) for r in rows],
+        next_cursor=None,
+    )
+    return resp.json(exclude_unset=True, separators=(',', ':')).encode()
+
+
+def list_fast(rows: list[dict[str, Any]]) -> bytes:
+    return dumps({
+        'items': [TopicResponse.from_row(r) for r in rows],
+        'next_cursor': None,
+    })
+
+
+def detail_pydantic(topics: list[Topic]) -> bytes:
+    return b''.join(
+        TopicDetailResponse.from_orm(t).json(separators=(',', ':')).encode()
+        for t in topics)
+
+
+def detail_fast(topics: list[Topic]) -> bytes:
+    return b''.join(dumps(TopicDetailResponse.from_topic(t)) for t in topics)
+
+
+def measure(fn: Callable[[Any], bytes], data: Any, repeat: int) -> float:
+    '''
+    Best time of `repeat` runs in seconds.
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(data)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench.serialization')
+    parser.add_argument('--topics', type=int, default=5000)
+    parser.add_argument('--options', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='write results as JSON to this file',
+    )
+    args = parser.parse_args()
+    rows = make_rows(args.topics, args.options)
+    topics = [Topic.parse_obj(r) for r in rows]
+    assert json.loads(list_fast(rows)) == json.loads(list_pydantic(rows))
+    cases = {
+        'list/pydantic': (list_pydantic, rows),
+        'list/fast': (list_fast, rows),
+        'detail/pydantic': (detail_pydantic, topics),
+        'detail/fast': (detail_fast, topics),
+    }
+    results = {}
+    for name, (fn, data) in cases.items():
+        seconds = measure(fn, data, args.repeat)
+        results[name] = {
+            'total_ms': seconds * 1000,
+            'per_item_us': seconds / args.topics * 1e6,
+        }
+    print(f'{args.topics} topics, {args.options} options each')
+    print(f'{"case":<18}{"total ms":>12}{"us/item":>12}')
+    for name, r in results.items():
+        print(f'{name:<18}{r["total_ms"]:>12.2f}{r["per_item_us"]:>12.2f}')
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(
+                {
+                    'params': vars(args),
+                    'results': results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == '__main__':
+    sys.exit(main())
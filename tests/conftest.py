@@ -0,0 +1,153 @@
+'''
+Fixtures running the app on the memory backend, requests go through
+httpx's ASGI transport. Sections of the config can be replaced with
+indirect parametrization:
+
+    @pytest.mark.parametrize(
+        'vote_config',
+        [{'vote': {'group_commit': True}}],
+        indirect=True,
+    )
+'''
+from datetime import datetime, timedelta, timezone
+from typing import Any
+import httpx
+import pytest
+from vote.api import acquire_topic_repository
+from vote.config import VoteConfigToml, get_vote_config, set_vote_config
+from vote.db import MemoryConfig, user_repository
+from vote.domain.auth import AuthService
+from vote.domain.topic import CreateOptionInput, CreateTopicInput, Topic
+from vote.domain.user import AddUserInput, get_password_digest
+from vote.main import create_app
+
+# bcrypt's minimum, digests are only checked by login tests
+ROUNDS = 4
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+@pytest.fixture
+def vote_config(request: pytest.FixtureRequest):
+    original = get_vote_config()
+    sections: dict[str, Any] = {
+        'db': {
+            'backend': 'memory',
+            'memory': MemoryConfig(),
+        },
+        'reload': {
+            'sighup': False,
+            'watch': False,
+        },
+        'log': {
+            'level': 'WARNING',
+            'access': False,
+        },
+        # requests of a test all come from the same client
+        'admission': {
+            'ip_rate': 0,
+        },
+    }
+    for name, values in getattr(request, 'param', {}).items():
+        sections[name] = sections.get(name, {}) | values
+    config = original.copy(
+        update={
+            name: getattr(original, name).copy(update=values)
+            for name, values in sections.items()
+        })
+    set_vote_config(config)
+    yield config
+    set_vote_config(original)
+
+
+@pytest.fixture
+async def app(vote_config: VoteConfigToml):
+    app = create_app()
+    async with app.router.lifespan_context(app):
+        yield app
+
+
+@pytest.fixture
+async def client(app):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+            transport=transport,
+            base_url='http://test',
+    ) as client:
+        yield client
+
+
+@pytest.fixture
+def add_user(app, vote_config: VoteConfigToml):
+    '''
+    Add a user, return headers authenticating as it.
+    '''
+    digest = get_password_digest('password', ROUNDS)
+    auth_svc = AuthService(vote_config.auth)
+
+    async def add(username: str, roles: list[str] = []) -> dict[str, str]:
+        async with app.state.db_pool.acquire() as db:
+            repo = user_repository(db)
+            await repo.add(
+                AddUserInput(
+                    username=username,
+                    email=f'{username}@example.com',
+                    password_digest=digest,
+                    roles=roles,
+                    created_at=datetime.now(timezone.utc),
+                    disabled=False,
+                ))
+            user = await repo.get_by_username(username)
+        return {'Authorization': f'Bearer {auth_svc.sign_user(user)}'}
+
+    return add
+
+
+@pytest.fixture
+def add_topic(app):
+    '''
+    Add a topic with its stage refreshed, by default it's in progress.
+    '''
+
+    async def add(
+            starts_at: timedelta = timedelta(hours=-1),
+            ends_at: timedelta = timedelta(hours=1),
+            options: int = 2,
+    ) -> Topic:
+        now = datetime.now(timezone.utc)
+        async with acquire_topic_repository(app) as repo:
+            id = await repo.add(
+                CreateTopicInput(
+                    starts_at=now + starts_at,
+                    ends_at=now + ends_at,
+                    options=[
+                        CreateOptionInput(label=f'option {i}', description='')
+                        for i in range(options)
+                    ],
+                ))
+            await repo.refresh_stages(now)
+            return await repo.get_by_id(id)
+
+    return add
+
+
+@pytest.fixture
+def end_topic(app):
+    '''
+    Make a topic end a second ago, its stage isn't refreshed, like requests
+    racing with its end.
+    '''
+
+    async def end(topic: Topic) -> Topic:
+        ended = topic.copy(
+            update={
+                'ends_at': datetime.now(timezone.utc) - timedelta(seconds=1),
+            })
+        async with acquire_topic_repository(app) as repo:
+            await repo.save(ended)
+        return ended
+
+    return end
@@ -0,0 +1,209 @@
+from types import SimpleNamespace
+import asyncio
+import pytest
+from vote.api import admission
+from vote.api.admission import AdmissionQueue, Priority, RateLimiter, classify
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch):
+    clock = SimpleNamespace(now=0.0)
+    monkeypatch.setattr(
+        admission,
+        'time',
+        SimpleNamespace(monotonic=lambda: clock.now),
+    )
+    return clock
+
+
+def test_classify():
+    assert classify('POST', '/vote/') == Priority.CRITICAL
+    assert classify('GET', '/healthz/ready') == Priority.CRITICAL
+    assert classify('GET', '/comment/') == Priority.LOW
+    assert classify('POST', '/topic/') == Priority.NORMAL
+    assert classify('GET', '/topic/topic:a/stream') is None
+
+
+def test_rate_limiter(clock):
+    limiter = RateLimiter(rate=2, burst=3, max_size=10)
+    assert [limiter.acquire('a') for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire('a') == pytest.approx(0.5)
+    # buckets are separated by key
+    assert limiter.acquire('b') == 0
+    clock.now += 1
+    assert [limiter.acquire('a') for _ in range(2)] == [0, 0]
+    assert limiter.acquire('a') > 0
+
+
+def test_rate_limiter_drop_least_recently_used(clock):
+    limiter = RateLimiter(rate=1, burst=1, max_size=2)
+    limiter.acquire('a')
+    limiter.acquire('b')
+    limiter.acquire('a')
+    limiter.acquire('c')
+    # `b` is dropped and starts full again, `a` is kept
+    assert limiter.acquire('b') == 0
+    assert limiter.acquire('c') > 0
+
+
+def test_rate_limiter_disabled():
+    limiter = RateLimiter(rate=0, burst=0, max_size=1)
+    assert all(limiter.acquire('a') == 0 for _ in range(100))
+
+
+async def settle():
+    '''
+    Let waiters of the queue run until they block again.
+    '''
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def wait(
+    queue: AdmissionQueue,
+    priority: Priority,
+    admitted: list[Priority] | None = None,
+) -> asyncio.Task:
+    task = asyncio.create_task(queue.acquire(priority))
+
+    def done(task: asyncio.Task):
+        if admitted is not None and not task.cancelled() and task.result():
+            admitted.append(priority)
+
+    task.add_done_callback(done)
+    await settle()
+    return task
+
+
+async def test_queue():
+    queue = AdmissionQueue(limit=2, max_size=10, timeout=1)
+    assert await queue.acquire(Priority.LOW)
+    assert await queue.acquire(Priority.LOW)
+    waiter = await wait(queue, Priority.LOW)
+    assert (queue.active, queue.waiting) == (2, 1)
+    queue.release()
+    # the slot is handed over
+    assert await waiter
+    assert (queue.active, queue.waiting) == (2, 0)
+    queue.release()
+    queue.release()
+    assert queue.active == 0
+
+
+async def test_queue_by_priority():
+    queue = AdmissionQueue(limit=1, max_size=10, timeout=1)
+    assert await queue.acquire(Priority.NORMAL)
+    admitted: list[Priority] = []
+    tasks = [
+        await wait(queue, priority, admitted) for priority in (
+            Priority.LOW,
+            Priority.NORMAL,
+            Priority.CRITICAL,
+            Priority.NORMAL,
+        )
+    ]
+    for _ in tasks:
+        queue.release()
+        await settle()
+    assert admitted == [
+        Priority.CRITICAL,
+        Priority.NORMAL,
+        Priority.NORMAL,
+        Priority.LOW,
+    ]
+    assert all(await asyncio.gather(*tasks))
+
+
+async def test_queue_full():
+    queue = AdmissionQueue(limit=1, max_size=2, timeout=1)
+    assert await queue.acquire(Priority.NORMAL)
+    low = await wait(queue, Priority.LOW)
+    normal = await wait(queue, Priority.NORMAL)
+    # the newest waiter of the lowest priority makes room
+    critical = await wait(queue, Priority.CRITICAL)
+    assert low.done() and not await low
+    # nobody to evict
+    assert not await queue.acquire(Priority.NORMAL)
+    assert queue.waiting == 2
+    queue.release()
+    assert await critical
+    queue.release()
+    assert await normal
+
+
+async def test_queue_disabled():
+    # with no queue, there is no waiter to evict either
+    queue = AdmissionQueue(limit=1, max_size=0, timeout=1)
+    assert await queue.acquire(Priority.LOW)
+    assert not await queue.acquire(Priority.CRITICAL)
+
+
+async def test_queue_timeout():
+    queue = AdmissionQueue(limit=1, max_size=10, timeout=0.01)
+    assert await queue.acquire(Priority.NORMAL)
+    assert not await queue.acquire(Priority.NORMAL)
+    assert queue.waiting == 0
+    queue.release()
+    assert queue.active == 0
+
+
+async def test_queue_cancelled():
+    queue = AdmissionQueue(limit=1, max_size=10, timeout=1)
+    assert await queue.acquire(Priority.NORMAL)
+    gone = await wait(queue, Priority.NORMAL)
+    waiter = await wait(queue, Priority.NORMAL)
+    gone.cancel()
+    await settle()
+    assert queue.waiting == 1
+    queue.release()
+    assert await waiter
+    queue.release()
+    assert (queue.active, queue.waiting) == (0, 0)
+
+
+async def test_queue_cancelled_after_admitted():
+    queue = AdmissionQueue(limit=1, max_size=10, timeout=1)
+    assert await queue.acquire(Priority.NORMAL)
+    waiter = await wait(queue, Priority.NORMAL)
+    # handed the slot, but cancelled before it resumes
+    queue.release()
+    waiter.cancel()
+    try:
+        # `wait_for` may return the result instead of raising
+        if await waiter:
+            queue.release()
+    except asyncio.CancelledError:
+        pass
+    # the slot isn't lost either way
+    assert (queue.active, queue.waiting) == (0, 0)
+
+
+@pytest.mark.parametrize(
+    'vote_config',
+    [{
+        'admission': {
+            'ip_rate': 0.01,
+            'ip_burst': 3,
+            'user_rate': 0.01,
+            'user_burst': 1,
+        }
+    }],
+    indirect=True,
+)
+async def test_rate_limit(client, add_user, add_topic):
+    # all requests come from the same IP
+    topic = await add_topic()
+    for i in range(5):
+        headers = await add_user(f'user{i}')
+        body = {'topic_id': topic.id, 'option_id': topic.options[0].id}
+        r = await client.post('/vote/', json=body, headers=headers)
+        assert r.status_code == 200
+        # but each user only has one token
+        r = await client.post('/vote/', json=body, headers=headers)
+        assert r.status_code == 429
+        assert r.json() == {'detail': 'Too many requests'}
+    statuses = [(await client.post('/user/signup', json={})).status_code
+                for _ in range(5)]
+    assert statuses == [422] * 3 + [429] * 2
@@ -0,0 +1,72 @@
+import time
+from jose import jwt
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def login(client, username: str) -> str:
+    r = await client.post(
+        '/auth/token',
+        data={
+            'username': username,
+            'password': 'password',
+        },
+    )
+    assert r.status_code == 200
+    return r.json()['access_token']
+
+
+@pytest.mark.parametrize(
+    'vote_config',
+    [{
+        'auth': {
+            'token_expire_minutes': 2,
+        }
+    }],
+    indirect=True,
+)
+async def test_login(client, add_user, add_topic, vote_config):
+    await add_user('alice', ['admin'])
+    token = await login(client, 'alice')
+    payload = jwt.decode(
+        token,
+        vote_config.auth.secret_key,
+        algorithms=[vote_config.auth.algorithm],
+    )
+    assert payload['sub'] == 'alice'
+    assert payload['roles'] == ['admin']
+    assert payload['exp'] - time.time() == pytest.approx(120, abs=5)
+    topic = await add_topic()
+    headers = {'Authorization': f'Bearer {token}'}
+    r = await client.get(f'/topic/{topic.id}/my-vote', headers=headers)
+    # authenticated, but hasn't voted yet
+    assert r.status_code == 404
+
+
+async def test_login_wrong_password(client, add_user):
+    await add_user('alice')
+    r = await client.post(
+        '/auth/token',
+        data={
+            'username': 'alice',
+            'password': 'wrong',
+        },
+    )
+    assert r.status_code == 401
+
+
+async def test_revoke(client, add_user, add_topic):
+    headers = await add_user('alice')
+    topic = await add_topic()
+    r = await client.get(f'/topic/{topic.id}/my-vote', headers=headers)
+    assert r.status_code == 404
+    r = await client.post('/auth/revoke', headers=headers)
+    assert r.status_code == 204
+    # the user is cached, but not with the old token version
+    r = await client.get(f'/topic/{topic.id}/my-vote', headers=headers)
+    assert r.status_code == 401
+    token = await login(client, 'alice')
+    headers = {'Authorization': f'Bearer {token}'}
+    r = await client.get(f'/topic/{topic.id}/my-vote', headers=headers)
+    assert r.status_code == 404
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+def ndjson(*votes: dict) -> bytes:
+    return b''.join(json.dumps(v).encode() + b'\n' for v in votes)
+
+
+async def test_batch(client, add_user, add_topic):
+    headers = await add_user('admin', ['admin'])
+    topic = await add_topic()
+    a, b = (o.id for o in topic.options)
+    votes = [
+        {
+            'username': 'alice',
+            'topic_id': topic.id,
+            'option_id': a,
+        },
+        {
+            'username': 'bob',
+            'topic_id': topic.id,
+            'option_id': 'nope',
+        },
+        {
+            'username': 'alice',
+            'topic_id': topic.id,
+            'option_id': b,
+        },
+    ]
+    r = await client.post('/vote/batch', json=votes, headers=headers)
+    assert r.status_code == 200
+    assert [v['status'] for v in r.json()] == [
+        'OK',
+        'INVALID_OPTION',
+        'DUPLICATED',
+    ]
+
+
+async def test_batch_after_end(client, add_user, add_topic, end_topic):
+    headers = await add_user('admin', ['admin'])
+    ended = await end_topic(await add_topic())
+    topic = await add_topic()
+    votes = [
+        {
+            'username': 'alice',
+            'topic_id': ended.id,
+            'option_id': ended.options[0].id,
+        },
+        {
+            'username': 'alice',
+            'topic_id': topic.id,
+            'option_id': topic.options[0].id,
+        },
+    ]
+    r = await client.post('/vote/batch', json=votes, headers=headers)
+    assert r.status_code == 200
+    assert [v['status'] for v in r.json()] == ['NOT_IN_PROGRESS', 'OK']
+
+
+async def test_batch_not_admin(client, add_user):
+    headers = await add_user('alice')
+    r = await client.post('/vote/batch', json=[], headers=headers)
+    assert r.status_code == 403
+
+
+@pytest.mark.parametrize(
+    'vote_config',
+    [{
+        'vote': {
+            'batch_size': 2,
+        }
+    }],
+    indirect=True,
+)
+async def test_ndjson(client, add_user, add_topic):
+    headers = await add_user('admin', ['admin'])
+    topic = await add_topic()
+    votes = [{
+        'username': f'user{i}',
+        'topic_id': topic.id,
+        'option_id': topic.options[0].id,
+    } for i in range(5)]
+    body = ndjson(*votes[:2]) + b'{"username": \n\n' + ndjson(*votes[2:])
+    # the last line doesn't need a newline
+    r = await client.post(
+        '/vote/batch/ndjson',
+        content=body.rstrip(b'\n'),
+        headers=headers,
+    )
+    assert r.status_code == 200
+    assert r.headers['content-type'] == 'application/x-ndjson'
+    results = [json.loads(line) for line in r.text.splitlines()]
+    assert [r['index'] for r in results] == list(range(6))
+    assert [r['status'] for r in results] == [
+        'OK',
+        'OK',
+        'INVALID_INPUT',
+        'OK',
+        'OK',
+        'OK',
+    ]
+
+
+@pytest.mark.parametrize(
+    'vote_config',
+    [{
+        'vote': {
+            'batch_size': 2,
+        }
+    }],
+    indirect=True,
+)
+async def test_ndjson_streaming(app, add_user, add_topic):
+    headers = await add_user('admin', ['admin'])
+    topic = await add_topic()
+    chunks = asyncio.Queue()
+    sent = asyncio.Queue()
+
+    async def receive():
+        body = await chunks.get()
+        return {
+            'type': 'http.request',
+            'body': body,
+            'more_body': body != b'',
+        }
+
+    async def send(message: dict):
+        if message['type'] == 'http.response.body':
+            await sent.put(message['body'])
+
+    raw_headers = [(k.lower().encode(), v.encode())
+                   for k, v in headers.items()]
+    scope = {
+        'type': 'http',
+        'asgi': {
+            'version': '3.0'
+        },
+        'http_version': '1.1',
+        'method': 'POST',
+        'scheme': 'http',
+        'path': '/vote/batch/ndjson',
+        'raw_path': b'/vote/batch/ndjson',
+        'query_string': b'',
+        'root_path': '',
+        'headers': raw_headers,
+        'client': ('127.0.0.1', 1234),
+        'server': ('test', 80),
+    }
+    task = asyncio.create_task(app(scope, receive, send))
+    await chunks.put(
+        ndjson(*({
+            'username': f'user{i}',
+            'topic_id': topic.id,
+            'option_id': topic.options[0].id,
+        } for i in range(2))))
+    # results of the first batch come before the rest of the request
+    first = await asyncio.wait_for(sent.get(), 1)
+    assert [json.loads(line)['index'] for line in first.splitlines()] == [
+        0,
+        1,
+    ]
+    await chunks.put(b'')
+    await asyncio.wait_for(task, 1)
@@ -0,0 +1,43 @@
+from datetime import timedelta
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_topic_etag(client, add_topic):
+    topic = await add_topic()
+    r = await client.get(f'/topic/{topic.id}')
+    assert r.status_code == 200
+    etag = r.headers['etag']
+    # capped by the time left before it ends
+    max_age = int(r.headers['cache-control'].split('max-age=')[1])
+    assert 0 < max_age <= 60
+    r = await client.get(
+        f'/topic/{topic.id}',
+        headers={'If-None-Match': etag},
+    )
+    assert r.status_code == 304
+    assert r.content == b''
+    r = await client.get(
+        f'/topic/{topic.id}',
+        headers={'If-None-Match': '"other"'},
+    )
+    assert r.status_code == 200
+
+
+async def test_vote_result_revalidated(client, add_user, add_topic):
+    headers = await add_user('admin', ['admin'])
+    topic = await add_topic(timedelta(hours=-2), timedelta(hours=-1))
+    url = f'/topic/{topic.id}/vote-result'
+    r = await client.get(url)
+    assert r.status_code == 200
+    # it can be recomputed, so it's never reused without asking
+    assert r.headers['cache-control'] == 'no-cache'
+    etag = r.headers['etag']
+    r = await client.get(url, headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    r = await client.post(f'{url}/recompute', headers=headers)
+    assert r.status_code == 200
+    r = await client.get(url, headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.headers['etag'] != etag
@@ -0,0 +1,68 @@
+import asyncio
+import pytest
+from vote.events import TallyBroker, TallyChannel
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_diff_merges_votes():
+    channel = TallyChannel()
+    seen: dict[str, int] = {}
+    channel.publish('a')
+    channel.publish('a')
+    channel.publish('b')
+    assert channel.diff(seen) == {'a': 2, 'b': 1}
+    assert channel.diff(seen) == {}
+    channel.publish('b', 3)
+    assert channel.diff(seen) == {'b': 3}
+    assert seen == {'a': 2, 'b': 4}
+
+
+async def test_wait():
+    channel = TallyChannel()
+    version = channel.version
+    # something newer is already there
+    channel.publish('a')
+    await asyncio.wait_for(channel.wait(version), 1)
+
+    version = channel.version
+    waiters = [asyncio.create_task(channel.wait(version)) for _ in range(3)]
+    await asyncio.sleep(0)
+    assert not any(w.done() for w in waiters)
+    channel.publish('a')
+    await asyncio.wait_for(asyncio.gather(*waiters), 1)
+
+
+async def test_publish_without_subscriber():
+    broker = TallyBroker()
+    broker.publish('topic', 'a')
+    assert broker.stats().published == 0
+    with broker.subscribe('topic') as channel:
+        # votes before subscribing are not replayed
+        assert channel.counts == {}
+
+
+async def test_subscribe():
+    broker = TallyBroker()
+    with broker.subscribe('topic') as a, broker.subscribe('topic') as b:
+        assert a is b
+        broker.publish('topic', 'x')
+        broker.publish('other', 'x')
+        assert a.counts == {'x': 1}
+        stats = broker.stats()
+        assert (stats.topics, stats.subscribers, stats.published) == (1, 2, 1)
+    # the channel is dropped with its last subscriber
+    assert broker.stats().topics == 0
+    with broker.subscribe('topic') as c:
+        assert c is not a
+        assert c.counts == {}
+
+
+async def test_on_publish():
+    broker = TallyBroker()
+    published = []
+    broker.on_publish = lambda *args: published.append(args)
+    broker.publish('topic', 'a', 2)
+    # votes from other processes are not sent back
+    broker.publish('topic', 'b', notify=False)
+    assert published == [('topic', 'a', 2)]
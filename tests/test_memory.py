@@ -0,0 +1,174 @@
+from datetime import datetime, timezone
+from pathlib import Path
+import json
+import pytest
+from vote.db.memory import MemoryConfig, MemoryDatabase, UniqueIndexError
+
+pytestmark = pytest.mark.anyio
+
+
+def user(id: str, username: str, email: str | None = None) -> dict:
+    return {
+        'id': f'user:{id}',
+        'username': username,
+        'email': email or f'{username}@example.com',
+    }
+
+
+async def open_db(path: Path, **kwargs) -> MemoryDatabase:
+    db = MemoryDatabase(MemoryConfig(path=str(path), **kwargs))
+    await db.open()
+    return db
+
+
+def crash(db: MemoryDatabase):
+    '''
+    Stop using `db` without the snapshot written by `close`.
+    '''
+    db._log.close()
+    db._log = None
+
+
+def usernames(db: MemoryDatabase) -> list[str]:
+    return sorted(r['username'] for r in db['user'])
+
+
+async def test_unique_index_rollback():
+    db = MemoryDatabase(MemoryConfig())
+    db.write(('put', 'user', user('a', 'alice')))
+    with pytest.raises(UniqueIndexError) as e:
+        db.write(
+            ('put', 'user', user('b', 'bob')),
+            ('put', 'user', user('a', 'alice', 'new@example.com')),
+            ('delete', 'user', 'user:a'),
+            ('put', 'user', user('c', 'bob', 'carol@example.com')),
+        )
+    assert e.value.index == 'username_index'
+    # nothing of the transaction is left, including its indexes
+    assert usernames(db) == ['alice']
+    assert db['user'].get_unique('email_index', 'alice@example.com')
+    assert db['user'].get_unique('email_index', 'new@example.com') is None
+    assert db['user'].get_unique('username_index', 'bob') is None
+    db.write(('put', 'user', user('b', 'bob')))
+    assert usernames(db) == ['alice', 'bob']
+
+
+async def test_update_unique_key():
+    db = MemoryDatabase(MemoryConfig())
+    db.write(('put', 'user', user('a', 'alice')))
+    db.write(('put', 'user', user('a', 'alice2')))
+    # the old key is released
+    db.write(('put', 'user', user('b', 'alice')))
+    assert usernames(db) == ['alice', 'alice2']
+
+
+async def test_scan():
+    db = MemoryDatabase(MemoryConfig())
+    for i in range(5):
+        db.write((
+            'put',
+            'topic',
+            {
+                'id': f'topic:{i}',
+                'created_at': datetime(2023, 1, i + 1, tzinfo=timezone.utc),
+            },
+        ))
+    scan = db['topic'].scan
+    ids = [r['id'] for r in scan('topic_created_at_index')]
+    assert ids == [f'topic:{i}' for i in range(5)]
+    after = (datetime(2023, 1, 3, tzinfo=timezone.utc), 'topic:2')
+    ids = [r['id'] for r in scan('topic_created_at_index', after=after)]
+    assert ids == ['topic:3', 'topic:4']
+    ids = [
+        r['id'] for r in scan(
+            'topic_created_at_index',
+            after=after,
+            reverse=True,
+        )
+    ]
+    assert ids == ['topic:1', 'topic:0']
+
+
+async def test_replay_log(tmp_path: Path):
+    db = await open_db(tmp_path)
+    created_at = datetime.now(timezone.utc)
+    db.write(('put', 'user', user('a', 'alice') | {'created_at': created_at}))
+    db.write(('put', 'user', user('b', 'bob')))
+    db.write(('delete', 'user', 'user:b'))
+    with pytest.raises(UniqueIndexError):
+        db.write(('put', 'user', user('c', 'alice')))
+    crash(db)
+
+    db = await open_db(tmp_path)
+    assert usernames(db) == ['alice']
+    assert db['user'].get('user:a')['created_at'] == created_at
+    # the failed transaction is not logged
+    assert db.stats().logged == 3
+
+
+async def test_snapshot(tmp_path: Path):
+    db = await open_db(tmp_path, snapshot_every=2)
+    for i in range(5):
+        db.write(('put', 'user', user(str(i), f'user{i}')))
+    assert (db.stats().snapshots, db.stats().logged) == (2, 1)
+    crash(db)
+
+    db = await open_db(tmp_path)
+    assert len(db['user']) == 5
+    await db.close()
+    # all of it is in the snapshot after a clean close
+    assert len((tmp_path / 'log.jsonl').read_text().splitlines()) == 1
+    db = await open_db(tmp_path)
+    assert len(db['user']) == 5
+
+
+async def test_generation_mismatch(tmp_path: Path):
+    db = await open_db(tmp_path)
+    db.write(('put', 'user', user('a', 'alice')))
+    log = (tmp_path / 'log.jsonl').read_text()
+    db.snapshot()
+    db.write(('put', 'user', user('b', 'bob')))
+    crash(db)
+    # crashed right after the snapshot was written, before the log was
+    # truncated
+    (tmp_path / 'log.jsonl').write_text(log)
+
+    db = await open_db(tmp_path)
+    assert usernames(db) == ['alice']
+    # the stale log would be replayed onto the snapshot otherwise
+    db.write(('put', 'user', user('a', 'alice2')))
+    crash(db)
+    db = await open_db(tmp_path)
+    assert usernames(db) == ['alice2']
+
+
+@pytest.mark.parametrize(
+    'torn',
+    [
+        '[["put", "user", {"id": "user:c"',
+        # complete, but without the newline
+        json.dumps([['put', 'user', user('c', 'carol')]]),
+    ],
+)
+async def test_torn_line(tmp_path: Path, torn: str):
+    db = await open_db(tmp_path)
+    db.write(('put', 'user', user('a', 'alice')))
+    db._log.write(torn)
+    crash(db)
+
+    db = await open_db(tmp_path)
+    assert usernames(db) == ['alice']
+    # appended after the dropped line, not glued to it
+    db.write(('put', 'user', user('b', 'bob')))
+    crash(db)
+    db = await open_db(tmp_path)
+    assert usernames(db) == ['alice', 'bob']
+
+
+async def test_torn_header(tmp_path: Path):
+    (tmp_path / 'log.jsonl').write_text('{"generat')
+    db = await open_db(tmp_path)
+    db.write(('put', 'user', user('a', 'alice')))
+    crash(db)
+    db = await open_db(tmp_path)
+    assert usernames(db) == ['alice']
@@ -0,0 +1,49 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+def sample(text: str, name: str, **labels: str) -> float | None:
+    '''
+    Value of a sample in the Prometheus text format.
+    '''
+    for line in text.splitlines():
+        if line.startswith('#'):
+            continue
+        series, _, value = line.rpartition(' ')
+        metric, _, rest = series.partition('{')
+        if metric != name:
+            continue
+        pairs = dict(p.split('=', 1) for p in rest.rstrip('}').split(',') if p)
+        if all(pairs.get(k) == f'"{v}"' for k, v in labels.items()):
+            return float(value)
+    return None
+
+
+async def test_metrics(client, add_user, add_topic):
+    headers = await add_user('alice')
+    topic = await add_topic()
+    # metrics are global, compare with what earlier tests left
+    before = (await client.get('/metrics')).text
+    body = {'topic_id': topic.id, 'option_id': topic.options[0].id}
+    r = await client.post('/vote/', json=body, headers=headers)
+    assert r.status_code == 200
+    r = await client.get('/metrics')
+    assert r.status_code == 200
+    assert r.headers['content-type'].startswith('text/plain')
+
+    def added(name: str, **labels: str) -> float:
+        return ((sample(r.text, name, **labels) or 0) -
+                (sample(before, name, **labels) or 0))
+
+    assert added(
+        'vote_http_requests_total',
+        method='POST',
+        route='/vote/',
+        status='200',
+    ) == 1
+    # the memory backend is timed by repository operation as well
+    assert added(
+        'vote_db_query_duration_seconds_count',
+        operation='vote.add',
+    ) == 1
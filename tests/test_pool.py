@@ -0,0 +1,71 @@
+import pytest
+from vote.db import pool
+from vote.db.pool import SurrealConfig, SurrealPool
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeSurreal:
+    '''
+    Connection whose sign-in fails if its index is in `rejected`.
+    '''
+    rejected: set[int] = set()
+    connections: list['FakeSurreal'] = []
+
+    def __init__(self, url: str, slow_query: float) -> None:
+        self.closed = False
+        self.id = len(self.connections)
+        self.connections.append(self)
+
+    async def connect(self):
+        pass
+
+    async def signin(self, vars: dict):
+        if self.id in self.rejected:
+            raise RuntimeError('sign-in failed')
+
+    async def use(self, namespace: str, database: str):
+        pass
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def surreal(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(FakeSurreal, 'connections', [])
+    monkeypatch.setattr(FakeSurreal, 'rejected', set())
+    monkeypatch.setattr(pool, 'InstrumentedSurreal', FakeSurreal)
+    return FakeSurreal
+
+
+def new_pool(size: int) -> SurrealPool:
+    return SurrealPool(
+        SurrealConfig(
+            url='ws://test/rpc',
+            username='root',
+            password='root',
+            namespace='test',
+            database='test',
+            pool_size=size,
+        ))
+
+
+async def test_open(surreal):
+    db_pool = new_pool(3)
+    await db_pool.open()
+    assert (db_pool.stats().opened, db_pool.stats().idle) == (3, 3)
+    await db_pool.close()
+    assert all(c.closed for c in surreal.connections)
+    assert db_pool.stats().opened == 0
+
+
+async def test_open_failed(surreal):
+    surreal.rejected = {1}
+    db_pool = new_pool(3)
+    with pytest.raises(RuntimeError):
+        await db_pool.open()
+    # connections which did open are not leaked
+    assert len(surreal.connections) == 3
+    assert all(c.closed for c in surreal.connections)
+    assert (db_pool.stats().opened, db_pool.stats().idle) == (0, 0)
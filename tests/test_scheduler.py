@@ -0,0 +1,34 @@
+from datetime import datetime, timedelta, timezone
+import asyncio
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_schedule_started_topic(client, add_user):
+    headers = await add_user('alice')
+    now = datetime.now(timezone.utc)
+    # created after it should have started, e.g. a late admin
+    r = await client.post(
+        '/topic/',
+        json={
+            'starts_at': (now - timedelta(minutes=1)).isoformat(),
+            'ends_at': (now + timedelta(hours=1)).isoformat(),
+            'options': [{
+                'label': 'yes',
+                'description': '',
+            }],
+        },
+        headers=headers,
+    )
+    assert r.status_code == 200
+    topic_id = r.json()['id']
+    # moved to the next stage right away, not only by the next deadline
+    for _ in range(50):
+        topic = (await client.get(f'/topic/{topic_id}')).json()
+        if topic['stage'] != 'NOT_STARTED':
+            break
+        await asyncio.sleep(0.01)
+    body = {'topic_id': topic_id, 'option_id': topic['options'][0]['id']}
+    r = await client.post('/vote/', json=body, headers=headers)
+    assert r.status_code == 200
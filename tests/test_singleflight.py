@@ -0,0 +1,103 @@
+import asyncio
+import pytest
+from vote.singleflight import SingleFlight
+
+pytestmark = pytest.mark.anyio
+
+
+class Call:
+    '''
+    A call which blocks until `release`, counting how often it runs.
+    '''
+
+    def __init__(self, result='result') -> None:
+        self.result = result
+        self.calls = 0
+        self.started = asyncio.Event()
+        self._release = asyncio.Event()
+
+    def release(self):
+        self._release.set()
+
+    async def __call__(self):
+        self.calls += 1
+        self.started.set()
+        await self._release.wait()
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+async def test_coalesce():
+    flight = SingleFlight()
+    call = Call()
+    tasks = [
+        asyncio.create_task(flight.do('op', 'key', call)) for _ in range(5)
+    ]
+    await call.started.wait()
+    assert flight.in_flight() == 1
+    call.release()
+    assert await asyncio.gather(*tasks) == ['result'] * 5
+    assert call.calls == 1
+    assert flight.in_flight() == 0
+    # it's only shared while it runs
+    assert await flight.do('op', 'key', call) == 'result'
+    assert call.calls == 2
+
+
+async def test_different_keys():
+    flight = SingleFlight()
+    call = Call()
+    call.release()
+    await asyncio.gather(
+        flight.do('op', 'a', call),
+        flight.do('op', 'b', call),
+        flight.do('other', 'a', call),
+    )
+    assert call.calls == 3
+
+
+async def test_exception():
+    flight = SingleFlight()
+    call = Call(ValueError('boom'))
+    tasks = [
+        asyncio.create_task(flight.do('op', 'key', call)) for _ in range(3)
+    ]
+    await call.started.wait()
+    call.release()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    assert all(isinstance(r, ValueError) for r in results)
+    assert call.calls == 1
+    assert flight.in_flight() == 0
+
+
+async def test_leader_cancelled():
+    flight = SingleFlight()
+    call = Call()
+    leader = asyncio.create_task(flight.do('op', 'key', call))
+    await call.started.wait()
+    follower = asyncio.create_task(flight.do('op', 'key', call))
+    await asyncio.sleep(0)
+    leader.cancel()
+    await asyncio.sleep(0)
+    # the follower runs it again instead of getting cancelled
+    call.release()
+    assert await follower == 'result'
+    assert leader.cancelled()
+    assert call.calls == 2
+
+
+async def test_follower_cancelled():
+    flight = SingleFlight()
+    call = Call()
+    leader = asyncio.create_task(flight.do('op', 'key', call))
+    await call.started.wait()
+    follower = asyncio.create_task(flight.do('op', 'key', call))
+    await asyncio.sleep(0)
+    follower.cancel()
+    await asyncio.sleep(0)
+    # the call isn't cancelled with it
+    call.release()
+    assert await leader == 'result'
+    assert follower.cancelled()
+    assert call.calls == 1
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+import json
+import pytest
+from vote.api.topic import stream_vote_result
+from vote.domain.vote import VoteService
+
+pytestmark = pytest.mark.anyio
+
+
+async def next_event(events) -> tuple[str, dict]:
+    while True:
+        chunk = await events.__anext__()
+        if chunk.startswith('event: '):
+            event, data = chunk.split('\n')[:2]
+            return event[len('event: '):], json.loads(data[len('data: '):])
+
+
+@pytest.mark.parametrize(
+    'vote_config',
+    [{
+        'stream': {
+            'min_interval': 0,
+        }
+    }],
+    indirect=True,
+)
+async def test_vote_during_snapshot(
+    app,
+    client,
+    add_user,
+    add_topic,
+    vote_config,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    topic = await add_topic()
+    a, b = (o.id for o in topic.options)
+    alice = await add_user('alice')
+    bob = await add_user('bob')
+    get_tally = VoteService.get_tally
+
+    async def vote_then_get_tally(svc, topic_id: str):
+        # committed and published while the snapshot is read
+        body = {'topic_id': topic.id, 'option_id': a}
+        r = await client.post('/vote/', json=body, headers=alice)
+        assert r.status_code == 200
+        monkeypatch.setattr(VoteService, 'get_tally', get_tally)
+        return await get_tally(svc, topic_id)
+
+    monkeypatch.setattr(VoteService, 'get_tally', vote_then_get_tally)
+    response = await stream_vote_result(
+        topic.id,
+        SimpleNamespace(app=app),
+        app.state.tally_broker,
+        vote_config,
+    )
+    events = response.body_iterator
+    assert await next_event(events) == ('snapshot', {a: 1, b: 0})
+    body = {'topic_id': topic.id, 'option_id': b}
+    r = await client.post('/vote/', json=body, headers=bob)
+    assert r.status_code == 200
+    # alice's vote isn't counted again
+    assert await next_event(events) == ('delta', {b: 1})
+    await events.aclose()
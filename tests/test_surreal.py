@@ -0,0 +1,100 @@
+'''
+Run the request-level tests touching SurrealQL queries again against a
+SurrealDB, e.g. `ws://localhost:8080/rpc` of `start-db.sh`, given by
+`VOTE_TEST_SURREAL_URL`. They're skipped without it. Each test gets a new
+database.
+'''
+from datetime import datetime, timedelta, timezone
+import os
+import secrets
+import pytest
+from vote.config import VoteConfigToml, set_vote_config
+from vote.db import topic_repository, vote_repository
+from vote.domain.topic import TopicStage
+from .test_batch import test_batch, test_batch_after_end, test_ndjson
+from .test_topic import (
+    test_comment_pages,
+    test_topic_fields,
+    test_topic_pages,
+    test_topic_pages_with_new_topic,
+)
+from .test_vote import (
+    test_concurrent_votes_of_same_user,
+    test_freeze_open_topic,
+    test_freeze_waits_for_end,
+    test_recompute_result,
+    test_tally,
+    test_vote,
+    test_vote_after_end,
+    test_vote_after_result_frozen,
+    test_vote_not_in_progress,
+    test_vote_twice,
+)
+
+SURREAL_URL = os.environ.get('VOTE_TEST_SURREAL_URL')
+
+pytestmark = [
+    pytest.mark.anyio,
+    pytest.mark.skipif(
+        SURREAL_URL is None,
+        reason='VOTE_TEST_SURREAL_URL is not set',
+    ),
+]
+
+
+@pytest.fixture
+def vote_config(vote_config: VoteConfigToml):
+    db = vote_config.db.copy(
+        update={
+            'backend': 'surreal',
+            'url': SURREAL_URL,
+            'username': 'root',
+            'password': 'root',
+            'namespace': 'test',
+            'database': f'test_{secrets.token_hex(8)}',
+        })
+    config = vote_config.copy(update={'db': db})
+    set_vote_config(config)
+    return config
+
+
+async def test_recount(app, client, add_user, add_topic):
+    topic = await add_topic()
+    for i, username in enumerate(('alice', 'bob', 'carol')):
+        headers = await add_user(username)
+        body = {'topic_id': topic.id, 'option_id': topic.options[i % 2].id}
+        r = await client.post('/vote/', json=body, headers=headers)
+        assert r.status_code == 200
+    expected = {topic.options[0].id: 2, topic.options[1].id: 1}
+    async with app.state.db_pool.acquire() as db:
+        repo = vote_repository(db)
+        assert await repo.get_tally(topic.id) == expected
+        await db.query('UPDATE vote_tally SET count = 100;')
+        await repo.recount(topic.id)
+        assert await repo.get_tally(topic.id) == expected
+        await db.query('DELETE vote_tally;')
+        await repo.recount()
+        assert await repo.get_tally(topic.id) == expected
+
+
+async def test_refresh_stages(app, add_topic):
+    topics = [
+        await add_topic(timedelta(hours=1), timedelta(hours=2)),
+        await add_topic(),
+        await add_topic(timedelta(hours=-2), timedelta(hours=-1)),
+    ]
+    assert [t.stage for t in topics] == [
+        TopicStage.NOT_STARTED,
+        TopicStage.IN_PROGRESS,
+        TopicStage.ENDED,
+    ]
+    async with app.state.db_pool.acquire() as db:
+        repo = topic_repository(db)
+        later = datetime.now(timezone.utc) + timedelta(hours=1.5)
+        # the first one starts and the second one ends
+        assert await repo.refresh_stages(later) == 2
+        assert await repo.refresh_stages(later) == 0
+        stages = [(await repo.get_by_id(t.id)).stage for t in topics]
+    assert stages == [
+        TopicStage.IN_PROGRESS, TopicStage.ENDED, TopicStage.ENDED
+    ]
@@ -0,0 +1,71 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def get_pages(client, url: str, **params) -> list[list[dict]]:
+    pages = []
+    cursor = None
+    while True:
+        if cursor is not None:
+            params['cursor'] = cursor
+        r = await client.get(url, params=params)
+        assert r.status_code == 200
+        pages.append(r.json()['items'])
+        cursor = r.json()['next_cursor']
+        if cursor is None:
+            return pages
+
+
+async def test_topic_pages(client, add_topic):
+    topics = [await add_topic() for _ in range(5)]
+    pages = await get_pages(client, '/topic/', limit=2)
+    assert [len(p) for p in pages] == [2, 2, 1]
+    # newer first
+    ids = [t['id'] for p in pages for t in p]
+    assert ids == [t.id for t in reversed(topics)]
+
+
+async def test_topic_pages_with_new_topic(client, add_topic):
+    topics = [await add_topic() for _ in range(3)]
+    r = await client.get('/topic/', params={'limit': 2})
+    cursor = r.json()['next_cursor']
+    # a new topic doesn't shift later pages
+    await add_topic()
+    r = await client.get('/topic/', params={'limit': 2, 'cursor': cursor})
+    assert [t['id'] for t in r.json()['items']] == [topics[0].id]
+
+
+async def test_topic_fields(client, add_topic):
+    topic = await add_topic()
+    r = await client.get('/topic/', params={'fields': 'stage, ends_at'})
+    assert r.status_code == 200
+    item, = r.json()['items']
+    # plus the keys of the cursor
+    assert set(item) == {'id', 'created_at', 'stage', 'ends_at'}
+    assert item['stage'] == topic.stage
+    r = await client.get('/topic/', params={'fields': 'stage,password'})
+    assert r.status_code == 400
+
+
+async def test_invalid_cursor(client):
+    r = await client.get('/topic/', params={'cursor': 'nope'})
+    assert r.status_code == 400
+    assert r.json() == {'detail': 'Invalid cursor'}
+
+
+async def test_comment_pages(client, add_user, add_topic):
+    headers = await add_user('alice')
+    topic = await add_topic()
+    other = await add_topic()
+    for i in range(5):
+        body = {'topic_id': topic.id, 'content': f'comment {i}'}
+        r = await client.post('/comment/', json=body, headers=headers)
+        assert r.status_code == 204
+    body = {'topic_id': other.id, 'content': 'elsewhere'}
+    await client.post('/comment/', json=body, headers=headers)
+    pages = await get_pages(client, '/comment/', topic_id=topic.id, limit=2)
+    assert [len(p) for p in pages] == [2, 2, 1]
+    # older first
+    contents = [c['content'] for p in pages for c in p]
+    assert contents == [f'comment {i}' for i in range(5)]
@@ -0,0 +1,19 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_request_id(client):
+    headers = {'X-Request-ID': 'abc-1'}
+    r = await client.get('/healthz/liveness', headers=headers)
+    assert r.headers['x-request-id'] == 'abc-1'
+    # a new one for every request without it
+    ids = {(await client.get('/healthz/liveness')).headers['x-request-id']
+           for _ in range(2)}
+    assert len(ids) == 2
+
+
+@pytest.mark.parametrize('rid', ['', 'a b', 'x' * 65])
+async def test_invalid_request_id(client, rid: str):
+    r = await client.get('/healthz/liveness', headers={'X-Request-ID': rid})
+    assert r.headers['x-request-id'] not in ('', rid)
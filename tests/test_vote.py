@@ -0,0 +1,202 @@
+from datetime import datetime, timedelta, timezone
+import asyncio
+import pytest
+from vote.db import topic_repository, vote_repository
+from vote.domain import vote as vote_module
+from vote.domain.vote import TopicNotEndedError, VoteResult, VoteService
+
+pytestmark = pytest.mark.anyio
+
+
+def vote_body(topic, option: int = 0) -> dict[str, str]:
+    return {'topic_id': topic.id, 'option_id': topic.options[option].id}
+
+
+async def test_vote(client, add_user, add_topic):
+    headers = await add_user('alice')
+    topic = await add_topic()
+    r = await client.post('/vote/', json=vote_body(topic, 1), headers=headers)
+    assert r.status_code == 200
+    r = await client.get(f'/topic/{topic.id}/my-vote', headers=headers)
+    assert r.json()['option_id'] == topic.options[1].id
+
+
+async def test_vote_twice(client, add_user, add_topic):
+    headers = await add_user('alice')
+    topic = await add_topic()
+    r = await client.post('/vote/', json=vote_body(topic), headers=headers)
+    assert r.status_code == 200
+    # another option doesn't make it a different vote
+    r = await client.post('/vote/', json=vote_body(topic, 1), headers=headers)
+    assert r.status_code == 409
+    assert r.json() == {'detail': 'Already voted'}
+
+
+async def get_tally(app, topic_id: str) -> dict[str, int]:
+    async with app.state.db_pool.acquire() as db:
+        return await vote_repository(db).get_tally(topic_id)
+
+
+async def test_concurrent_votes_of_same_user(
+    app,
+    client,
+    add_user,
+    add_topic,
+):
+    headers = await add_user('alice')
+    topic = await add_topic()
+    responses = await asyncio.gather(*[
+        client.post('/vote/', json=vote_body(topic, i % 2), headers=headers)
+        for i in range(10)
+    ])
+    statuses = sorted(r.status_code for r in responses)
+    assert statuses == [200] + [409] * 9
+    assert sum((await get_tally(app, topic.id)).values()) == 1
+
+
+async def test_vote_of_other_user(client, add_user, add_topic):
+    topic = await add_topic()
+    for username in ('alice', 'bob'):
+        headers = await add_user(username)
+        r = await client.post('/vote/', json=vote_body(topic), headers=headers)
+        assert r.status_code == 200
+
+
+@pytest.mark.parametrize('starts_at, ends_at', [(1, 2), (-2, -1)])
+async def test_vote_not_in_progress(
+    client,
+    add_user,
+    add_topic,
+    starts_at,
+    ends_at,
+):
+    headers = await add_user('alice')
+    topic = await add_topic(
+        timedelta(hours=starts_at),
+        timedelta(hours=ends_at),
+    )
+    r = await client.post('/vote/', json=vote_body(topic), headers=headers)
+    assert r.status_code == 400
+
+
+async def test_vote_invalid_option(client, add_user, add_topic):
+    headers = await add_user('alice')
+    topic = await add_topic()
+    body = {'topic_id': topic.id, 'option_id': 'nope'}
+    r = await client.post('/vote/', json=body, headers=headers)
+    assert r.status_code == 400
+
+
+async def test_vote_after_result_frozen(app, client, add_user, add_topic):
+    headers = await add_user('alice')
+    topic = await add_topic()
+    async with app.state.db_pool.acquire() as db:
+        await vote_repository(db).add_result(
+            VoteResult(
+                topic_id=topic.id,
+                counts={o.id: 0
+                        for o in topic.options},
+                total=0,
+                winners=[],
+                checksum='',
+                computed_at=datetime.now(timezone.utc),
+            ))
+    # the stage isn't refreshed yet, but the result must not change
+    r = await client.post('/vote/', json=vote_body(topic), headers=headers)
+    assert r.status_code == 400
+    assert sum((await get_tally(app, topic.id)).values()) == 0
+
+
+async def freeze_result(app, topic) -> VoteResult:
+    async with app.state.db_pool.acquire() as db:
+        svc = VoteService(vote_repository(db), topic_repository(db))
+        return await svc.freeze_result(topic)
+
+
+async def test_vote_after_end(app, client, add_user, add_topic, end_topic):
+    headers = await add_user('alice')
+    topic = await add_topic()
+    r = await client.post('/vote/', json=vote_body(topic), headers=headers)
+    assert r.status_code == 200
+    topic = await end_topic(topic)
+    headers = await add_user('bob')
+    r = await client.post('/vote/', json=vote_body(topic, 1), headers=headers)
+    assert r.status_code == 400
+    result = await freeze_result(app, topic)
+    assert result.counts == {topic.options[0].id: 1, topic.options[1].id: 0}
+    assert result.winners == [topic.options[0].id]
+
+
+async def test_freeze_open_topic(app, add_topic, monkeypatch):
+    monkeypatch.setattr(vote_module, 'FREEZE_RETRIES', 2)
+    monkeypatch.setattr(vote_module, 'FREEZE_RETRY_DELAY', 0)
+    topic = await add_topic()
+    with pytest.raises(TopicNotEndedError):
+        await freeze_result(app, topic)
+    assert sum((await get_tally(app, topic.id)).values()) == 0
+
+
+async def test_freeze_waits_for_end(
+    app,
+    client,
+    add_user,
+    add_topic,
+    monkeypatch,
+):
+    monkeypatch.setattr(vote_module, 'FREEZE_RETRY_DELAY', 0.1)
+    headers = await add_user('alice')
+    topic = await add_topic(ends_at=timedelta(seconds=0.5))
+    r = await client.post('/vote/', json=vote_body(topic), headers=headers)
+    assert r.status_code == 200
+    # called before the topic ends, e.g. the app's clock is ahead
+    result = await freeze_result(app, topic)
+    assert result.total == 1
+
+
+async def test_tally(app, client, add_user, add_topic):
+    topic = await add_topic(options=3)
+    for i, username in enumerate(('alice', 'bob', 'carol')):
+        headers = await add_user(username)
+        r = await client.post(
+            '/vote/',
+            json=vote_body(topic, i % 2),
+            headers=headers,
+        )
+        assert r.status_code == 200
+    # options without votes aren't in the tally
+    assert await get_tally(app, topic.id) == {
+        topic.options[0].id: 2,
+        topic.options[1].id: 1,
+    }
+
+
+async def test_recompute_result(
+    app,
+    client,
+    add_user,
+    add_topic,
+    end_topic,
+):
+    topic = await add_topic()
+    for i, username in enumerate(('alice', 'bob', 'carol')):
+        headers = await add_user(username)
+        r = await client.post(
+            '/vote/',
+            json=vote_body(topic, i % 2),
+            headers=headers,
+        )
+        assert r.status_code == 200
+    await end_topic(topic)
+    r = await client.post('/topic/refresh')
+    assert r.status_code == 204
+    r = await client.get(f'/topic/{topic.id}/vote-result')
+    assert r.status_code == 200
+    frozen = r.json()
+    assert frozen['counts'] == {topic.options[0].id: 2, topic.options[1].id: 1}
+    headers = await add_user('admin', ['admin'])
+    url = f'/topic/{topic.id}/vote-result/recompute'
+    r = await client.post(url, headers=headers)
+    assert r.status_code == 200
+    assert r.json()['result']['counts'] == frozen['counts']
+    assert r.json()['previous'] == frozen
+    assert r.json()['changed'] is False
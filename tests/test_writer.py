@@ -0,0 +1,159 @@
+from contextlib import asynccontextmanager
+import asyncio
+import pytest
+from vote.domain.vote import (
+    BatchVoteInput,
+    BatchVoteStatus,
+    CreateVoteInput,
+    DuplicatedVoteError,
+    VoteNotAllowedError,
+)
+from vote.db import vote_repository
+from vote.writer import VoteWriter
+import vote.writer
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeVoteRepository:
+    '''
+    `add_many` of a vote repository, which can be blocked with `hold`.
+    '''
+
+    def __init__(self) -> None:
+        self.batches: list[list[str]] = []
+        self.statuses: dict[str, BatchVoteStatus] = {}
+        self.error: Exception | None = None
+        self.hold = asyncio.Event()
+        self.hold.set()
+        self.writing = asyncio.Event()
+
+    @asynccontextmanager
+    async def open(self):
+        yield self
+
+    async def add_many(
+        self,
+        votes: list[BatchVoteInput],
+    ) -> list[BatchVoteStatus]:
+        self.writing.set()
+        await self.hold.wait()
+        if self.error is not None:
+            raise self.error
+        self.batches.append([v.username for v in votes])
+        return [
+            self.statuses.get(v.username, BatchVoteStatus.OK) for v in votes
+        ]
+
+
+@pytest.fixture
+async def repo():
+    return FakeVoteRepository()
+
+
+@pytest.fixture
+async def writer(repo: FakeVoteRepository):
+    writer = VoteWriter(repo.open, window=0.01, size=3)
+    writer.start()
+    yield writer
+    await writer.stop()
+
+
+def add(writer: VoteWriter, username: str) -> asyncio.Task:
+    input = CreateVoteInput(topic_id='topic:a', option_id='option:a')
+    return asyncio.create_task(writer.add(username, input))
+
+
+async def test_batch(repo: FakeVoteRepository, writer: VoteWriter):
+    await asyncio.gather(*(add(writer, f'user{i}') for i in range(7)))
+    assert [len(b) for b in repo.batches] == [3, 3, 1]
+    assert sum(repo.batches, []) == [f'user{i}' for i in range(7)]
+    assert writer.pending() == 0
+
+
+async def test_status_of_each_vote(
+    repo: FakeVoteRepository,
+    writer: VoteWriter,
+):
+    repo.statuses = {
+        'bob': BatchVoteStatus.DUPLICATED,
+        'carol': BatchVoteStatus.NOT_IN_PROGRESS,
+    }
+    alice, bob, carol = (add(writer, u) for u in ('alice', 'bob', 'carol'))
+    await alice
+    with pytest.raises(DuplicatedVoteError):
+        await bob
+    with pytest.raises(VoteNotAllowedError):
+        await carol
+    assert repo.batches == [['alice', 'bob', 'carol']]
+
+
+async def test_stop_while_writing(repo: FakeVoteRepository):
+    writer = VoteWriter(repo.open, window=0.01, size=3)
+    writer.start()
+    repo.hold.clear()
+    tasks = [add(writer, f'user{i}') for i in range(7)]
+    await repo.writing.wait()
+    stop = asyncio.create_task(writer.stop())
+    await asyncio.sleep(0.05)
+    assert not stop.done()
+    repo.hold.set()
+    await stop
+    # the write in progress and the pending votes are all written
+    await asyncio.gather(*tasks)
+    assert [len(b) for b in repo.batches] == [3, 3, 1]
+
+
+async def test_write_failed(
+    repo: FakeVoteRepository,
+    writer: VoteWriter,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(vote.writer, 'RETRY_DELAY', 0)
+    repo.error = RuntimeError('connection lost')
+    results = await asyncio.gather(
+        *(add(writer, f'user{i}') for i in range(5)),
+        return_exceptions=True,
+    )
+    # votes waiting for the next batch fail as well
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert writer.pending() == 0
+
+
+async def test_caller_went_away(
+    repo: FakeVoteRepository,
+    writer: VoteWriter,
+):
+    gone = add(writer, 'alice')
+    await asyncio.sleep(0)
+    gone.cancel()
+    await add(writer, 'bob')
+    assert repo.batches == [['bob']]
+
+
+@pytest.mark.parametrize(
+    'vote_config',
+    [{
+        'vote': {
+            'group_commit': True,
+            'group_commit_window': 0.01,
+        }
+    }],
+    indirect=True,
+)
+async def test_group_commit(app, client, add_user, add_topic):
+    assert app.state.vote_writer is not None
+    topic = await add_topic()
+    users = [await add_user(f'user{i}') for i in range(5)]
+    bodies = [{
+        'topic_id': topic.id,
+        'option_id': topic.options[i % 2].id,
+    } for i in range(len(users))]
+    responses = await asyncio.gather(*[
+        client.post('/vote/', json=body, headers=headers)
+        for body, headers in zip(bodies + bodies[:1], users + users[:1])
+    ])
+    assert sorted(r.status_code for r in responses) == [200] * 5 + [409]
+    async with app.state.db_pool.acquire() as db:
+        tally = await vote_repository(db).get_tally(topic.id)
+    assert tally == {topic.options[0].id: 3, topic.options[1].id: 2}
@@ -1,120 +1,274 @@
-from typing import Annotated
-from surrealdb import Surreal
-from fastapi import Depends
+from typing import Annotated, Any, AsyncIterator
+from contextlib import AsyncExitStack, asynccontextmanager
+from fastapi import Depends, FastAPI, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
-from pydantic import BaseSettings, BaseModel
-import toml
-from vote.domain.user import UserRepository, UserRepositoryImpl, UserService
-from vote.domain.topic import TopicService, TopicRepositoryImpl
-from vote.domain.vote import VoteService, VoteRepositoryImpl
-from vote.domain.auth import AuthConfig, AuthService
-from vote.domain.comment import CommentRepositoryImpl, CommentService
+from vote.domain.user import (
+    User,
+    UserRepository,
+    UserService,
+    PasswordHasher,
+)
+from vote.domain.topic import (
+    Topic,
+    TopicService,
+    TopicRepository,
+    CachedTopicRepository,
+)
+from vote.domain.vote import VoteService, VoteRepository
+from vote.domain.auth import AuthService
+from vote.domain.comment import CommentService
+from vote.domain.page import Cursor, InvalidCursorError
+from vote.db import (
+    Database,
+    DatabasePool,
+    user_repository,
+    topic_repository,
+    vote_repository,
+    comment_repository,
+)
+from vote.config import VoteConfigToml
+from vote.cache import TTLCache
+from vote.scheduler import StageScheduler
+from vote.events import TallyBroker
+from vote.singleflight import SingleFlight
+from vote.writer import VoteWriter, GroupCommitVoteRepository
+from vote import config
 
 oauth2_schema = OAuth2PasswordBearer(tokenUrl='/auth/token')
 
 
-class SurrealConfig(BaseModel):
-    url: str
-    username: str
-    password: str
-    namespace: str
-    database: str
+async def get_vote_config() -> VoteConfigToml:
+    return config.get_vote_config()
 
 
-def toml_settings(settings: BaseSettings) -> dict:
-    return toml.load(open(settings.__config__.path))
+def get_db_pool(request: Request) -> DatabasePool:
+    return request.app.state.db_pool
 
 
-# https://docs.pydantic.dev/latest/usage/settings/#customise-settings-sources
-class VoteConfigToml(BaseSettings):
+class DatabaseLease:
     '''
-    Config for vote app loading from a toml file
+    Connection of a request, it's acquired on first use, so requests
+    which don't need the DB (e.g. cache hits) don't wait for one.
     '''
-    auth: AuthConfig
-    db: SurrealConfig
-
-    class Config:
-        path = 'vote.toml'
-
-        @classmethod
-        def customise_sources(
-            cls,
-            init_settings,
-            env_settings,
-            file_secret_settings,
-        ):
-            return (
-                init_settings,
-                toml_settings,
-                env_settings,
-                file_secret_settings,
-            )
-
-
-def get_vote_config():
-    return VoteConfigToml()
-
-
-async def get_db(cfg: Annotated[
-    VoteConfigToml,
-    Depends(get_vote_config),
-]):
-    db = Surreal(cfg.db.url)
-    async with db as db:
-        await db.signin({
-            'user': cfg.db.username,
-            'pass': cfg.db.password,
-        })
-        await db.use(
-            cfg.db.namespace,
-            cfg.db.database,
-        )
-        yield db
 
+    def __init__(self, pool: DatabasePool, stack: AsyncExitStack) -> None:
+        self.pool = pool
+        self.stack = stack
+        self._db: Database | None = None
 
-async def get_user_repository(db: Annotated[
-    Surreal,
-    Depends(get_db),
-]):
-    repo = UserRepositoryImpl(db)
-    await repo.init_db()
-    return repo
+    async def get(self) -> Database:
+        if self._db is None:
+            self._db = await self.stack.enter_async_context(
+                self.pool.acquire())
+        return self._db
 
 
-async def get_user_service(repo: Annotated[
-    UserRepository,
-    Depends(get_user_repository),
+async def get_db_lease(pool: Annotated[
+    DatabasePool,
+    Depends(get_db_pool),
 ]):
-    return UserService(repo)
+    # errors of the request go through the pool, like a plain `acquire`
+    async with AsyncExitStack() as stack:
+        yield DatabaseLease(pool, stack)
 
 
-async def get_topic_service(db: Annotated[
-    Surreal,
-    Depends(get_db),
+async def get_db(lease: Annotated[
+    DatabaseLease,
+    Depends(get_db_lease),
 ]):
-    return TopicService(TopicRepositoryImpl(db))
+    return await lease.get()
 
 
-async def get_vote_service(db: Annotated[
-    Surreal,
+async def get_user_repository(db: Annotated[
+    Database,
     Depends(get_db),
 ]):
-    repo = VoteRepositoryImpl(db)
-    await repo.init_db()
-    return VoteService(repo)
+    return user_repository(db)
 
 
-def get_auth_service(cfg: Annotated[
-    VoteConfigToml,
-    Depends(get_vote_config),
-]):
-    return AuthService(cfg.auth)
+def get_password_hasher(request: Request) -> PasswordHasher:
+    return request.app.state.password_hasher
+
+
+async def get_user_service(
+    repo: Annotated[
+        UserRepository,
+        Depends(get_user_repository),
+    ],
+    hasher: Annotated[
+        PasswordHasher,
+        Depends(get_password_hasher),
+    ],
+):
+    return UserService(repo, hasher)
+
+
+def get_topic_cache(request: Request) -> TTLCache[str, Topic]:
+    return request.app.state.topic_cache
+
+
+def get_stage_scheduler(request: Request) -> StageScheduler:
+    return request.app.state.stage_scheduler
+
+
+def get_tally_broker(request: Request) -> TallyBroker:
+    return request.app.state.tally_broker
+
+
+def get_single_flight(request: Request) -> SingleFlight:
+    return request.app.state.single_flight
+
+
+def get_vote_writer(request: Request) -> VoteWriter | None:
+    return request.app.state.vote_writer
+
+
+@asynccontextmanager
+async def acquire_topic_repository(
+        app: FastAPI) -> AsyncIterator[TopicRepository]:
+    '''
+    Topic repository outside of a request, e.g. for background tasks
+    or long-lived responses which should not hold a connection.
+    '''
+    async with app.state.db_pool.acquire() as db:
+        yield CachedTopicRepository(
+            topic_repository(db),
+            app.state.topic_cache,
+        )
+
+
+@asynccontextmanager
+async def acquire_vote_repository(
+        app: FastAPI) -> AsyncIterator[VoteRepository]:
+    async with app.state.db_pool.acquire() as db:
+        yield vote_repository(db)
+
+
+@asynccontextmanager
+async def acquire_vote_service(app: FastAPI) -> AsyncIterator[VoteService]:
+    '''
+    Vote service outside of a request, reads go through the app's
+    single-flight like in requests.
+    '''
+    async with app.state.db_pool.acquire() as db:
+        yield VoteService(
+            vote_repository(db),
+            CachedTopicRepository(topic_repository(db), app.state.topic_cache),
+            app.state.tally_broker,
+            config.get_vote_config().vote,
+            app.state.single_flight,
+        )
+
+
+async def warm_up_topic_cache(app: FastAPI, limit: int):
+    '''
+    Load the newest topics into the topic cache, they are the ones most
+    requests are about.
+    '''
+    if limit <= 0:
+        return
+    async with app.state.db_pool.acquire() as db:
+        page = await topic_repository(db).get_page(limit)
+    for row in page.items:
+        app.state.topic_cache.set(row['id'], Topic.parse_obj(row))
+
+
+async def freeze_results(app: FastAPI, topics: list[Topic]):
+    '''
+    Store results of topics which have just ended.
+    '''
+    async with acquire_vote_service(app) as svc:
+        for topic in topics:
+            await svc.freeze_result(topic)
+
+
+async def get_topic_repository(
+    db: Annotated[Database, Depends(get_db)],
+    cache: Annotated[
+        TTLCache[str, Topic],
+        Depends(get_topic_cache),
+    ],
+):
+    return CachedTopicRepository(topic_repository(db), cache)
+
+
+async def get_topic_service(
+    repo: Annotated[
+        TopicRepository,
+        Depends(get_topic_repository),
+    ],
+    flight: Annotated[SingleFlight, Depends(get_single_flight)],
+):
+    return TopicService(repo, flight)
+
+
+async def get_vote_service(
+    db: Annotated[Database, Depends(get_db)],
+    topic_repo: Annotated[
+        TopicRepository,
+        Depends(get_topic_repository),
+    ],
+    broker: Annotated[TallyBroker, Depends(get_tally_broker)],
+    cfg: Annotated[
+        VoteConfigToml,
+        Depends(get_vote_config),
+    ],
+    flight: Annotated[SingleFlight, Depends(get_single_flight)],
+    writer: Annotated[
+        VoteWriter | None,
+        Depends(get_vote_writer),
+    ],
+):
+    repo = vote_repository(db)
+    if writer is not None:
+        repo = GroupCommitVoteRepository(repo, writer)
+    return VoteService(
+        repo,
+        topic_repo,
+        broker,
+        cfg.vote,
+        flight,
+    )
+
+
+def get_token_cache(request: Request) -> TTLCache[str, dict[str, Any]]:
+    return request.app.state.token_cache
+
+
+def get_user_cache(request: Request) -> TTLCache[tuple[str, int | None], User]:
+    return request.app.state.user_cache
+
+
+async def get_auth_service(
+    cfg: Annotated[
+        VoteConfigToml,
+        Depends(get_vote_config),
+    ],
+    token_cache: Annotated[
+        TTLCache[str, dict[str, Any]],
+        Depends(get_token_cache),
+    ],
+):
+    return AuthService(cfg.auth, token_cache)
 
 
 async def get_comment_service(db: Annotated[
-    Surreal,
+    Database,
     Depends(get_db),
 ]):
-    repo = CommentRepositoryImpl(db)
-    # await repo.init_db()
-    return CommentService(repo)
+    return CommentService(comment_repository(db))
+
+
+async def get_cursor(cursor: str | None = None) -> Cursor | None:
+    '''
+    Cursor of the page to fetch, it's `next_cursor` of the previous page.
+    '''
+    if cursor is None:
+        return None
+    try:
+        return Cursor.decode(cursor)
+    except InvalidCursorError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Invalid cursor',
+        )
@@ -0,0 +1,280 @@
+'''
+Admission control: a concurrency limit with a bounded priority queue,
+and token buckets on write routes. Requests which would only make
+everybody slower are rejected early and cheaply.
+'''
+from collections import OrderedDict
+from enum import IntEnum
+from typing import Hashable
+from fastapi.responses import JSONResponse
+from jose import JWTError
+from starlette.types import ASGIApp, Receive, Scope, Send
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from vote.config import AdmissionConfig, get_vote_config
+from vote.domain.auth import AuthService
+from vote.metrics import ADMISSION_REJECTED
+
+
+class Priority(IntEnum):
+    '''
+    Lower is served first.
+    '''
+    CRITICAL = 0
+    NORMAL = 1
+    LOW = 2
+
+
+# routes limited by token buckets, without trailing slash
+RATE_LIMITED_ROUTES = frozenset({
+    '/vote',
+    '/comment',
+    '/user/signup',
+    '/auth/token',
+})
+
+
+def classify(method: str, path: str) -> Priority | None:
+    '''
+    Priority of a request, `None` if it's not limited at all, e.g. long
+    lived streams which would hold a slot until the client leaves.
+    '''
+    if path.endswith('/stream') and path.startswith('/topic/'):
+        return None
+    if path.startswith(('/healthz', '/metrics')):
+        return Priority.CRITICAL
+    if method == 'POST' and path.rstrip('/') == '/vote':
+        return Priority.CRITICAL
+    if method == 'GET' and (path.startswith('/comment')
+                            or path.rstrip('/') == '/topic'):
+        return Priority.LOW
+    return Priority.NORMAL
+
+
+# routes only limited per user, many voters may share one IP (NAT, kiosks)
+IP_EXEMPT_ROUTES = frozenset({'/vote'})
+
+
+def is_rate_limited(method: str, path: str) -> bool:
+    if method not in ('POST', 'PUT', 'PATCH', 'DELETE'):
+        return False
+    return (path.rstrip('/') in RATE_LIMITED_ROUTES
+            or path.startswith('/comment/'))
+
+
+class RateLimiter:
+    '''
+    Token buckets by key, refilled `rate` tokens per second up to `burst`.
+    Only the `max_size` most recently used buckets are kept, a dropped
+    bucket starts full again.
+    '''
+
+    def __init__(self, rate: float, burst: int, max_size: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        # key -> (tokens, last update)
+        self._buckets: OrderedDict[Hashable, tuple[float, float]]
+        self._buckets = OrderedDict()
+
+    def acquire(self, key: Hashable) -> float:
+        '''
+        Take a token, return 0 if there is one, otherwise seconds until
+        the next one.
+        '''
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class AdmissionQueue:
+    '''
+    At most `limit` requests are handled at the same time, others wait
+    by priority for up to `timeout` seconds. When `max_size` requests
+    are waiting, a new one replaces the newest waiter of a lower
+    priority, or is rejected.
+    '''
+
+    def __init__(self, limit: int, max_size: int, timeout: float) -> None:
+        self.limit = limit
+        self.max_size = max_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        # (priority, seq, future), futures of waiters which left are done
+        self._heap: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+
+    async def acquire(self, priority: Priority) -> bool:
+        '''
+        Wait for a slot, return `False` if rejected. `release` should be
+        called after a successful acquire.
+        '''
+        if self.active < self.limit and self.waiting == 0:
+            self.active += 1
+            return True
+        if self.waiting >= self.max_size and not self._evict(priority):
+            return False
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), future))
+        self.waiting += 1
+        try:
+            # the slot handed over by `release` must not be lost
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if future.done() and future.result():
+                self.release()
+            elif not future.done():
+                self._leave(future)
+            raise
+        if not future.done():
+            self._leave(future)
+            return False
+        return future.result()
+
+    def release(self):
+        while self._heap:
+            _, _, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            # hand the slot over, `active` stays the same
+            self.waiting -= 1
+            future.set_result(True)
+            return
+        self.active -= 1
+
+    def _leave(self, future: asyncio.Future):
+        future.cancel()
+        self.waiting -= 1
+
+    def _evict(self, priority: Priority) -> bool:
+        waiters = [w for w in self._heap if not w[2].done()]
+        if not waiters:
+            return False
+        worst = max(waiters, key=lambda w: (w[0], w[1]))
+        if worst[0] <= priority:
+            return False
+        worst[2].set_result(False)
+        self.waiting -= 1
+        return True
+
+
+class Admission:
+
+    def __init__(self, config: AdmissionConfig) -> None:
+        self.config = config
+        self.queue = AdmissionQueue(
+            config.max_concurrency,
+            config.max_queue,
+            config.queue_timeout,
+        )
+        self.user_limiter = RateLimiter(
+            config.user_rate,
+            config.user_burst,
+            config.max_buckets,
+        )
+        self.ip_limiter = RateLimiter(
+            config.ip_rate,
+            config.ip_burst,
+            config.max_buckets,
+        )
+
+
+def _username(scope: Scope) -> str | None:
+    '''
+    User of a bearer token, `None` if it's missing or invalid.
+    '''
+    header = dict(scope['headers']).get(b'authorization', b'').decode()
+    scheme, _, token = header.partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    auth_svc = AuthService(
+        get_vote_config().auth,
+        scope['app'].state.token_cache,
+    )
+    try:
+        sub = auth_svc.parse(token).get('sub')
+    except JWTError:
+        return None
+    return sub if isinstance(sub, str) else None
+
+
+class AdmissionMiddleware:
+    '''
+    Reject with 429 when a user / client IP writes too fast, and with
+    503 when too many requests are waiting.
+    '''
+
+    def __init__(self, app: ASGIApp, admission: Admission) -> None:
+        self.app = app
+        self.admission = admission
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        method, path = scope['method'], scope['path']
+        priority = classify(method, path)
+        if priority is None:
+            await self.app(scope, receive, send)
+            return
+        if is_rate_limited(method, path):
+            wait = self._rate_limit(scope)
+            if wait > 0:
+                ADMISSION_REJECTED.inc('rate_limited', priority.name)
+                response = JSONResponse(
+                    {'detail': 'Too many requests'},
+                    status_code=429,
+                    headers={'Retry-After': str(math.ceil(wait))},
+                )
+                await response(scope, receive, send)
+                return
+        queue = self.admission.queue
+        if queue.limit <= 0:
+            await self.app(scope, receive, send)
+            return
+        if not await queue.acquire(priority):
+            ADMISSION_REJECTED.inc('overloaded', priority.name)
+            response = JSONResponse(
+                {'detail': 'Server is busy'},
+                status_code=503,
+                headers={'Retry-After': '1'},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            queue.release()
+
+    def _rate_limit(self, scope: Scope) -> float:
+        '''
+        Take a token from buckets of the client IP and the user, return
+        seconds to wait if any of them is empty.
+        '''
+        wait = 0.0
+        client = scope.get('client')
+        by_ip = scope['path'].rstrip('/') not in IP_EXEMPT_ROUTES
+        if client is not None and by_ip:
+            wait = self.admission.ip_limiter.acquire(client[0])
+        username = _username(scope)
+        if username is not None:
+            wait = max(wait, self.admission.user_limiter.acquire(username))
+        return wait
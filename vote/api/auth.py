@@ -10,8 +10,18 @@ from jose import JWTError
 from typing import Annotated
 from pydantic import BaseModel
 
-from . import oauth2_schema, get_user_service, get_auth_service
-from vote.domain.user import UserService
+from . import (
+    oauth2_schema,
+    get_user_service,
+    get_auth_service,
+    get_user_cache,
+    get_db_lease,
+    get_password_hasher,
+    DatabaseLease,
+)
+from vote.cache import TTLCache
+from vote.db import user_repository
+from vote.domain.user import User, UserService, PasswordHasher
 from vote.domain.auth import AuthService
 
 router = APIRouter()
@@ -29,7 +39,16 @@ class TokenData(BaseModel):
 async def get_current_user(
     token: Annotated[str, Depends(oauth2_schema)],
     auth_svc: Annotated[AuthService, Depends(get_auth_service)],
-    user_svc: Annotated[UserService, Depends(get_user_service)],
+    # only connect on a cache miss
+    lease: Annotated[DatabaseLease, Depends(get_db_lease)],
+    hasher: Annotated[
+        PasswordHasher,
+        Depends(get_password_hasher),
+    ],
+    user_cache: Annotated[
+        TTLCache[tuple[str, int | None], User],
+        Depends(get_user_cache),
+    ],
 ):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -44,12 +63,34 @@ async def get_current_user(
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = await user_svc.get_by_username(token_data.username)
+    # rejected by claims without touching DB
+    if payload.get('disabled'):
+        raise credentials_exception
+    # tokens without claims can't be revoked, so don't check version
+    key = (token_data.username, payload.get('ver'))
+    user = user_cache.get(key)
     if user is None:
+        user_svc = UserService(user_repository(await lease.get()), hasher)
+        user = await user_svc.get_by_username(token_data.username)
+        if user is None:
+            raise credentials_exception
+        if key[1] is not None and key[1] != user.token_version:
+            raise credentials_exception
+        user_cache.set(key, user)
+    if user.disabled:
         raise credentials_exception
     return user
 
 
+async def get_admin_user(user: Annotated[User, Depends(get_current_user)]):
+    if 'admin' not in user.roles:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail='Permission denied',
+        )
+    return user
+
+
 @router.post('/token', response_model=Token)
 async def login_for_access_token(
     form_data: Annotated[
@@ -69,13 +110,29 @@ async def login_for_access_token(
             detail='Incorrect username or password',
             headers={'WWW-Authenticate': 'Bearer'},
         )
-    # TODO: config
-    access_token_expires = timedelta(minutes=300)
-    access_token = auth_svc.sign(
-        data={'sub': user.username},
+    access_token_expires = timedelta(
+        minutes=auth_svc.config.token_expire_minutes)
+    access_token = auth_svc.sign_user(
+        user,
         expires_after=access_token_expires,
     )
     return Token(
         access_token=access_token,
         token_type='bearer',
     )
+
+
+@router.post('/revoke', status_code=status.HTTP_204_NO_CONTENT)
+async def revoke_tokens(
+    user: Annotated[User, Depends(get_current_user)],
+    user_svc: Annotated[UserService, Depends(get_user_service)],
+    user_cache: Annotated[
+        TTLCache[tuple[str, int | None], User],
+        Depends(get_user_cache),
+    ],
+):
+    '''
+    Log out everywhere, all tokens issued to current user become invalid.
+    '''
+    await user_svc.revoke_tokens(user.username)
+    user_cache.invalidate((user.username, user.token_version))
@@ -0,0 +1,83 @@
+'''
+HTTP caching helpers, `ETag` / `If-None-Match` and `Cache-Control`.
+'''
+from datetime import datetime, timezone
+from fastapi import Request, Response, status
+import hashlib
+from vote.config import HttpCacheConfig
+from vote.domain.topic import Topic, TopicStage
+
+
+def content_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def version_etag(*parts: object) -> str:
+    '''
+    Weak ETag derived from what the response is built from, so it can be
+    checked before building the response.
+    '''
+    raw = '|'.join(str(p) for p in parts).encode()
+    return 'W/"' + hashlib.blake2b(raw, digest_size=16).hexdigest() + '"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get('if-none-match')
+    if header is None:
+        return False
+    if header.strip() == '*':
+        return True
+    # weak comparison, see RFC 9110 section 13.1.2
+    tag = etag.removeprefix('W/')
+    return any(t.strip().removeprefix('W/') == tag for t in header.split(','))
+
+
+def cache_control(max_age: float) -> str:
+    if max_age <= 0:
+        return 'no-cache'
+    return f'public, max-age={int(max_age)}'
+
+
+def topic_max_age(topic: Topic, config: HttpCacheConfig) -> float:
+    '''
+    Ended topics don't change anymore. The others can be cached until
+    their next stage change at most.
+    '''
+    if topic.stage == TopicStage.ENDED:
+        return config.ended_max_age
+    now = datetime.now(timezone.utc)
+    if topic.stage == TopicStage.NOT_STARTED:
+        change_at = topic.starts_at
+    else:
+        change_at = topic.ends_at
+    if change_at.tzinfo is None:
+        change_at = change_at.replace(tzinfo=timezone.utc)
+    left = (change_at - now).total_seconds()
+    return min(config.topic_max_age, left)
+
+
+def not_modified(etag: str, cache: str) -> Response:
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers={
+            'ETag': etag,
+            'Cache-Control': cache,
+        },
+    )
+
+
+def cached_json(request: Request, body: bytes, cache: str) -> Response:
+    '''
+    Response of an already serialized body, or 304 if the client has it.
+    '''
+    etag = content_etag(body)
+    if is_not_modified(request, etag):
+        return not_modified(etag, cache)
+    return Response(
+        content=body,
+        media_type='application/json',
+        headers={
+            'ETag': etag,
+            'Cache-Control': cache,
+        },
+    )
@@ -1,10 +1,11 @@
-from fastapi import APIRouter, Depends, status
-from . import get_comment_service
+from fastapi import APIRouter, Depends, Query, status
+from . import get_comment_service, get_cursor
 from .auth import get_current_user
 from datetime import datetime
 
 from vote.domain.comment import CommentService, UpdateCommentInput, CreateCommentInput, Comment
 from vote.domain.user import User
+from vote.domain.page import Cursor, Page
 
 from typing import Annotated
 from pydantic import BaseModel
@@ -19,8 +20,14 @@ async def get_comments(
         CommentService,
         Depends(get_comment_service),
     ],
-) -> list[Comment]:
-    return await svc.get(topic_id)
+    cursor: Annotated[Cursor | None, Depends(get_cursor)],
+    limit: Annotated[int, Query(ge=1, le=200)] = 50,
+) -> Page[Comment]:
+    '''
+    Get comments of a topic, older first. Pass `next_cursor` of the
+    response as `cursor` to get the next page.
+    '''
+    return await svc.get_page(topic_id, limit, cursor)
 
 
 class UpdateCommentRequest(BaseModel):
@@ -1,13 +1,32 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from typing import Annotated
+from vote.db import DatabasePool, PoolStats, MemoryStats
+from vote.cache import TTLCache, CacheStats
+from vote.domain.topic import Topic
+from vote.domain.user import PasswordHasher, PasswordHasherStats
+from vote.events import TallyBroker, TallyBrokerStats
+from . import (
+    get_db_pool,
+    get_topic_cache,
+    get_token_cache,
+    get_user_cache,
+    get_password_hasher,
+    get_tally_broker,
+)
 
 router = APIRouter()
 
 
 @router.get('/readiness')
-async def ready_probe():
+async def ready_probe(request: Request):
     '''
-    Ready probe.
+    Ready probe, fails while the app is shutting down.
     '''
+    if not getattr(request.app.state, 'ready', False):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Not ready',
+        )
 
 
 @router.get('/')
@@ -16,3 +35,56 @@ async def live_probe():
     '''
     Live probe.
     '''
+
+
+@router.get('/pool', response_model=PoolStats | MemoryStats)
+async def pool_stats(pool: Annotated[
+    DatabasePool,
+    Depends(get_db_pool),
+]):
+    '''
+    Usage of the DB connection pool, or record counts of the in-memory
+    backend.
+    '''
+    return pool.stats()
+
+
+@router.get('/cache', response_model=dict[str, CacheStats])
+async def cache_stats(
+    topic_cache: Annotated[
+        TTLCache[str, Topic],
+        Depends(get_topic_cache),
+    ],
+    token_cache: Annotated[TTLCache, Depends(get_token_cache)],
+    user_cache: Annotated[TTLCache, Depends(get_user_cache)],
+):
+    '''
+    Usage of in-process caches.
+    '''
+    return {
+        'topic': topic_cache.stats(),
+        'token': token_cache.stats(),
+        'user': user_cache.stats(),
+    }
+
+
+@router.get('/password-hasher', response_model=PasswordHasherStats)
+async def password_hasher_stats(hasher: Annotated[
+    PasswordHasher,
+    Depends(get_password_hasher),
+]):
+    '''
+    Usage of the bcrypt worker pool.
+    '''
+    return hasher.stats()
+
+
+@router.get('/stream', response_model=TallyBrokerStats)
+async def stream_stats(broker: Annotated[
+    TallyBroker,
+    Depends(get_tally_broker),
+]):
+    '''
+    Watched topics and subscribers of vote result streams.
+    '''
+    return broker.stats()
@@ -0,0 +1,205 @@
+from fastapi import APIRouter, FastAPI, Request
+from fastapi.responses import PlainTextResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import time
+from vote.db import PoolStats
+from vote.metrics import (
+    HTTP_REQUESTS,
+    HTTP_REQUEST_DURATION,
+    DB_QUERY_DURATION,
+    DB_QUERY_ERRORS,
+    EVENT_LOOP_LAG,
+    SINGLE_FLIGHT_CALLS,
+    SINGLE_FLIGHT_COALESCED,
+    VOTE_WRITER_BATCH_SIZE,
+    ADMISSION_REJECTED,
+    Counter,
+    Gauge,
+    Metric,
+    render_metrics,
+)
+
+router = APIRouter()
+
+
+class MetricsMiddleware:
+    '''
+    Count and time requests by route template (e.g. `/topic/{topic_id}`)
+    so metrics don't explode with one series per id.
+    '''
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # set by the router once a route matches
+            route = scope.get('route')
+            labels = (
+                scope['method'],
+                route.path if route is not None else '<unmatched>',
+                str(status),
+            )
+            HTTP_REQUESTS.inc(*labels)
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, *labels)
+
+
+def _state_metrics(app: FastAPI) -> list[Metric]:
+    '''
+    Gauges and counters read from app-lifetime objects.
+    '''
+    state = app.state
+    metrics: list[Metric] = []
+    stats = state.db_pool.stats()
+    if isinstance(stats, PoolStats):
+        metrics.append(
+            Gauge(
+                'vote_db_pool_connections',
+                'DB connections by state.',
+                ('state', ),
+                {
+                    ('in_use', ): stats.in_use,
+                    ('idle', ): stats.idle,
+                },
+            ))
+        metrics.append(
+            Gauge(
+                'vote_db_pool_size',
+                'Max number of DB connections.',
+                values={(): stats.size},
+            ))
+        metrics.append(
+            Gauge(
+                'vote_db_pool_waiting',
+                'Requests waiting for a DB connection.',
+                values={(): stats.waiting},
+            ))
+        timeouts = Counter(
+            'vote_db_pool_timeouts_total',
+            'Requests which gave up waiting for a DB connection.',
+        )
+        timeouts.inc(amount=stats.timeouts)
+        metrics.append(timeouts)
+    else:
+        metrics.append(
+            Gauge(
+                'vote_memory_records',
+                'Records of the in-memory backend by table.',
+                ('table', ),
+                {
+                    (t, ): n
+                    for t, n in stats.records.items()
+                },
+            ))
+    caches = {
+        'topic': state.topic_cache.stats(),
+        'token': state.token_cache.stats(),
+        'user': state.user_cache.stats(),
+    }
+    metrics.append(
+        Gauge(
+            'vote_cache_hit_ratio',
+            'Hit ratio of in-process caches since start.',
+            ('cache', ),
+            {
+                (name, ): s.hit_ratio
+                for name, s in caches.items()
+            },
+        ))
+    metrics.append(
+        Gauge(
+            'vote_cache_size',
+            'Entries of in-process caches.',
+            ('cache', ),
+            {
+                (name, ): s.size
+                for name, s in caches.items()
+            },
+        ))
+    metrics.append(
+        Gauge(
+            'vote_single_flight_in_flight',
+            'Single-flight reads running now.',
+            values={(): state.single_flight.in_flight()},
+        ))
+    if state.broadcast is not None:
+        for name, value, help in (
+            ('sent', state.broadcast.sent, 'sent to other workers'),
+            ('received', state.broadcast.received, 'from other workers'),
+            ('dropped', state.broadcast.dropped,
+             'not sent because a worker was busy'),
+        ):
+            counter = Counter(
+                f'vote_broadcast_{name}_total',
+                f'Cache invalidation / tally messages {help}.',
+            )
+            counter.inc(amount=value)
+            metrics.append(counter)
+    queue = state.admission.queue
+    metrics.append(
+        Gauge(
+            'vote_admission_requests',
+            'Requests being handled / waiting for a slot.',
+            ('state', ),
+            {
+                ('active', ): queue.active,
+                ('waiting', ): queue.waiting,
+            },
+        ))
+    if state.vote_writer is not None:
+        metrics.append(
+            Gauge(
+                'vote_writer_pending',
+                'Votes waiting for the next group commit.',
+                values={(): state.vote_writer.pending()},
+            ))
+    metrics.append(
+        Gauge(
+            'vote_event_loop_lag_last_seconds',
+            'Event loop lag of the latest sample.',
+            values={(): state.loop_monitor.lag},
+        ))
+    return metrics
+
+
+def collect_metrics(app: FastAPI) -> list[Metric]:
+    return [
+        HTTP_REQUESTS,
+        HTTP_REQUEST_DURATION,
+        DB_QUERY_DURATION,
+        DB_QUERY_ERRORS,
+        EVENT_LOOP_LAG,
+        SINGLE_FLIGHT_CALLS,
+        SINGLE_FLIGHT_COALESCED,
+        VOTE_WRITER_BATCH_SIZE,
+        ADMISSION_REJECTED,
+        *_state_metrics(app),
+    ]
+
+
+@router.get('', response_class=PlainTextResponse)
+async def get_metrics(request: Request):
+    '''
+    Prometheus metrics in text format. With several workers, metrics of
+    all of them are returned, each series has a `worker` label.
+    '''
+    shared = request.app.state.shared_metrics
+    others = shared.others() if shared is not None else ()
+    return PlainTextResponse(
+        render_metrics(collect_metrics(request.app), others),
+        media_type='text/plain; version=0.0.4',
+    )
@@ -0,0 +1,38 @@
+'''
+JSON serialization of responses with orjson, it's several times faster
+than the stdlib on long lists.
+'''
+from datetime import date
+from enum import Enum
+from typing import Any
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+import orjson
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, BaseModel):
+        # shallow, nested models come back here
+        return dict(obj)
+    if isinstance(obj, date):
+        return obj.isoformat()
+    if isinstance(obj, Enum):
+        return obj.value
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def dumps(content: Any) -> bytes:
+    '''
+    Compact JSON of trusted content, e.g. DB rows or models which are
+    already validated. Nothing is validated or copied on the way.
+    '''
+    return orjson.dumps(content, default=_default)
+
+
+class FastJSONResponse(JSONResponse):
+    '''
+    Default response class of the app, see `dumps`.
+    '''
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
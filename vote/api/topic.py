@@ -1,7 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Annotated
+from typing import Annotated, Any
 from datetime import datetime
+import asyncio
+import json
 from vote.domain.topic import (
     TopicService,
     UpdateTopicInput,
@@ -9,32 +20,70 @@ from vote.domain.topic import (
     Option,
     TopicStage,
     CreateTopicInput,
+    InvalidFieldError,
 )
-from vote.domain.vote import VoteService, Vote
+from vote.domain.page import Cursor
+from vote.domain.vote import VoteService, Vote, VoteResult
 from vote.domain.user import User
-from vote.api.auth import get_current_user
-from . import get_topic_service, get_vote_service
+from vote.api.auth import get_current_user, get_admin_user
+from vote.scheduler import StageScheduler
+from vote.events import TallyBroker
+from vote.config import VoteConfigToml
+from . import (
+    get_topic_service,
+    get_vote_service,
+    get_vote_config,
+    get_cursor,
+    get_stage_scheduler,
+    get_tally_broker,
+    acquire_topic_repository,
+    acquire_vote_service,
+)
+from .caching import (
+    cache_control,
+    cached_json,
+    is_not_modified,
+    not_modified,
+    topic_max_age,
+    version_etag,
+)
+from .serialization import dumps
 
 router = APIRouter()
 
 
 class TopicResponse(BaseModel):
-
-    class Config:
-        orm_mode = True
-
+    '''
+    Fields not selected by `fields` are omitted.
+    '''
     id: str
-    description: str
-    starts_at: datetime
-    ends_at: datetime
-    created_at: datetime
-    updated_at: datetime
-    options: list[Option]
-    stage: TopicStage
+    description: str | None
+    starts_at: datetime | None
+    ends_at: datetime | None
+    created_at: datetime | None
+    updated_at: datetime | None
+    options: list[Option] | None
+    stage: TopicStage | None
 
     @classmethod
-    def from_topic(cls, topic: Topic):
-        return cls.from_orm(topic)
+    def from_row(cls, row: dict[str, Any]) -> dict[str, Any]:
+        '''
+        Fields of a DB row which are in the response. Rows come from our
+        own DB, so they are served without validating again.
+        '''
+        return {k: row[k] for k in cls.__fields__ if k in row}
+
+
+class TopicListResponse(BaseModel):
+    items: list[TopicResponse]
+    next_cursor: str | None
+
+
+class RecomputeResultResponse(BaseModel):
+    result: VoteResult
+    # stored result before recomputing
+    previous: VoteResult | None
+    changed: bool
 
 
 class TopicDetailResponse(BaseModel):
@@ -53,7 +102,8 @@ class TopicDetailResponse(BaseModel):
 
     @classmethod
     def from_topic(cls, topic: Topic):
-        return cls.from_orm(topic)
+        # `topic` is already validated
+        return cls.construct(**{f: getattr(topic, f) for f in cls.__fields__})
 
 
 class CreateTopicResponse(BaseModel):
@@ -66,25 +116,66 @@ topic_not_found_exception = HTTPException(
 )
 
 
-@router.get('/', response_model=list[TopicResponse])
-async def get_all_topic(svc: Annotated[
-    TopicService,
-    Depends(get_topic_service),
-]):
+@router.get(
+    '/',
+    response_model=TopicListResponse,
+    response_model_exclude_unset=True,
+)
+async def get_all_topic(
+    request: Request,
+    svc: Annotated[
+        TopicService,
+        Depends(get_topic_service),
+    ],
+    cfg: Annotated[
+        VoteConfigToml,
+        Depends(get_vote_config),
+    ],
+    cursor: Annotated[Cursor | None, Depends(get_cursor)],
+    limit: Annotated[int, Query(ge=1, le=200)] = 50,
+    fields: Annotated[
+        str | None,
+        Query(description='Comma separated fields to return, '
+              'e.g. `stage,starts_at,ends_at`'),
+    ] = None,
+):
     '''
-    Get all topics.
+    Get topics, newer first. Pass `next_cursor` of the response as
+    `cursor` to get the next page.
     '''
-    topics = await svc.get_all()
-    return [TopicResponse.from_topic(t) for t in topics]
+    columns = None
+    if fields is not None:
+        columns = [f.strip() for f in fields.split(',') if f.strip()]
+    try:
+        page = await svc.get_page(limit, cursor, columns)
+    except InvalidFieldError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'Unknown fields: {", ".join(e.fields)}',
+        )
+    body = dumps({
+        'items': [TopicResponse.from_row(t) for t in page.items],
+        'next_cursor': page.next_cursor,
+    })
+    return cached_json(
+        request,
+        body,
+        cache_control(cfg.http_cache.list_max_age),
+    )
 
 
 @router.get('/{topic_id}', response_model=TopicDetailResponse)
 async def get_one_topic(
     topic_id: str,
+    request: Request,
     svc: Annotated[
         TopicService,
         Depends(get_topic_service),
     ],
+    cfg: Annotated[
+        VoteConfigToml,
+        Depends(get_vote_config),
+    ],
 ):
     '''
     Get single topic by id.
@@ -92,7 +183,11 @@ async def get_one_topic(
     topic = await svc.get_by_id(topic_id)
     if topic is None:
         raise topic_not_found_exception
-    return TopicDetailResponse.from_topic(topic)
+    return cached_json(
+        request,
+        dumps(TopicDetailResponse.from_topic(topic)),
+        cache_control(topic_max_age(topic, cfg.http_cache)),
+    )
 
 
 @router.post('/', response_model=CreateTopicResponse)
@@ -102,11 +197,16 @@ async def create_topic(
         TopicService,
         Depends(get_topic_service),
     ],
+    scheduler: Annotated[
+        StageScheduler,
+        Depends(get_stage_scheduler),
+    ],
 ):
     '''
     Create new topic.
     '''
     id = await svc.new(input)
+    scheduler.schedule(id, input.starts_at, input.ends_at)
     return CreateTopicResponse(id=id)
 
 
@@ -118,6 +218,10 @@ async def update_topic(
         Depends(get_topic_service),
     ],
     input: UpdateTopicInput,
+    scheduler: Annotated[
+        StageScheduler,
+        Depends(get_stage_scheduler),
+    ],
 ):
     '''
     Update single topic. Only allowed before vote started.
@@ -127,19 +231,61 @@ async def update_topic(
         raise topic_not_found_exception
     topic.update(input)
     await svc.save(topic)
+    scheduler.schedule(topic.id, topic.starts_at, topic.ends_at)
 
 
-@router.get('/{topic_id}/vote-result')
+@router.get('/{topic_id}/vote-result', response_model=VoteResult)
 async def get_vote_result(
+    topic_id: str,
+    request: Request,
+    response: Response,
+    topic_svc: Annotated[
+        TopicService,
+        Depends(get_topic_service),
+    ],
+    vote_svc: Annotated[VoteService, Depends(get_vote_service)],
+):
+    '''
+    Get the final result of an ended topic, stored when it ended.
+    '''
+    topic = await topic_svc.get_by_id(topic_id)
+    if topic is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Topic not found',
+        )
+    if topic.stage != TopicStage.ENDED:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Not ended',
+        )
+    result = await vote_svc.get_result(topic)
+    etag = version_etag('vote-result', result.checksum, result.computed_at)
+    # a recompute can replace it, so clients always revalidate
+    cache = cache_control(0)
+    if is_not_modified(request, etag):
+        return not_modified(etag, cache)
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = cache
+    return result
+
+
+@router.post(
+    '/{topic_id}/vote-result/recompute',
+    response_model=RecomputeResultResponse,
+)
+async def recompute_vote_result(
     topic_id: str,
     topic_svc: Annotated[
         TopicService,
         Depends(get_topic_service),
     ],
     vote_svc: Annotated[VoteService, Depends(get_vote_service)],
+    _: Annotated[User, Depends(get_admin_user)],
 ):
     '''
-    Get vote result of a topic.
+    Recount votes of an ended topic and replace its stored result, for
+    audits. `changed` tells whether the counts differ from the stored ones.
     '''
     topic = await topic_svc.get_by_id(topic_id)
     if topic is None:
@@ -152,11 +298,84 @@ async def get_vote_result(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail='Not ended',
         )
-    votes = [v for v in await vote_svc.get_all() if v.topic_id == topic_id]
-    stats = {o.id: 0 for o in topic.options}
-    for v in votes:
-        stats[v.option_id] += 1
-    return stats
+    result, previous = await vote_svc.recompute_result(topic)
+    return RecomputeResultResponse(
+        result=result,
+        previous=previous,
+        changed=previous is None or previous.checksum != result.checksum,
+    )
+
+
+def sse(event: str, data: Any) -> str:
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+@router.get('/{topic_id}/vote-result/stream')
+async def stream_vote_result(
+    topic_id: str,
+    request: Request,
+    broker: Annotated[TallyBroker, Depends(get_tally_broker)],
+    cfg: Annotated[VoteConfigToml, Depends(get_vote_config)],
+):
+    '''
+    Stream vote result as server-sent events. A `snapshot` event carries
+    the whole result, it's sent first and then periodically. `delta`
+    events carry votes added since the previous event.
+    '''
+    # don't hold a DB connection for the whole stream
+    async with acquire_topic_repository(request.app) as repo:
+        topic = await repo.get_by_id(topic_id)
+    if topic is None:
+        raise topic_not_found_exception
+    option_ids = [o.id for o in topic.options]
+
+    async def read_result():
+        # subscribers (re)connect together, e.g. after a deploy
+        async with acquire_vote_service(request.app) as svc:
+            tally = await svc.get_tally(topic_id)
+        return {o: tally.get(o, 0) for o in option_ids}
+
+    async def events():
+        loop = asyncio.get_running_loop()
+        with broker.subscribe(topic_id) as channel:
+            while True:
+                result = await read_result()
+                # votes published during the read are in the snapshot,
+                # don't send them again as delta
+                seen = dict(channel.counts)
+                version = channel.version
+                yield sse('snapshot', result)
+                resync_at = loop.time() + cfg.stream.resync_interval
+                while loop.time() < resync_at:
+                    timeout = min(
+                        cfg.stream.heartbeat,
+                        resync_at - loop.time(),
+                    )
+                    try:
+                        await asyncio.wait_for(channel.wait(version), timeout)
+                    except asyncio.TimeoutError:
+                        if loop.time() < resync_at:
+                            yield ': ping\n\n'
+                        continue
+                    version = channel.version
+                    delta = {
+                        o: d
+                        for o, d in channel.diff(seen).items()
+                        if o in option_ids
+                    }
+                    if delta:
+                        yield sse('delta', delta)
+                    # merge votes arriving in the meantime
+                    await asyncio.sleep(cfg.stream.min_interval)
+
+    return StreamingResponse(
+        events(),
+        media_type='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        },
+    )
 
 
 @router.post('/refresh', status_code=status.HTTP_204_NO_CONTENT)
@@ -164,13 +383,11 @@ async def refresh_all_topics(svc: Annotated[
     TopicService,
     Depends(get_topic_service),
 ], ):
-    topics = await svc.get_all()
-    # FIXME: don't use SurrealQL directly
-    await svc.repo.db.query('BEGIN TRANSACTION')
-    for t in topics:
-        t.refresh()
-        await svc.save(t)
-    await svc.repo.db.query('COMMIT TRANSACTION')
+    '''
+    Refresh stage of all topics. Stages are already updated on time by
+    the app, this is only for manual fixes.
+    '''
+    await svc.refresh_stages()
 
 
 @router.get('/{topic_id}/my-vote', response_model=Vote)
@@ -192,13 +409,10 @@ async def get_my_vote(
             status_code=status.HTTP_404_NOT_FOUND,
             detail='Topic not found',
         )
-    votes = await vote_svc.get_all()
-    try:
-        vote = next(v for v in votes
-                    if v.username == user.username and v.topic_id == topic_id)
-        return vote
-    except StopIteration:
+    vote = await vote_svc.get_by_user_and_topic(user.username, topic_id)
+    if vote is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail='Vote not found',
         )
+    return vote
@@ -0,0 +1,66 @@
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import logging
+import re
+import time
+import uuid
+from vote.log import request_id
+
+logger = logging.getLogger(__name__)
+
+# ids from clients / proxies are only trusted if they look like this
+_VALID_ID = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+
+class TracingMiddleware:
+    '''
+    Tag everything logged while handling a request with its id. The id is
+    taken from `X-Request-ID` if the client sent a sane one, and echoed in
+    the response.
+    '''
+
+    def __init__(self, app: ASGIApp, access_log: bool = True) -> None:
+        self.app = app
+        self.access_log = access_log
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope['headers'])
+        rid = headers.get(b'x-request-id', b'').decode('latin-1')
+        if not _VALID_ID.fullmatch(rid):
+            rid = uuid.uuid4().hex
+        token = request_id.set(rid)
+        status = 500
+
+        async def send_with_id(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                message['headers'] = [
+                    *message.get('headers', []),
+                    (b'x-request-id', rid.encode()),
+                ]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            if self.access_log:
+                route = scope.get('route')
+                path = route.path if route is not None else None
+                duration = time.perf_counter() - start
+                logger.info(
+                    'request',
+                    extra={
+                        'fields': {
+                            'method': scope['method'],
+                            'path': scope['path'],
+                            'route': path,
+                            'status': status,
+                            'duration_ms': round(duration * 1000, 3),
+                        },
+                    },
+                )
+            request_id.reset(token)
@@ -1,14 +1,48 @@
-from fastapi import APIRouter, Query, Depends
-from typing import Annotated
-from pydantic import BaseModel
+from fastapi import (
+    APIRouter,
+    Query,
+    Depends,
+    HTTPException,
+    Request,
+    status,
+)
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+from typing import Annotated, AsyncIterator
+from pydantic import BaseModel, ValidationError
 from vote.domain.user import User
-from vote.domain.vote import VoteService, CreateVoteInput, Vote
+from vote.domain.vote import (
+    VoteService,
+    CreateVoteInput,
+    BatchVoteInput,
+    BatchVoteResult,
+    BatchVoteStatus,
+    Vote,
+    DuplicatedVoteError,
+    TopicNotFoundError,
+    VoteNotAllowedError,
+    InvalidOptionError,
+)
 from . import get_vote_service
-from .auth import get_current_user
+from .auth import get_current_user, get_admin_user
 
 router = APIRouter()
 
 
+class DuplexStreamingResponse(StreamingResponse):
+    '''
+    Streaming response whose body is produced while the request body is
+    still being read. `StreamingResponse` listens for disconnect in the
+    meantime, which would take the request body messages; a disconnect
+    ends the request body with `ClientDisconnect` instead.
+    '''
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
 class VoteResponse(BaseModel):
     username: str
     topic_id: str
@@ -37,10 +71,7 @@ async def list_vote(
     if user is None:
         user = current_user.username
     # TODO: check permission
-    votes = [
-        VoteResponse.from_vote(v) for v in await svc.get_all()
-        if v.username == user
-    ]
+    votes = [VoteResponse.from_vote(v) for v in await svc.list_by_user(user)]
     return votes
 
 
@@ -56,4 +87,102 @@ async def create_vote(
     '''
     Create a vote. There should be at most one vote for a topic per user.
     '''
-    await svc.add(user.username, input)
+    try:
+        await svc.add(user.username, input)
+    except TopicNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Topic not found',
+        )
+    except VoteNotAllowedError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Topic is not in progress',
+        )
+    except InvalidOptionError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Invalid option',
+        )
+    except DuplicatedVoteError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail='Already voted',
+        )
+
+
+@router.post('/batch', response_model=list[BatchVoteResult])
+async def create_votes(
+    inputs: list[BatchVoteInput],
+    svc: Annotated[
+        VoteService,
+        Depends(get_vote_service),
+    ],
+    _: Annotated[User, Depends(get_admin_user)],
+):
+    '''
+    Import votes cast elsewhere (paper ballots, kiosks). Each vote gets its
+    own result, one bad vote doesn't fail the others.
+    '''
+    return await svc.add_many(inputs)
+
+
+@router.post('/batch/ndjson')
+async def create_votes_ndjson(
+    request: Request,
+    svc: Annotated[
+        VoteService,
+        Depends(get_vote_service),
+    ],
+    _: Annotated[User, Depends(get_admin_user)],
+):
+    '''
+    Same as `POST /vote/batch`, but read one vote per line so large imports
+    don't need to be parsed as a whole. Results are also one per line, in
+    order, and sent as soon as each batch is written.
+    '''
+    results: list[BatchVoteResult] = []
+    pending: list[tuple[int, BatchVoteInput]] = []
+
+    async def flush() -> str:
+        if pending:
+            for r in await svc.add_many([v for _, v in pending]):
+                r.index = pending[r.index][0]
+                results.append(r)
+            pending.clear()
+        # invalid lines are only after the previous batch
+        results.sort(key=lambda r: r.index)
+        lines = ''.join(r.json() + '\n' for r in results)
+        results.clear()
+        return lines
+
+    def parse(index: int, line: bytes):
+        try:
+            pending.append((index, BatchVoteInput.parse_raw(line)))
+        except ValidationError:
+            results.append(
+                BatchVoteResult(
+                    index=index,
+                    status=BatchVoteStatus.INVALID_INPUT,
+                ))
+
+    async def import_votes() -> AsyncIterator[str]:
+        index = 0
+        buf = b''
+        async for chunk in request.stream():
+            *lines, buf = (buf + chunk).split(b'\n')
+            for line in lines:
+                if line.strip():
+                    parse(index, line)
+                    index += 1
+            if len(pending) >= svc.config.batch_size:
+                yield await flush()
+        if buf.strip():
+            parse(index, buf)
+        if pending or results:
+            yield await flush()
+
+    return DuplexStreamingResponse(
+        import_votes(),
+        media_type='application/x-ndjson',
+    )
@@ -0,0 +1,158 @@
+'''
+Messages between the worker processes of one server, e.g. to invalidate
+their in-process caches together. Each worker binds a Unix datagram
+socket in a shared directory and sends messages to all the others.
+Messages can be lost when a worker is too busy to read them, which only
+means a cache entry lives until its TTL.
+'''
+from typing import Any, Callable
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from vote.cache import TTLCache
+from vote.events import TallyBroker
+
+logger = logging.getLogger(__name__)
+
+# seconds before the directory is listed again to find new workers
+PEERS_TTL = 1.0
+MAX_MESSAGE_SIZE = 65536
+
+
+class Broadcast:
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.path = os.path.join(directory, f'{os.getpid()}.sock')
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self._handlers: dict[str, Callable[[dict[str, Any]], None]] = {}
+        self._sock: socket.socket | None = None
+        self._peers: list[str] = []
+        self._peers_at = 0.0
+
+    def subscribe(self, kind: str, handler: Callable[[dict[str, Any]], None]):
+        self._handlers[kind] = handler
+
+    async def open(self):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        # anyone who can write here can inject messages
+        if os.stat(self.directory).st_uid != os.getuid():
+            raise PermissionError(f'{self.directory} is owned by another user')
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+        sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(sock.fileno(), self._receive)
+        self._sock = sock
+
+    async def close(self):
+        if self._sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def publish(self, kind: str, **data: Any):
+        '''
+        Send a message to all other workers, without waiting.
+        '''
+        if self._sock is None:
+            return
+        message = json.dumps({'kind': kind, **data}).encode()
+        for peer in list(self._get_peers()):
+            try:
+                self._sock.sendto(message, peer)
+                self.sent += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # the worker has exited
+                self._forget(peer)
+            except BlockingIOError:
+                self.dropped += 1
+
+    def _get_peers(self) -> list[str]:
+        now = time.monotonic()
+        if now - self._peers_at > PEERS_TTL:
+            paths = (os.path.join(self.directory, name)
+                     for name in os.listdir(self.directory)
+                     if name.endswith('.sock'))
+            self._peers = [path for path in paths if path != self.path]
+            self._peers_at = now
+        return self._peers
+
+    def _forget(self, peer: str):
+        try:
+            os.unlink(peer)
+        except FileNotFoundError:
+            pass
+        if peer in self._peers:
+            self._peers.remove(peer)
+
+    def _receive(self):
+        while self._sock is not None:
+            try:
+                data = self._sock.recv(MAX_MESSAGE_SIZE)
+            except BlockingIOError:
+                return
+            self.received += 1
+            try:
+                message = json.loads(data)
+                handler = self._handlers.get(message.pop('kind'))
+                if handler is not None:
+                    handler(message)
+            except Exception:
+                logger.exception('failed to handle broadcast message')
+
+
+def share_cache(broadcast: Broadcast, name: str, cache: TTLCache):
+    '''
+    Invalidate the cache called `name` of other workers together with
+    this one.
+    '''
+    kind = f'cache.{name}'
+
+    def apply(message: dict[str, Any]):
+        key = message['key']
+        if key is None:
+            cache.clear(notify=False)
+        else:
+            # tuple keys are sent as JSON arrays
+            if isinstance(key, list):
+                key = tuple(key)
+            cache.invalidate(key, notify=False)
+
+    cache.on_invalidate = lambda key: broadcast.publish(kind, key=key)
+    broadcast.subscribe(kind, apply)
+
+
+def share_tallies(broadcast: Broadcast, broker: TallyBroker):
+    '''
+    Push votes cast on other workers to streams of this one.
+    '''
+
+    def apply(message: dict[str, Any]):
+        broker.publish(
+            message['topic_id'],
+            message['option_id'],
+            message['delta'],
+            notify=False,
+        )
+
+    broker.on_publish = lambda topic_id, option_id, delta: broadcast.publish(
+        'tally',
+        topic_id=topic_id,
+        option_id=option_id,
+        delta=delta,
+    )
+    broadcast.subscribe('tally', apply)
@@ -0,0 +1,85 @@
+from typing import Callable, Generic, Hashable, TypeVar
+from collections import OrderedDict
+from pydantic import BaseModel
+import time
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class CacheConfig(BaseModel):
+    # max number of topics kept in memory
+    topic_size: int = 1024
+    # seconds before a cached topic is read from DB again
+    topic_ttl: float = 5.0
+
+
+class CacheStats(BaseModel):
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    evictions: int
+    hit_ratio: float
+
+
+class TTLCache(Generic[K, V]):
+    '''
+    In-process LRU cache whose entries expire after `ttl` seconds.
+    '''
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        # called with the invalidated key, or `None` when cleared
+        self.on_invalidate: Callable[[K | None], None] | None = None
+
+    def get(self, key: K) -> V | None:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self._misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return entry[1]
+
+    def set(self, key: K, value: V, ttl: float | None = None):
+        '''
+        Cache `value`, `ttl` can only shorten the default one.
+        '''
+        if self.max_size <= 0:
+            return
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def invalidate(self, key: K, notify: bool = True):
+        self._entries.pop(key, None)
+        if notify and self.on_invalidate is not None:
+            self.on_invalidate(key)
+
+    def clear(self, notify: bool = True):
+        self._entries.clear()
+        if notify and self.on_invalidate is not None:
+            self.on_invalidate(None)
+
+    def stats(self) -> CacheStats:
+        lookups = self._hits + self._misses
+        return CacheStats(
+            size=len(self._entries),
+            max_size=self.max_size,
+            hits=self._hits,
+            misses=self._misses,
+            evictions=self._evictions,
+            hit_ratio=self._hits / lookups if lookups else 0.0,
+        )
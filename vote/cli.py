@@ -0,0 +1,96 @@
+'''
+Maintenance commands, run with `python -m vote.cli <command>`.
+'''
+import argparse
+import asyncio
+import os
+import sys
+from contextlib import asynccontextmanager
+import uvicorn
+from vote.config import get_vote_config
+from vote.db import create_pool, migrate, topic_repository, vote_repository
+from vote.domain.vote import VoteService
+from vote.log import setup_logging
+
+
+@asynccontextmanager
+async def open_db():
+    cfg = get_vote_config()
+    pool = create_pool(cfg.db.copy(update={'pool_size': 1}))
+    await pool.open()
+    try:
+        async with pool.acquire() as db:
+            yield db
+    finally:
+        await pool.close()
+
+
+async def recount(args: argparse.Namespace):
+    async with open_db() as db:
+        svc = VoteService(vote_repository(db), topic_repository(db))
+        await svc.recount(args.topic)
+
+
+async def migrate_db():
+    async with open_db() as db:
+        await migrate(db)
+
+
+def serve(args: argparse.Namespace):
+    '''
+    Run the app with the `[server]` config. Migrations run once here,
+    instead of racing in every worker.
+    '''
+    cfg = get_vote_config()
+    workers = cfg.server.workers or os.cpu_count() or 1
+    if workers > 1 and cfg.db.backend == 'memory':
+        sys.exit('the memory backend can\'t be shared by several workers')
+    setup_logging(cfg.log)
+    if cfg.db.backend == 'surreal':
+        asyncio.run(migrate_db())
+    uvicorn.run(
+        # workers don't migrate again
+        'vote.main:create_worker_app',
+        factory=True,
+        host=args.host or cfg.server.host,
+        port=args.port or cfg.server.port,
+        workers=workers,
+        loop=cfg.server.loop,
+        http=cfg.server.http,
+        proxy_headers=cfg.server.proxy_headers,
+        forwarded_allow_ips=cfg.server.forwarded_allow_ips,
+        # logged by `TracingMiddleware` already
+        access_log=False,
+        # let uvicorn logs go through our handler
+        log_config=None,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m vote.cli')
+    commands = parser.add_subparsers(required=True)
+
+    cmd = commands.add_parser(
+        'recount',
+        help='rebuild vote tallies from the vote table',
+    )
+    cmd.add_argument('--topic', help='only recount this topic id')
+    cmd.set_defaults(func=recount)
+
+    cmd = commands.add_parser(
+        'serve',
+        help='run the app with workers set in [server] of vote.toml',
+    )
+    cmd.add_argument('--host', help='override [server] host')
+    cmd.add_argument('--port', type=int, help='override [server] port')
+    cmd.set_defaults(func=serve)
+
+    args = parser.parse_args()
+    if asyncio.iscoroutinefunction(args.func):
+        asyncio.run(args.func(args))
+    else:
+        args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import os
+from typing import Literal
+from pydantic import BaseSettings, BaseModel
+import toml
+from vote.domain.auth import AuthConfig
+from vote.domain.user import PasswordConfig
+from vote.db import SurrealConfig
+from vote.cache import CacheConfig
+from vote.events import StreamConfig
+from vote.domain.vote import VoteConfig
+from vote.metrics import MetricsConfig
+from vote.log import LogConfig
+
+logger = logging.getLogger(__name__)
+
+
+class ReloadConfig(BaseModel):
+    # reload config when receiving SIGHUP
+    sighup: bool = True
+    # poll the config file and reload it after modification
+    watch: bool = False
+    # seconds between two polls
+    interval: float = 2.0
+
+
+class HttpCacheConfig(BaseModel):
+    # seconds browsers / CDNs may reuse a topic list
+    list_max_age: float = 5.0
+    # max seconds to reuse a topic which is not ended, also capped by its
+    # next stage change
+    topic_max_age: float = 60.0
+    # seconds to reuse an ended topic, vote results are always revalidated
+    # since they can be recomputed
+    ended_max_age: float = 86400.0
+
+
+class ServerConfig(BaseModel):
+    '''
+    Used by `python -m vote.cli serve`.
+    '''
+    host: str = '127.0.0.1'
+    port: int = 8000
+    # worker processes, 0 for one per CPU core
+    workers: int = 1
+    # "auto" uses uvloop / httptools if they are installed
+    loop: Literal['auto', 'asyncio', 'uvloop'] = 'auto'
+    http: Literal['auto', 'h11', 'httptools'] = 'auto'
+    # trust X-Forwarded-For / X-Forwarded-Proto from these proxy IPs
+    # (comma separated, "*" for any), so per-IP limits see real clients
+    proxy_headers: bool = True
+    forwarded_allow_ips: str = '127.0.0.1'
+    # newest topics loaded into the topic cache before a worker is ready
+    warmup_topics: int = 200
+    # Unix sockets of workers are put here to invalidate caches of each
+    # other, only used with more than one worker
+    broadcast_dir: str = '/tmp/vote-broadcast'
+
+
+class AdmissionConfig(BaseModel):
+    # requests handled at the same time, 0 for no limit
+    max_concurrency: int = 64
+    # requests waiting for a slot, more are rejected with 503
+    max_queue: int = 256
+    # seconds a request waits for a slot before 503
+    queue_timeout: float = 5.0
+    # token buckets of write routes (vote, comment, signup, login): tokens
+    # refilled per second and bucket size, 0 rate for no limit; votes are
+    # only limited per user
+    user_rate: float = 2.0
+    user_burst: int = 10
+    ip_rate: float = 20.0
+    ip_burst: int = 50
+    # max number of users / IPs whose buckets are kept
+    max_buckets: int = 100000
+
+
+def toml_settings(settings: BaseSettings) -> dict:
+    with open(settings.__config__.path) as f:
+        return toml.load(f)
+
+
+# https://docs.pydantic.dev/latest/usage/settings/#customise-settings-sources
+class VoteConfigToml(BaseSettings):
+    '''
+    Config for vote app loading from a toml file
+    '''
+    auth: AuthConfig
+    db: SurrealConfig
+    reload: ReloadConfig = ReloadConfig()
+    cache: CacheConfig = CacheConfig()
+    password: PasswordConfig = PasswordConfig()
+    stream: StreamConfig = StreamConfig()
+    vote: VoteConfig = VoteConfig()
+    metrics: MetricsConfig = MetricsConfig()
+    log: LogConfig = LogConfig()
+    http_cache: HttpCacheConfig = HttpCacheConfig()
+    admission: AdmissionConfig = AdmissionConfig()
+    server: ServerConfig = ServerConfig()
+
+    class Config:
+        path = 'vote.toml'
+        frozen = True
+
+        @classmethod
+        def customise_sources(
+            cls,
+            init_settings,
+            env_settings,
+            file_secret_settings,
+        ):
+            return (
+                init_settings,
+                toml_settings,
+                env_settings,
+                file_secret_settings,
+            )
+
+
+_config: VoteConfigToml | None = None
+
+
+def get_vote_config() -> VoteConfigToml:
+    '''
+    Get the process-wide config, the file is only parsed on first use.
+    '''
+    global _config
+    if _config is None:
+        _config = VoteConfigToml()
+    return _config
+
+
+def set_vote_config(config: VoteConfigToml):
+    '''
+    Replace the process-wide config, for tools which tweak the loaded one.
+    '''
+    global _config
+    _config = config
+
+
+def reload_vote_config() -> VoteConfigToml:
+    '''
+    Parse the config file again and swap it in. The current config is kept
+    if the new one is invalid.
+    '''
+    global _config
+    try:
+        config = VoteConfigToml()
+    except Exception:
+        logger.exception('failed to reload config, keep the current one')
+        return get_vote_config()
+    _config = config
+    logger.info('config reloaded')
+    return config
+
+
+def _mtime(path: str) -> float | None:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+async def watch_vote_config(interval: float):
+    '''
+    Reload the config whenever the file's mtime changes.
+    '''
+    path = VoteConfigToml.__config__.path
+    last = _mtime(path)
+    while True:
+        await asyncio.sleep(interval)
+        mtime = _mtime(path)
+        if mtime is not None and mtime != last:
+            last = mtime
+            reload_vote_config()
@@ -0,0 +1,12 @@
+from .pool import SurrealConfig, SurrealPool, PoolStats, PoolTimeoutError
+from .migration import Migration, MigrationError, MIGRATIONS, migrate
+from .memory import MemoryConfig, MemoryDatabase, MemoryStats
+from .repository import (
+    Database,
+    DatabasePool,
+    create_pool,
+    user_repository,
+    topic_repository,
+    vote_repository,
+    comment_repository,
+)
@@ -0,0 +1,431 @@
+from bisect import bisect_left, bisect_right, insort
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Iterator, Literal
+from pydantic import BaseModel
+import json
+import logging
+import os
+import secrets
+
+logger = logging.getLogger(__name__)
+
+Record = dict[str, Any]
+# ('put', table, record) or ('delete', table, id)
+Op = tuple[Literal['put', 'delete'], str, Any]
+
+
+class MemoryConfig(BaseModel):
+    # directory of the snapshot and the append log, data only lives in
+    # memory if it's not set
+    path: str | None = None
+    # write a new snapshot (and truncate the log) after this many logged
+    # transactions
+    snapshot_every: int = 10000
+    # fsync the log after each transaction, slower but survives power loss
+    fsync: bool = False
+
+
+class MemoryStats(BaseModel):
+    records: dict[str, int]
+    # transactions in the log since the last snapshot
+    logged: int
+    snapshots: int
+
+
+class UniqueIndexError(Exception):
+    '''
+    Same wording as SurrealDB so callers can tell which index is violated.
+    '''
+
+    def __init__(self, table: str, index: str, key: tuple) -> None:
+        self.table = table
+        self.index = index
+        self.key = key
+
+    def __str__(self) -> str:
+        return (f'Database index `{self.index}` already contains '
+                f'{list(self.key)!r}')
+
+
+def utc(dt: datetime) -> datetime:
+    '''
+    SurrealDB reads datetimes without timezone as UTC, do the same so
+    they can be compared.
+    '''
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def new_id(table: str) -> str:
+    return f'{table}:{secrets.token_hex(10)}'
+
+
+class Table:
+    '''
+    Records keyed by id, with the same kinds of index as `DEFINE INDEX`:
+    `unique` and `index` map columns to record ids, `ordered` keeps ids
+    of each group sorted by some columns (for keyset pagination).
+    '''
+
+    def __init__(
+        self,
+        name: str,
+        unique: dict[str, tuple[str, ...]] = {},
+        index: dict[str, tuple[str, ...]] = {},
+        ordered: dict[str, tuple[tuple[str, ...], tuple[str, ...]]] = {},
+    ) -> None:
+        self.name = name
+        self.records: dict[str, Record] = {}
+        self._unique = unique
+        self._index = index
+        self._ordered = ordered
+        self._unique_keys: dict[str, dict[tuple, str]] = {
+            name: {}
+            for name in unique
+        }
+        self._index_keys: dict[str, dict[tuple, set[str]]] = {
+            name: {}
+            for name in index
+        }
+        self._ordered_keys: dict[str, dict[tuple, list[tuple]]] = {
+            name: {}
+            for name in ordered
+        }
+
+    def get(self, id: str) -> Record | None:
+        return self.records.get(id)
+
+    def get_unique(self, index: str, *key: Any) -> Record | None:
+        id = self._unique_keys[index].get(key)
+        return None if id is None else self.records[id]
+
+    def find(self, index: str, *key: Any) -> list[Record]:
+        ids = self._index_keys[index].get(key, ())
+        return [self.records[id] for id in ids]
+
+    def scan(
+        self,
+        index: str,
+        group: tuple = (),
+        after: tuple | None = None,
+        reverse: bool = False,
+    ) -> Iterator[Record]:
+        '''
+        Iterate a group of an ordered index, starting right after the
+        `after` key (its columns followed by the id).
+        '''
+        keys = self._ordered_keys[index].get(group, [])
+        if not reverse:
+            start = 0 if after is None else bisect_right(keys, after)
+            for i in range(start, len(keys)):
+                yield self.records[keys[i][-1]]
+        else:
+            end = len(keys) if after is None else bisect_left(keys, after)
+            for i in range(end - 1, -1, -1):
+                yield self.records[keys[i][-1]]
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __iter__(self) -> Iterator[Record]:
+        return iter(self.records.values())
+
+    def _key(self, record: Record, columns: tuple[str, ...]) -> tuple:
+        return tuple(record.get(c) for c in columns)
+
+    def _check(self, record: Record):
+        for index, columns in self._unique.items():
+            owner = self._unique_keys[index].get(self._key(record, columns))
+            if owner is not None and owner != record['id']:
+                raise UniqueIndexError(
+                    self.name,
+                    index,
+                    self._key(record, columns),
+                )
+
+    def _link(self, record: Record):
+        id = record['id']
+        for index, columns in self._unique.items():
+            self._unique_keys[index][self._key(record, columns)] = id
+        for index, columns in self._index.items():
+            ids = self._index_keys[index].setdefault(
+                self._key(record, columns),
+                set(),
+            )
+            ids.add(id)
+        for index, (group, columns) in self._ordered.items():
+            keys = self._ordered_keys[index].setdefault(
+                self._key(record, group),
+                [],
+            )
+            insort(keys, (*self._key(record, columns), id))
+
+    def _unlink(self, record: Record):
+        id = record['id']
+        for index, columns in self._unique.items():
+            self._unique_keys[index].pop(self._key(record, columns), None)
+        for index, columns in self._index.items():
+            key = self._key(record, columns)
+            ids = self._index_keys[index][key]
+            ids.discard(id)
+            if not ids:
+                del self._index_keys[index][key]
+        for index, (group, columns) in self._ordered.items():
+            group_key = self._key(record, group)
+            keys = self._ordered_keys[index][group_key]
+            del keys[bisect_left(keys, (*self._key(record, columns), id))]
+            if not keys:
+                del self._ordered_keys[index][group_key]
+
+    def _put(self, record: Record) -> Record | None:
+        self._check(record)
+        old = self.records.get(record['id'])
+        if old is not None:
+            self._unlink(old)
+        self.records[record['id']] = record
+        self._link(record)
+        return old
+
+    def _delete(self, id: str) -> Record | None:
+        old = self.records.pop(id, None)
+        if old is not None:
+            self._unlink(old)
+        return old
+
+
+def _tables() -> dict[str, Table]:
+    # keep in sync with the indexes defined in `vote.db.migration`
+    tables = [
+        Table(
+            'user',
+            unique={
+                'email_index': ('email', ),
+                'username_index': ('username', ),
+            },
+        ),
+        Table(
+            'topic',
+            ordered={
+                'topic_created_at_index': ((), ('created_at', )),
+            },
+        ),
+        Table(
+            'vote',
+            unique={
+                'topic_id_index': ('username', 'topic_id'),
+            },
+            index={
+                'vote_username_index': ('username', ),
+                'vote_topic_id_index': ('topic_id', ),
+            },
+        ),
+        Table(
+            'vote_tally',
+            index={
+                'vote_tally_topic_id_index': ('topic_id', ),
+            },
+        ),
+        Table('vote_result'),
+        Table(
+            'comment',
+            ordered={
+                'comment_topic_created_at_index': (
+                    ('topic_id', ),
+                    ('created_at', ),
+                ),
+            },
+        ),
+    ]
+    return {t.name: t for t in tables}
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _decode(obj: dict) -> Any:
+    if len(obj) == 1 and '$datetime' in obj:
+        return datetime.fromisoformat(obj['$datetime'])
+    return obj
+
+
+class MemoryDatabase:
+    '''
+    In-process database for small elections and benchmarks. Repositories
+    run synchronously on the event loop, so each `write` is atomic. If
+    `path` is set, every write is appended to a log which is folded into
+    a snapshot from time to time.
+    '''
+
+    def __init__(self, config: MemoryConfig) -> None:
+        self.config = config
+        self.tables = _tables()
+        self._log = None
+        self._logged = 0
+        self._snapshots = 0
+        # bumped by each snapshot, the log starts with the generation of
+        # the snapshot it applies to
+        self._generation = 0
+
+    def __getitem__(self, table: str) -> Table:
+        return self.tables[table]
+
+    @property
+    def _snapshot_path(self) -> str:
+        return os.path.join(self.config.path, 'snapshot.json')
+
+    @property
+    def _log_path(self) -> str:
+        return os.path.join(self.config.path, 'log.jsonl')
+
+    async def open(self):
+        if self.config.path is None:
+            return
+        os.makedirs(self.config.path, exist_ok=True)
+        self._load()
+        self._log = open(self._log_path, 'a')
+        if self._log.tell() == 0:
+            self._write_header()
+
+    async def close(self):
+        if self._log is None:
+            return
+        self.snapshot()
+        self._log.close()
+        self._log = None
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator['MemoryDatabase']:
+        # same interface as `SurrealPool`
+        yield self
+
+    def write(self, *ops: Op):
+        '''
+        Apply ops as one transaction, nothing is applied if any of them
+        violates an unique index.
+        '''
+        undo = []
+        try:
+            for op, table, arg in ops:
+                t = self.tables[table]
+                if op == 'put':
+                    undo.append((t, arg['id'], t._put(arg)))
+                else:
+                    undo.append((t, arg, t._delete(arg)))
+        except UniqueIndexError:
+            for t, id, old in reversed(undo):
+                t._delete(id)
+                if old is not None:
+                    t._put(old)
+            raise
+        if self._log is not None:
+            self._append(ops)
+
+    def _append(self, ops: tuple[Op, ...]):
+        self._log.write(json.dumps(ops, default=_encode) + '\n')
+        self._log.flush()
+        if self.config.fsync:
+            os.fsync(self._log.fileno())
+        self._logged += 1
+        if self._logged >= self.config.snapshot_every:
+            self.snapshot()
+
+    def _write_header(self):
+        self._log.write(json.dumps({'generation': self._generation}) + '\n')
+        self._log.flush()
+
+    def _load(self):
+        try:
+            with open(self._snapshot_path) as f:
+                snapshot = json.load(f, object_hook=_decode)
+        except FileNotFoundError:
+            snapshot = {'generation': 0, 'tables': {}}
+        self._generation = snapshot['generation']
+        for name, records in snapshot['tables'].items():
+            for r in records:
+                self.tables[name]._put(r)
+        try:
+            f = open(self._log_path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            header = f.readline()
+            if header and self._generation_of(header) != self._generation:
+                # crashed after the snapshot was written, but before the
+                # log was truncated, it's already in the snapshot
+                f.close()
+                os.truncate(self._log_path, 0)
+                return
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    ops = json.loads(line, object_hook=_decode)
+                except ValueError:
+                    ops = None
+                if ops is None or not line.endswith(b'\n'):
+                    # torn write of the last transaction, cut it off or
+                    # the next append is glued to it and lost as well
+                    logger.warning('drop broken line in %s', self._log_path)
+                    f.close()
+                    os.truncate(self._log_path, offset)
+                    return
+                for op, table, arg in ops:
+                    if op == 'put':
+                        self.tables[table]._put(arg)
+                    else:
+                        self.tables[table]._delete(arg)
+                self._logged += 1
+
+    def _generation_of(self, header: bytes) -> int | None:
+        try:
+            return json.loads(header)['generation']
+        except ValueError:
+            # torn header, nothing was logged after it
+            return None
+
+    def snapshot(self):
+        '''
+        Dump all tables and truncate the log.
+        '''
+        if self.config.path is None:
+            return
+        generation = self._generation + 1
+        tmp = self._snapshot_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(
+                {
+                    'generation': generation,
+                    'tables': {
+                        name: list(t.records.values())
+                        for name, t in self.tables.items()
+                    },
+                },
+                f,
+                default=_encode,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._snapshot_path)
+        self._generation = generation
+        if self._log is not None:
+            self._log.truncate(0)
+            self._write_header()
+        self._logged = 0
+        self._snapshots += 1
+
+    def stats(self) -> MemoryStats:
+        return MemoryStats(
+            records={
+                name: len(t)
+                for name, t in self.tables.items()
+            },
+            logged=self._logged,
+            snapshots=self._snapshots,
+        )
@@ -0,0 +1,226 @@
+from datetime import datetime
+from typing import Awaitable, Callable
+from pydantic import BaseModel
+from surrealdb import Surreal
+from vote.domain.vote import VoteRepositoryImpl
+
+
+class Migration(BaseModel):
+    version: int
+    name: str
+    statements: str
+    # data migration which runs after the statements are committed, the
+    # version is recorded only after it succeeds, so it's retried on the
+    # next start, statements of such a migration must be safe to rerun
+    after: Callable[[Surreal], Awaitable[None]] | None = None
+
+
+class MigrationError(Exception):
+
+    def __init__(self, migration: Migration, err: list[dict]) -> None:
+        self.migration = migration
+        self.err = err
+
+
+# Applied versions are recorded in `schema_version`, never edit a
+# migration after it is released, append a new one instead.
+MIGRATIONS = [
+    Migration(
+        version=1,
+        name='user',
+        statements='''
+        DEFINE TABLE user;
+        DEFINE FIELD username ON TABLE user TYPE string
+            ASSERT $value != None;
+        DEFINE FIELD email ON TABLE user TYPE string
+            ASSERT $value != None
+            AND is::email($value);
+        DEFINE FIELD password_digest ON TABLE user TYPE string
+            ASSERT $value != None;
+        DEFINE FIELD roles ON TABLE user TYPE array
+            ASSERT $value != None;
+        DEFINE FIELD roles.* ON TABLE user TYPE string;
+        DEFINE FIELD last_login_at ON TABLE user TYPE datetime;
+        DEFINE FIELD created_at ON TABLE user TYPE datetime
+            ASSERT $value != None;
+        DEFINE FIELD disabled ON TABLE user TYPE bool
+            ASSERT $value != None;
+
+        DEFINE INDEX email_index ON TABLE user COLUMNS email UNIQUE;
+        DEFINE INDEX username_index ON TABLE user COLUMNS username UNIQUE;
+        ''',
+    ),
+    Migration(
+        version=2,
+        name='topic',
+        statements='''
+        DEFINE TABLE topic;
+        DEFINE FIELD description ON TABLE topic TYPE string
+            ASSERT $value != None;
+        DEFINE FIELD starts_at ON TABLE topic TYPE datetime
+            ASSERT $value != None;
+        DEFINE FIELD ends_at ON TABLE topic TYPE datetime
+            ASSERT $value != None;
+        DEFINE FIELD created_at ON TABLE topic TYPE datetime
+            ASSERT $value != None;
+        DEFINE FIELD updated_at ON TABLE topic TYPE datetime
+            ASSERT $value != None;
+        DEFINE FIELD options ON TABLE topic TYPE array
+            ASSERT $value != None;
+        DEFINE FIELD stage ON TABLE topic TYPE string
+            ASSERT $value inside ["NOT_STARTED", "IN_PROGRESS", "ENDED"];
+        ''',
+    ),
+    Migration(
+        version=3,
+        name='vote',
+        statements='''
+        DEFINE TABLE vote;
+        DEFINE FIELD username ON TABLE vote TYPE string
+            ASSERT $value != None;
+        DEFINE FIELD topic_id ON TABLE vote TYPE string
+            ASSERT $value != None;
+        DEFINE FIELD option_id ON TABLE vote TYPE string
+            ASSERT $value != None;
+
+        DEFINE INDEX topic_id_index ON TABLE vote COLUMNS username, topic_id UNIQUE;
+        ''',
+    ),
+    Migration(
+        version=4,
+        name='comment',
+        statements='''
+        DEFINE TABLE comment;
+        DEFINE FIELD topic_id ON TABLE comment TYPE string
+            ASSERT $value != None;
+        DEFINE FIELD user_id ON TABLE comment TYPE string
+            ASSERT $value != None;
+        DEFINE FIELD content ON TABLE comment TYPE string
+            ASSERT $value != None;
+        DEFINE FIELD created_at ON TABLE comment TYPE datetime
+            ASSERT $value != None;
+
+        DEFINE INDEX comment_topic_id_index ON TABLE comment COLUMNS topic_id;
+        ''',
+    ),
+    Migration(
+        version=5,
+        name='vote_tally',
+        statements='''
+        DEFINE TABLE vote_tally;
+        DEFINE FIELD topic_id ON TABLE vote_tally TYPE string
+            ASSERT $value != None;
+        DEFINE FIELD option_id ON TABLE vote_tally TYPE string
+            ASSERT $value != None;
+        DEFINE FIELD count ON TABLE vote_tally TYPE int;
+
+        DEFINE INDEX vote_tally_topic_id_index ON TABLE vote_tally COLUMNS topic_id;
+        ''',
+        after=lambda db: VoteRepositoryImpl(db).recount(),
+    ),
+    Migration(
+        version=6,
+        name='vote_lookup_index',
+        statements='''
+        DEFINE INDEX vote_username_index ON TABLE vote COLUMNS username;
+        DEFINE INDEX vote_topic_id_index ON TABLE vote COLUMNS topic_id;
+        ''',
+    ),
+    Migration(
+        version=7,
+        name='created_at_index',
+        statements='''
+        DEFINE INDEX topic_created_at_index ON TABLE topic COLUMNS created_at;
+        DEFINE INDEX comment_topic_created_at_index ON TABLE comment
+            COLUMNS topic_id, created_at;
+        ''',
+    ),
+    Migration(
+        version=8,
+        name='user_token_version',
+        statements='''
+        DEFINE FIELD token_version ON TABLE user TYPE int;
+        UPDATE user SET token_version = 0 WHERE token_version = NONE;
+        ''',
+    ),
+    Migration(
+        version=9,
+        name='vote_result',
+        statements='''
+        DEFINE TABLE vote_result;
+        DEFINE FIELD topic_id ON TABLE vote_result TYPE string
+            ASSERT $value != None;
+        DEFINE FIELD counts ON TABLE vote_result TYPE object;
+        DEFINE FIELD total ON TABLE vote_result TYPE int;
+        DEFINE FIELD winners ON TABLE vote_result TYPE array;
+        DEFINE FIELD winners.* ON TABLE vote_result TYPE string;
+        DEFINE FIELD checksum ON TABLE vote_result TYPE string;
+        DEFINE FIELD computed_at ON TABLE vote_result TYPE datetime;
+        ''',
+    ),
+]
+
+
+async def get_applied_versions(db: Surreal) -> set[int]:
+    results = await db.query('SELECT version FROM schema_version;')
+    if results[0]['status'] != 'OK':
+        return set()
+    return {r['version'] for r in results[0]['result']}
+
+
+RECORD_VERSION = '''
+CREATE type::thing('schema_version', $version) CONTENT {
+    version: $version,
+    name: $name,
+    applied_at: $applied_at,
+};
+'''
+
+
+async def run_transaction(
+    db: Surreal,
+    statements: str,
+    vars: dict,
+) -> tuple[bool, list[dict]]:
+    results = await db.query(
+        f'''
+        BEGIN TRANSACTION;
+        {statements}
+        COMMIT TRANSACTION;
+        ''',
+        vars,
+    )
+    return all(r['status'] == 'OK' for r in results), results
+
+
+async def migrate(
+    db: Surreal,
+    migrations: list[Migration] = MIGRATIONS,
+) -> list[int]:
+    '''
+    Apply pending migrations in version order and return their versions.
+    '''
+    applied = await get_applied_versions(db)
+    done = []
+    for m in sorted(migrations, key=lambda m: m.version):
+        if m.version in applied:
+            continue
+        vars = {
+            'version': m.version,
+            'name': m.name,
+            'applied_at': datetime.now().isoformat(),
+        }
+        statements = m.statements
+        if m.after is None:
+            statements += RECORD_VERSION
+        ok, results = await run_transaction(db, statements, vars)
+        if ok and m.after is not None:
+            await m.after(db)
+            ok, results = await run_transaction(db, RECORD_VERSION, vars)
+        if not ok:
+            # another worker may have applied it concurrently
+            if m.version not in await get_applied_versions(db):
+                raise MigrationError(m, results)
+            continue
+        done.append(m.version)
+    return done
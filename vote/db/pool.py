@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Literal
+from pydantic import BaseModel
+from surrealdb import Surreal
+from websockets.exceptions import ConnectionClosed
+from vote.metrics import DB_QUERY_DURATION, DB_QUERY_ERRORS, db_operation
+from vote.log import redact
+from .memory import MemoryConfig
+
+logger = logging.getLogger(__name__)
+
+
+class SurrealConfig(BaseModel):
+    # "memory" keeps everything inside the app process, see `[db.memory]`
+    backend: Literal['surreal', 'memory'] = 'surreal'
+    memory: MemoryConfig = MemoryConfig()
+    url: str
+    username: str
+    password: str
+    namespace: str
+    database: str
+    # max number of connections kept by the pool
+    pool_size: int = 10
+    # seconds to wait for a free connection before giving up
+    pool_timeout: float = 5.0
+    # queries slower than this (seconds) are logged as warnings
+    slow_query: float = 0.1
+
+
+class PoolTimeoutError(Exception):
+
+    def __init__(self, timeout: float) -> None:
+        self.timeout = timeout
+
+
+class PoolStats(BaseModel):
+    size: int
+    opened: int
+    in_use: int
+    idle: int
+    waiting: int
+    checkouts: int
+    timeouts: int
+    reconnects: int
+
+
+# errors after which the socket can not be trusted anymore,
+# a cancelled query may leave an unread response on the wire
+_BROKEN_ERRORS = (
+    ConnectionClosed,
+    OSError,
+    asyncio.CancelledError,
+)
+
+
+class InstrumentedSurreal(Surreal):
+    '''
+    Time every query, labelled by the repository operation running it.
+    Slow queries are logged as warnings, all others at debug level.
+    '''
+
+    def __init__(self, url: str, slow_query: float) -> None:
+        super().__init__(url)
+        self.slow_query = slow_query
+
+    async def query(
+        self,
+        sql: str,
+        vars: dict[str, Any] | None = None,
+    ) -> list[dict[str, Any]]:
+        operation = db_operation.get()
+        start = time.perf_counter()
+        try:
+            results = await super().query(sql, vars)
+        except Exception:
+            DB_QUERY_ERRORS.inc(operation)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            DB_QUERY_DURATION.observe(duration, operation)
+        ok = all(r.get('status') == 'OK' for r in results)
+        if not ok:
+            DB_QUERY_ERRORS.inc(operation)
+        level = logging.DEBUG
+        if duration >= self.slow_query:
+            level = logging.WARNING
+        if logger.isEnabledFor(level):
+            rows = [
+                len(r['result']) if isinstance(r.get('result'), list) else None
+                for r in results
+            ]
+            logger.log(
+                level,
+                'slow query' if level == logging.WARNING else 'query',
+                extra={
+                    'fields': {
+                        'operation': operation,
+                        'statement': ' '.join(sql.split()),
+                        'params': redact(vars or {}),
+                        'rows': rows,
+                        'ok': ok,
+                        'duration_ms': round(duration * 1000, 3),
+                    },
+                },
+            )
+        return results
+
+
+def _is_alive(db: Surreal) -> bool:
+    return db.ws is not None and db.ws.open
+
+
+class SurrealPool:
+    '''
+    App-lifetime pool of SurrealDB connections. Every connection is
+    already signed in and has namespace / database selected.
+    '''
+
+    def __init__(self, config: SurrealConfig) -> None:
+        self.config = config
+        self._sem = asyncio.Semaphore(config.pool_size)
+        self._idle: list[Surreal] = []
+        self._opened = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._reconnects = 0
+
+    async def _connect(self) -> Surreal:
+        db = InstrumentedSurreal(self.config.url, self.config.slow_query)
+        await db.connect()
+        try:
+            await db.signin({
+                'user': self.config.username,
+                'pass': self.config.password,
+            })
+            await db.use(
+                self.config.namespace,
+                self.config.database,
+            )
+        except BaseException:
+            await self._close(db)
+            raise
+        self._opened += 1
+        return db
+
+    async def _close(self, db: Surreal):
+        try:
+            await db.close()
+        except Exception:
+            pass
+
+    async def _discard(self, db: Surreal):
+        self._opened -= 1
+        await self._close(db)
+
+    async def open(self):
+        '''
+        Fill the pool so the first requests don't pay for the handshake.
+        '''
+        results = await asyncio.gather(
+            *[self._connect() for _ in range(self.config.pool_size)],
+            return_exceptions=True,
+        )
+        dbs = [r for r in results if not isinstance(r, BaseException)]
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            # don't leak the connections which did open
+            for db in dbs:
+                await self._discard(db)
+            raise errors[0]
+        self._idle.extend(dbs)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for db in idle:
+            await self._discard(db)
+
+    async def _checkout(self) -> Surreal:
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(
+                self._sem.acquire(),
+                self.config.pool_timeout,
+            )
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            raise PoolTimeoutError(self.config.pool_timeout)
+        finally:
+            self._waiting -= 1
+        try:
+            while self._idle:
+                db = self._idle.pop()
+                if _is_alive(db):
+                    return db
+                self._reconnects += 1
+                await self._discard(db)
+            return await self._connect()
+        except BaseException:
+            self._sem.release()
+            raise
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Surreal]:
+        db = await self._checkout()
+        self._checkouts += 1
+        try:
+            yield db
+        except _BROKEN_ERRORS:
+            await self._discard(db)
+            db = None
+            raise
+        finally:
+            if db is not None:
+                self._idle.append(db)
+            self._sem.release()
+
+    def stats(self) -> PoolStats:
+        idle = len(self._idle)
+        return PoolStats(
+            size=self.config.pool_size,
+            opened=self._opened,
+            in_use=self._opened - idle,
+            idle=idle,
+            waiting=self._waiting,
+            checkouts=self._checkouts,
+            timeouts=self._timeouts,
+            reconnects=self._reconnects,
+        )
@@ -0,0 +1,432 @@
+'''
+Pick the repository implementation of the configured backend. The
+SurrealDB ones are the `*Impl` classes next to their domain in
+`vote.domain`, the memory backend ones are here: they need
+`MemoryDatabase`, and `vote.domain` importing `vote.db` would be
+circular since this module imports the domain.
+'''
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any
+import json
+import secrets
+from surrealdb import Surreal
+from vote.domain.user import (
+    User,
+    AddUserInput,
+    AddUserError,
+    UserRepository,
+    UserRepositoryImpl,
+)
+from vote.domain.topic import (
+    Topic,
+    TopicStage,
+    CreateTopicInput,
+    TopicRepository,
+    TopicRepositoryImpl,
+)
+from vote.domain.vote import (
+    Vote,
+    CreateVoteInput,
+    BatchVoteInput,
+    BatchVoteStatus,
+    DuplicatedVoteError,
+    TopicNotEndedError,
+    VoteNotAllowedError,
+    VoteResult,
+    VoteRepository,
+    VoteRepositoryImpl,
+)
+from vote.domain.comment import (
+    Comment,
+    CreateCommentInput,
+    UpdateCommentInput,
+    CommentRepository,
+    CommentRepositoryImpl,
+)
+from vote.domain.page import Cursor, Page, next_cursor
+from vote.metrics import instrumented
+from .pool import SurrealConfig, SurrealPool
+from .memory import MemoryDatabase, Op, UniqueIndexError, new_id, utc
+
+# a connection acquired from `DatabasePool`
+Database = Surreal | MemoryDatabase
+DatabasePool = SurrealPool | MemoryDatabase
+
+
+def create_pool(config: SurrealConfig) -> DatabasePool:
+    '''
+    Pool of the configured backend, it should be opened before use.
+    '''
+    if config.backend == 'memory':
+        return MemoryDatabase(config.memory)
+    return SurrealPool(config)
+
+
+def user_repository(db: Database) -> UserRepository:
+    if isinstance(db, MemoryDatabase):
+        return MemoryUserRepository(db)
+    return UserRepositoryImpl(db)
+
+
+def topic_repository(db: Database) -> TopicRepository:
+    if isinstance(db, MemoryDatabase):
+        return MemoryTopicRepository(db)
+    return TopicRepositoryImpl(db)
+
+
+def vote_repository(db: Database) -> VoteRepository:
+    if isinstance(db, MemoryDatabase):
+        return MemoryVoteRepository(db)
+    return VoteRepositoryImpl(db)
+
+
+def comment_repository(db: Database) -> CommentRepository:
+    if isinstance(db, MemoryDatabase):
+        return MemoryCommentRepository(db)
+    return CommentRepositoryImpl(db)
+
+
+@instrumented('user', timed=True)
+class MemoryUserRepository:
+
+    def __init__(self, db: MemoryDatabase) -> None:
+        self.db = db
+
+    async def get_by_username(self, username: str) -> User | None:
+        record = self.db['user'].get_unique('username_index', username)
+        if record is None:
+            return None
+        return User.parse_obj(record)
+
+    async def add(self, input: AddUserInput):
+        record = input.dict() | {
+            'id': new_id('user'),
+            'created_at': utc(input.created_at),
+            'last_login_at': None,
+        }
+        try:
+            self.db.write(('put', 'user', record))
+        except UniqueIndexError as e:
+            raise AddUserError({'status': 'ERR', 'detail': str(e)})
+
+    async def bump_token_version(self, username: str):
+        record = self.db['user'].get_unique('username_index', username)
+        if record is None:
+            return
+        version = record.get('token_version', 0) + 1
+        self.db.write(('put', 'user', record | {'token_version': version}))
+
+
+@instrumented('topic', timed=True)
+class MemoryTopicRepository:
+
+    def __init__(self, db: MemoryDatabase) -> None:
+        self.db = db
+
+    async def add(self, input: CreateTopicInput) -> str:
+        now = datetime.now(timezone.utc)
+        record = input.dict() | {
+            'id': new_id('topic'),
+            'starts_at': utc(input.starts_at),
+            'ends_at': utc(input.ends_at),
+            'created_at': now,
+            'updated_at': now,
+            'stage': TopicStage.NOT_STARTED,
+        }
+        for opt in record['options']:
+            opt['id'] = secrets.token_urlsafe()
+        self.db.write(('put', 'topic', record))
+        return record['id']
+
+    async def get_by_id(self, id: str) -> Topic | None:
+        record = self.db['topic'].get(id)
+        if record is None:
+            return None
+        return Topic.parse_obj(record)
+
+    async def save(self, topic: Topic):
+        if self.db['topic'].get(topic.id) is None:
+            return
+        record = topic.dict()
+        for field in ('starts_at', 'ends_at', 'created_at', 'updated_at'):
+            record[field] = utc(record[field])
+        self.db.write(('put', 'topic', record))
+
+    async def get_all(self) -> list[Topic]:
+        records = self.db['topic'].scan('topic_created_at_index', reverse=True)
+        return [Topic.parse_obj(r) for r in records]
+
+    async def get_page(
+        self,
+        limit: int,
+        cursor: Cursor | None = None,
+        fields: list[str] | None = None,
+    ) -> Page[dict[str, Any]]:
+        '''
+        Get topics newer first. Rows only contain `id`, `created_at` and
+        `fields` if it's given.
+        '''
+        after = None
+        if cursor is not None:
+            after = (utc(cursor.created_at), cursor.id)
+        columns = None
+        if fields is not None:
+            columns = list(dict.fromkeys(['id', 'created_at', *fields]))
+        rows = []
+        topics = self.db['topic'].scan(
+            'topic_created_at_index',
+            after=after,
+            reverse=True,
+        )
+        for r in topics:
+            if columns is None:
+                rows.append(dict(r))
+            else:
+                rows.append({c: r[c] for c in columns})
+            if len(rows) > limit:
+                break
+        return Page[dict[str, Any]].construct(
+            items=rows[:limit],
+            next_cursor=next_cursor(rows, limit),
+        )
+
+    async def refresh_stages(self, now: datetime) -> int:
+        now = utc(now)
+        ops: list[Op] = []
+        for r in self.db['topic']:
+            if r['starts_at'] > now:
+                stage = TopicStage.NOT_STARTED
+            elif r['ends_at'] >= now:
+                stage = TopicStage.IN_PROGRESS
+            else:
+                stage = TopicStage.ENDED
+            if r['stage'] != stage:
+                ops.append(('put', 'topic', r | {'stage': stage}))
+        if ops:
+            self.db.write(*ops)
+        return len(ops)
+
+
+@instrumented('vote', timed=True)
+class MemoryVoteRepository:
+
+    def __init__(self, db: MemoryDatabase) -> None:
+        self.db = db
+
+    def _count(self, topic_id: str, option_id: str, delta: int) -> Op:
+        '''
+        Op to add `delta` to an option's tally.
+        '''
+        id = f'vote_tally:{json.dumps([topic_id, option_id])}'
+        tally = self.db['vote_tally'].get(id)
+        count = delta if tally is None else tally['count'] + delta
+        return ('put', 'vote_tally', {
+            'id': id,
+            'topic_id': topic_id,
+            'option_id': option_id,
+            'count': count,
+        })
+
+    def _closed(self, topic_id: str) -> bool:
+        '''
+        Same check as `vote.domain.vote.closed_guard`.
+        '''
+        if self.db['vote_result'].get(f'vote_result:{topic_id}') is not None:
+            return True
+        topic = self.db['topic'].get(topic_id)
+        return (topic is None
+                or datetime.now(timezone.utc) > utc(topic['ends_at']))
+
+    async def add(self, username: str, input: CreateVoteInput):
+        if self._closed(input.topic_id):
+            raise VoteNotAllowedError(TopicStage.ENDED)
+        vote = input.dict() | {'id': new_id('vote'), 'username': username}
+        try:
+            self.db.write(
+                ('put', 'vote', vote),
+                self._count(input.topic_id, input.option_id, 1),
+            )
+        except UniqueIndexError:
+            raise DuplicatedVoteError(username, input.topic_id)
+
+    async def get_by_id(self, id: str) -> Vote | None:
+        record = self.db['vote'].get(id)
+        if record is None:
+            return None
+        return Vote.parse_obj(record)
+
+    async def save(self, topic: Vote):
+        old = self.db['vote'].get(topic.id)
+        if old is None:
+            return
+        ops: list[Op] = [('put', 'vote', topic.dict())]
+        if (old['topic_id'], old['option_id']) != (topic.topic_id,
+                                                   topic.option_id):
+            ops.append(self._count(old['topic_id'], old['option_id'], -1))
+            ops.append(self._count(topic.topic_id, topic.option_id, 1))
+        self.db.write(*ops)
+
+    async def get_all(self) -> list[Vote]:
+        return [Vote.parse_obj(r) for r in self.db['vote']]
+
+    async def get_by_user_and_topic(
+        self,
+        username: str,
+        topic_id: str,
+    ) -> Vote | None:
+        record = self.db['vote'].get_unique(
+            'topic_id_index',
+            username,
+            topic_id,
+        )
+        if record is None:
+            return None
+        return Vote.parse_obj(record)
+
+    async def list_by_user(self, username: str) -> list[Vote]:
+        records = self.db['vote'].find('vote_username_index', username)
+        return [Vote.parse_obj(r) for r in records]
+
+    async def get_tally(self, topic_id: str) -> dict[str, int]:
+        return {
+            r['option_id']: r['count']
+            for r in self.db['vote_tally'].find(
+                'vote_tally_topic_id_index',
+                topic_id,
+            )
+        }
+
+    async def get_final_tally(self, topic: Topic) -> dict[str, int]:
+        # writes are atomic here, votes are rejected once it has ended
+        if not self._closed(topic.id):
+            raise TopicNotEndedError(topic.id)
+        # same as the DB one, options without votes are counted as 0
+        tally = await self.get_tally(topic.id)
+        return {o.id: tally.get(o.id, 0) for o in topic.options}
+
+    async def recount(self, topic_id: str | None = None):
+        if topic_id is None:
+            votes = list(self.db['vote'])
+            tallies = list(self.db['vote_tally'])
+        else:
+            votes = self.db['vote'].find('vote_topic_id_index', topic_id)
+            tallies = self.db['vote_tally'].find(
+                'vote_tally_topic_id_index',
+                topic_id,
+            )
+        ops: list[Op] = [('delete', 'vote_tally', t['id']) for t in tallies]
+        counts = Counter((v['topic_id'], v['option_id']) for v in votes)
+        for (t, o), n in counts.items():
+            ops.append(('put', 'vote_tally', {
+                'id': f'vote_tally:{json.dumps([t, o])}',
+                'topic_id': t,
+                'option_id': o,
+                'count': n,
+            }))
+        self.db.write(*ops)
+
+    async def add_many(
+        self,
+        votes: list[BatchVoteInput],
+    ) -> list[BatchVoteStatus]:
+        table = self.db['vote']
+        statuses = []
+        ops: list[Op] = []
+        voted = set()
+        tally = Counter()
+        for v in votes:
+            key = (v.username, v.topic_id)
+            if key in voted or table.get_unique('topic_id_index', *key):
+                statuses.append(BatchVoteStatus.DUPLICATED)
+                continue
+            if self._closed(v.topic_id):
+                statuses.append(BatchVoteStatus.NOT_IN_PROGRESS)
+                continue
+            voted.add(key)
+            statuses.append(BatchVoteStatus.OK)
+            ops.append(('put', 'vote', v.dict() | {'id': new_id('vote')}))
+            tally[v.topic_id, v.option_id] += 1
+        for (topic_id, option_id), n in tally.items():
+            ops.append(self._count(topic_id, option_id, n))
+        if ops:
+            self.db.write(*ops)
+        return statuses
+
+    async def get_result(self, topic_id: str) -> VoteResult | None:
+        record = self.db['vote_result'].get(f'vote_result:{topic_id}')
+        if record is None:
+            return None
+        return VoteResult.parse_obj(record)
+
+    async def add_result(self, result: VoteResult) -> VoteResult:
+        stored = await self.get_result(result.topic_id)
+        if stored is not None:
+            return stored
+        await self.replace_result(result)
+        return result
+
+    async def replace_result(self, result: VoteResult):
+        record = result.dict() | {'id': f'vote_result:{result.topic_id}'}
+        self.db.write(('put', 'vote_result', record))
+
+
+@instrumented('comment', timed=True)
+class MemoryCommentRepository:
+
+    def __init__(self, db: MemoryDatabase) -> None:
+        self.db = db
+
+    async def get(self, topic_id: str) -> list[Comment]:
+        records = self.db['comment'].scan(
+            'comment_topic_created_at_index',
+            (topic_id, ),
+        )
+        return [Comment.parse_obj(r) for r in records]
+
+    async def get_page(
+        self,
+        topic_id: str,
+        limit: int,
+        cursor: Cursor | None = None,
+    ) -> Page[Comment]:
+        '''
+        Get comments of a topic, older first.
+        '''
+        after = None
+        if cursor is not None:
+            after = (utc(cursor.created_at), cursor.id)
+        rows = []
+        comments = self.db['comment'].scan(
+            'comment_topic_created_at_index',
+            (topic_id, ),
+            after,
+        )
+        for r in comments:
+            rows.append(r)
+            if len(rows) > limit:
+                break
+        return Page[Comment](
+            items=rows[:limit],
+            next_cursor=next_cursor(rows, limit),
+        )
+
+    async def get_by_id(self, id: str) -> Comment | None:
+        record = self.db['comment'].get(id)
+        if record is None:
+            return None
+        return Comment.parse_obj(record)
+
+    async def add(self, input: CreateCommentInput) -> str:
+        record = input.dict() | {
+            'id': new_id('comment'),
+            'created_at': utc(input.created_at),
+        }
+        self.db.write(('put', 'comment', record))
+        return record['id']
+
+    async def update(self, input: UpdateCommentInput):
+        record = self.db['comment'].get(input.id)
+        if record is None:
+            return
+        self.db.write(('put', 'comment', record | {'content': input.content}))
@@ -2,27 +2,73 @@ from datetime import timedelta, datetime
 from typing import Protocol, Any
 from pydantic import BaseModel
 from jose import jwt
+import time
+from vote.cache import TTLCache
+from vote.domain.user import User
 
 
 class AuthConfig(BaseModel):
     secret_key: str
     algorithm: str
+    # put user id, roles, disabled flag and token version into tokens,
+    # tokens can only be revoked when this is enabled
+    embed_claims: bool = True
+    # max number of decoded tokens / users kept in memory
+    cache_size: int = 4096
+    # seconds before a cached user is read from DB again
+    cache_ttl: float = 30.0
+    # lifetime of tokens issued by `POST /auth/token`
+    token_expire_minutes: float = 300.0
 
 
 # TODO: maybe an application service?
 class AuthService:
 
-    def __init__(self, config: AuthConfig) -> None:
+    def __init__(
+        self,
+        config: AuthConfig,
+        token_cache: TTLCache[str, dict[str, Any]] | None = None,
+    ) -> None:
         self.config = config
+        self.token_cache = token_cache
 
     def parse(self, token: str) -> dict[str, Any]:
+        '''
+        Decode and verify a token. The returned payload may be shared
+        with other callers, don't modify it.
+        '''
+        if self.token_cache is not None:
+            payload = self.token_cache.get(token)
+            if payload is not None:
+                return payload
         payload = jwt.decode(
             token,
             self.config.secret_key,
             algorithms=[self.config.algorithm],
         )
+        if self.token_cache is not None:
+            ttl = None
+            if 'exp' in payload:
+                ttl = payload['exp'] - time.time()
+            if ttl is None or ttl > 0:
+                self.token_cache.set(token, payload, ttl)
         return payload
 
+    def sign_user(
+        self,
+        user: User,
+        expires_after: timedelta | None = None,
+    ) -> str:
+        data = {'sub': user.username}
+        if self.config.embed_claims:
+            data |= {
+                'uid': user.id,
+                'roles': user.roles,
+                'disabled': user.disabled,
+                'ver': user.token_version,
+            }
+        return self.sign(data, expires_after)
+
     def sign(
         self,
         data: dict[str, Any],
@@ -4,6 +4,8 @@ from datetime import datetime
 from pydantic import BaseModel, Field
 from surrealdb import Surreal
 from vote.domain.user import User
+from vote.domain.page import Cursor, Page, next_cursor
+from vote.metrics import instrumented
 
 
 class Comment(BaseModel):
@@ -44,6 +46,14 @@ class CommentRepository(Protocol):
     async def get(self, topic_id: str) -> list[Comment]:
         ...
 
+    async def get_page(
+        self,
+        topic_id: str,
+        limit: int,
+        cursor: Cursor | None = None,
+    ) -> Page[Comment]:
+        ...
+
     async def get_by_id(self, id: str) -> Comment | None:
         ...
 
@@ -51,6 +61,7 @@ class CommentRepository(Protocol):
         ...
 
 
+@instrumented('comment')
 class CommentRepositoryImpl:
 
     def __init__(self, db: Surreal) -> None:
@@ -64,6 +75,41 @@ class CommentRepositoryImpl:
         result = result[0]['result']
         return [Comment.parse_obj(r) for r in result]
 
+    async def get_page(
+        self,
+        topic_id: str,
+        limit: int,
+        cursor: Cursor | None = None,
+    ) -> Page[Comment]:
+        '''
+        Get comments of a topic, older first.
+        '''
+        where = ''
+        vars = {'topic_id': topic_id}
+        if cursor is not None:
+            where = '''
+            AND (created_at > <datetime> $created_at
+                OR (created_at = <datetime> $created_at
+                    AND id > type::thing('comment', $key)))
+            '''
+            vars |= {
+                'created_at': cursor.created_at.isoformat(),
+                'key': cursor.key,
+            }
+        results = await self.db.query(
+            f'''
+            SELECT * FROM comment WHERE topic_id = $topic_id {where}
+                ORDER BY created_at ASC, id ASC
+                LIMIT {limit + 1};
+            ''',
+            vars,
+        )
+        rows = results[0]['result']
+        return Page[Comment](
+            items=rows[:limit],
+            next_cursor=next_cursor(rows, limit),
+        )
+
     async def get_by_id(self, id: str) -> Comment | None:
         result = await self.db.query('SELECT * FROM comment WHERE id=$id',
                                      {'id': id})
@@ -80,7 +126,6 @@ class CommentRepositoryImpl:
                                      {'comment': input_dict})
         if result[0]['status'] != 'OK':
             raise AddCommentError(result[0])
-        print(result)
         return result[0]['result'][0]['id']
 
     ###
@@ -92,7 +137,6 @@ class CommentRepositoryImpl:
             })
         if result[0]['status'] != 'OK':
             raise UpdateCommentError(result[0])
-        print(result)
 
 
 class CommentService:
@@ -103,6 +147,14 @@ class CommentService:
     async def get(self, topic_id: str) -> list[Comment]:
         return await self.repo.get(topic_id)
 
+    async def get_page(
+        self,
+        topic_id: str,
+        limit: int,
+        cursor: Cursor | None = None,
+    ) -> Page[Comment]:
+        return await self.repo.get_page(topic_id, limit, cursor)
+
     async def post(self, input: CreateCommentInput) -> str:
         return await self.repo.add(input)
 
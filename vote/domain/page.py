@@ -0,0 +1,59 @@
+from typing import Generic, TypeVar
+from datetime import datetime
+from pydantic import BaseModel, ValidationError
+from pydantic.generics import GenericModel
+import base64
+import binascii
+import json
+
+T = TypeVar('T')
+
+
+class InvalidCursorError(Exception):
+
+    def __init__(self, cursor: str) -> None:
+        self.cursor = cursor
+
+
+class Cursor(BaseModel):
+    '''
+    Position of the last item of a page, pages are ordered by
+    (created_at, id) so the next one can be queried by keyset.
+    '''
+    created_at: datetime
+    id: str
+
+    @property
+    def key(self) -> str:
+        '''
+        Record id without table name.
+        '''
+        return self.id.split(':', 1)[-1]
+
+    def encode(self) -> str:
+        raw = json.dumps([self.created_at.isoformat(), self.id])
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @classmethod
+    def decode(cls, cursor: str) -> 'Cursor':
+        try:
+            created_at, id = json.loads(base64.urlsafe_b64decode(cursor))
+            return cls(created_at=created_at, id=id)
+        except (binascii.Error, ValueError, TypeError, ValidationError):
+            raise InvalidCursorError(cursor)
+
+
+class Page(GenericModel, Generic[T]):
+    items: list[T]
+    next_cursor: str | None = None
+
+
+def next_cursor(rows: list[dict], limit: int) -> str | None:
+    '''
+    Cursor of the next page. Rows should be queried with `limit + 1`
+    so we know whether there is a next page.
+    '''
+    if len(rows) <= limit:
+        return None
+    last = rows[limit - 1]
+    return Cursor(created_at=last['created_at'], id=last['id']).encode()
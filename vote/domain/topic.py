@@ -1,9 +1,13 @@
-from typing import Protocol, Annotated
+from typing import Protocol, Annotated, Any
 from enum import Enum
 from datetime import datetime, timezone
 from pydantic import BaseModel, Field
 from surrealdb import Surreal
 import secrets
+from vote.domain.page import Cursor, Page, next_cursor
+from vote.cache import TTLCache
+from vote.metrics import instrumented
+from vote.singleflight import SingleFlight
 
 
 class TopicStage(str, Enum):
@@ -40,12 +44,6 @@ class UpdateTopicInput(BaseModel):
     stage: TopicStage
 
 
-class InitTopicError(Exception):
-
-    def __init__(self, err: list[dict]) -> None:
-        self.err = err
-
-
 class AddTopicError(Exception):
 
     def __init__(self, err: dict) -> None:
@@ -56,6 +54,18 @@ class UpdateTopicError(Exception):
     ...
 
 
+class RefreshTopicError(Exception):
+
+    def __init__(self, err: list[dict]) -> None:
+        self.err = err
+
+
+class InvalidFieldError(Exception):
+
+    def __init__(self, fields: list[str]) -> None:
+        self.fields = fields
+
+
 class Topic(BaseModel):
     id: str
     description: str
@@ -84,6 +94,10 @@ class Topic(BaseModel):
             self.stage = TopicStage.ENDED
 
 
+# fields can be selected by `TopicService.get_page`
+TOPIC_FIELDS = frozenset(Topic.__fields__)
+
+
 class TopicRepository(Protocol):
 
     async def add(self, input: CreateTopicInput):
@@ -98,34 +112,24 @@ class TopicRepository(Protocol):
     async def get_all(self) -> list[Topic]:
         ...
 
+    async def get_page(
+        self,
+        limit: int,
+        cursor: Cursor | None = None,
+        fields: list[str] | None = None,
+    ) -> Page[dict[str, Any]]:
+        ...
+
+    async def refresh_stages(self, now: datetime) -> int:
+        ...
+
 
+@instrumented('topic')
 class TopicRepositoryImpl:
 
     def __init__(self, db: Surreal) -> None:
         self.db = db
 
-    async def init_db(self):
-        results = await self.db.query('''
-        DEFINE TABLE topic;
-        DEFINE FIELD description ON TABLE topic TYPE string
-            ASSERT $value != None;
-        DEFINE FIELD starts_at ON TABLE topic TYPE datetime
-            ASSERT $value != None;
-        DEFINE FIELD ends_at ON TABLE topic TYPE datetime
-            ASSERT $value != None;
-        DEFINE FIELD created_at ON TABLE topic TYPE datetime
-            ASSERT $value != None;
-        DEFINE FIELD updated_at ON TABLE topic TYPE datetime
-            ASSERT $value != None;
-        DEFINE FIELD options ON TABLE topic TYPE array
-            ASSERT $value != None;
-        DEFINE FIELD stage ON TABLE topic TYPE string
-            ASSERT $value inside ["NOT_STARTED", "IN_PROGRESS", "ENDED"];
-        ''')
-
-        if not all(r['status'] == 'OK' for r in results):
-            raise InitTopicError(results)
-
     # TODO: relate user and topic
     async def add(self, input: CreateTopicInput) -> str:
         input_dict = input.dict()
@@ -142,7 +146,6 @@ class TopicRepositoryImpl:
         )
         if result[0]['status'] != 'OK':
             raise AddTopicError(result[0])
-        print(result)
         return result[0]['result'][0]['id']
 
     async def get_by_id(self, id: str) -> Topic | None:
@@ -177,11 +180,135 @@ class TopicRepositoryImpl:
         result = result[0]['result']
         return [Topic.parse_obj(r) for r in result]
 
+    async def get_page(
+        self,
+        limit: int,
+        cursor: Cursor | None = None,
+        fields: list[str] | None = None,
+    ) -> Page[dict[str, Any]]:
+        '''
+        Get topics newer first. Rows only contain `id`, `created_at` and
+        `fields` if it's given.
+        '''
+        projection = '*'
+        if fields is not None:
+            columns = dict.fromkeys(['id', 'created_at', *fields])
+            projection = ', '.join(columns)
+        where = ''
+        vars = {}
+        if cursor is not None:
+            where = '''
+            WHERE created_at < <datetime> $created_at
+                OR (created_at = <datetime> $created_at
+                    AND id < type::thing('topic', $key))
+            '''
+            vars = {
+                'created_at': cursor.created_at.isoformat(),
+                'key': cursor.key,
+            }
+        results = await self.db.query(
+            f'''
+            SELECT {projection} FROM topic {where}
+                ORDER BY created_at DESC, id DESC
+                LIMIT {limit + 1};
+            ''',
+            vars,
+        )
+        rows = results[0]['result']
+        return Page[dict[str, Any]].construct(
+            items=rows[:limit],
+            next_cursor=next_cursor(rows, limit),
+        )
+
+    async def refresh_stages(self, now: datetime) -> int:
+        '''
+        Same as `Topic.refresh` for all topics, but done by the DB in one
+        transaction. Return the number of topics whose stage is changed.
+        '''
+        results = await self.db.query(
+            '''
+            BEGIN TRANSACTION;
+            LET $now = <datetime> $at;
+            UPDATE topic SET stage = 'NOT_STARTED'
+                WHERE stage != 'NOT_STARTED' AND starts_at > $now
+                RETURN id;
+            UPDATE topic SET stage = 'IN_PROGRESS'
+                WHERE stage != 'IN_PROGRESS'
+                    AND starts_at <= $now AND ends_at >= $now
+                RETURN id;
+            UPDATE topic SET stage = 'ENDED'
+                WHERE stage != 'ENDED' AND ends_at < $now
+                RETURN id;
+            COMMIT TRANSACTION;
+            ''',
+            {'at': now.isoformat()},
+        )
+        if not all(r['status'] == 'OK' for r in results):
+            raise RefreshTopicError(results)
+        return sum(
+            len(r['result']) for r in results if isinstance(r['result'], list))
+
+
+class CachedTopicRepository:
+    '''
+    Read-through cache in front of another topic repository. Writes go
+    to the underlying repository and invalidate the cached topic.
+    '''
+
+    def __init__(
+        self,
+        repo: TopicRepository,
+        cache: TTLCache[str, Topic],
+    ) -> None:
+        self.repo = repo
+        self.cache = cache
+
+    async def add(self, input: CreateTopicInput) -> str:
+        return await self.repo.add(input)
+
+    async def get_by_id(self, id: str) -> Topic | None:
+        topic = self.cache.get(id)
+        if topic is None:
+            topic = await self.repo.get_by_id(id)
+            if topic is None:
+                return None
+            self.cache.set(id, topic)
+        # callers may modify it inplace
+        return topic.copy()
+
+    async def save(self, topic: Topic):
+        try:
+            await self.repo.save(topic)
+        finally:
+            self.cache.invalidate(topic.id)
+
+    async def get_all(self) -> list[Topic]:
+        return await self.repo.get_all()
+
+    async def get_page(
+        self,
+        limit: int,
+        cursor: Cursor | None = None,
+        fields: list[str] | None = None,
+    ) -> Page[dict[str, Any]]:
+        return await self.repo.get_page(limit, cursor, fields)
+
+    async def refresh_stages(self, now: datetime) -> int:
+        changed = await self.repo.refresh_stages(now)
+        if changed:
+            self.cache.clear()
+        return changed
+
 
 class TopicService:
 
-    def __init__(self, repo: TopicRepository):
+    def __init__(
+        self,
+        repo: TopicRepository,
+        flight: SingleFlight | None = None,
+    ):
         self.repo = repo
+        self.flight = flight
 
     async def new(self, input: CreateTopicInput) -> str:
         return await self.repo.add(input)
@@ -190,7 +317,32 @@ class TopicService:
         await self.repo.save(topic)
 
     async def get_by_id(self, id: str) -> Topic | None:
-        return await self.repo.get_by_id(id)
+        if self.flight is None:
+            return await self.repo.get_by_id(id)
+        topic = await self.flight.do(
+            'topic.get_by_id',
+            id,
+            lambda: self.repo.get_by_id(id),
+        )
+        # shared by concurrent callers, which may modify it inplace
+        return None if topic is None else topic.copy()
 
     async def get_all(self) -> list[Topic]:
         return await self.repo.get_all()
+
+    async def get_page(
+        self,
+        limit: int,
+        cursor: Cursor | None = None,
+        fields: list[str] | None = None,
+    ) -> Page[dict[str, Any]]:
+        if fields is not None:
+            invalid = [f for f in fields if f not in TOPIC_FIELDS]
+            if invalid:
+                raise InvalidFieldError(invalid)
+        return await self.repo.get_page(limit, cursor, fields)
+
+    async def refresh_stages(self, now: datetime | None = None) -> int:
+        if now is None:
+            now = datetime.now(timezone.utc)
+        return await self.repo.refresh_stages(now)
@@ -1,8 +1,13 @@
 from surrealdb import Surreal
-from typing import Protocol, Annotated
+from typing import Protocol, Annotated, Callable, Literal, TypeVar
 from pydantic import BaseModel, Field, EmailStr
 from datetime import datetime
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 from passlib.hash import bcrypt
+import asyncio
+from vote.metrics import instrumented
+
+T = TypeVar('T')
 
 
 def verify_password(
@@ -12,8 +17,81 @@ def verify_password(
     return bcrypt.verify(password, digest)
 
 
-def get_password_digest(password: str):
-    return bcrypt.hash(password)
+def get_password_digest(password: str, rounds: int = 12):
+    return bcrypt.using(rounds=rounds).hash(password)
+
+
+class PasswordConfig(BaseModel):
+    # bcrypt cost factor of new digests, existing ones keep their own
+    rounds: int = 12
+    # run bcrypt in a thread pool or a process pool
+    executor: Literal['thread', 'process'] = 'thread'
+    # max number of passwords hashed / verified at the same time
+    workers: int = 4
+
+
+class PasswordHasherStats(BaseModel):
+    workers: int
+    running: int
+    waiting: int
+    completed: int
+
+
+class PasswordHasher:
+    '''
+    Run bcrypt in a bounded worker pool so it doesn't block the event loop.
+    '''
+
+    def __init__(self, config: PasswordConfig) -> None:
+        self.config = config
+        self._executor: Executor
+        if config.executor == 'process':
+            self._executor = ProcessPoolExecutor(config.workers)
+        else:
+            self._executor = ThreadPoolExecutor(
+                config.workers,
+                thread_name_prefix='bcrypt',
+            )
+        self._sem = asyncio.Semaphore(config.workers)
+        self._running = 0
+        self._waiting = 0
+        self._completed = 0
+
+    async def _run(self, fn: Callable[..., T], *args) -> T:
+        self._waiting += 1
+        try:
+            await self._sem.acquire()
+        finally:
+            self._waiting -= 1
+        self._running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self._running -= 1
+            self._completed += 1
+            self._sem.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(
+            get_password_digest,
+            password,
+            self.config.rounds,
+        )
+
+    async def verify(self, password: str, digest: str) -> bool:
+        return await self._run(verify_password, password, digest)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> PasswordHasherStats:
+        return PasswordHasherStats(
+            workers=self.config.workers,
+            running=self._running,
+            waiting=self._waiting,
+            completed=self._completed,
+        )
 
 
 class User(BaseModel):
@@ -25,6 +103,8 @@ class User(BaseModel):
     last_login_at: datetime | None
     created_at: datetime
     disabled: bool
+    # bumped to revoke all issued tokens
+    token_version: int = 0
 
 
 class SignupUserInput(BaseModel):
@@ -45,13 +125,14 @@ class AddUserInput(BaseModel):
     roles: list[str]
     created_at: datetime
     disabled: bool
+    token_version: int = 0
 
     @classmethod
-    def from_input(cls, input: SignupUserInput):
+    def from_input(cls, input: SignupUserInput, password_digest: str):
         return cls(
             username=input.username,
             email=input.email,
-            password_digest=get_password_digest(input.password),
+            password_digest=password_digest,
             roles=[],
             created_at=datetime.now(),
             disabled=False,
@@ -64,9 +145,9 @@ class AddUserError(Exception):
         self.err = err
 
 
-class InitUserError(Exception):
+class UpdateUserError(Exception):
 
-    def __init__(self, err: list[dict]) -> None:
+    def __init__(self, err: dict) -> None:
         self.err = err
 
 
@@ -78,37 +159,16 @@ class UserRepository(Protocol):
     async def add(self, input: AddUserInput):
         ...
 
+    async def bump_token_version(self, username: str):
+        ...
+
 
+@instrumented('user')
 class UserRepositoryImpl:
 
     def __init__(self, db: Surreal):
         self.db = db
 
-    async def init_db(self):
-        results = await self.db.query('''
-        DEFINE TABLE user;
-        DEFINE FIELD username ON TABLE user TYPE string
-            ASSERT $value != None;
-        DEFINE FIELD email ON TABLE user TYPE string
-            ASSERT $value != None
-            AND is::email($value);
-        DEFINE FIELD password_digest ON TABLE user TYPE string
-            ASSERT $value != None;
-        DEFINE FIELD roles ON TABLE user TYPE array
-            ASSERT $value != None;
-        DEFINE FIELD roles.* ON TABLE user TYPE string;
-        DEFINE FIELD last_login_at ON TABLE user TYPE datetime;
-        DEFINE FIELD created_at ON TABLE user TYPE datetime
-            ASSERT $value != None;
-        DEFINE FIELD disabled ON TABLE user TYPE bool
-            ASSERT $value != None;
-        
-        DEFINE INDEX email_index ON TABLE user COLUMNS email UNIQUE;
-        DEFINE INDEX username_index ON TABLE user COLUMNS username UNIQUE;
-        ''')
-        if not all(r['status'] == 'OK' for r in results):
-            raise InitUserError(results)
-
     async def get_by_username(self, username: str) -> User | None:
         result = await self.db.query(
             'SELECT * FROM user WHERE username = $username',
@@ -129,11 +189,27 @@ class UserRepositoryImpl:
         if result[0]['status'] != 'OK':
             raise AddUserError(result[0])
 
+    async def bump_token_version(self, username: str):
+        result = await self.db.query(
+            '''
+            UPDATE user SET token_version += 1
+                WHERE username = $username;
+            ''',
+            {'username': username},
+        )
+        if result[0]['status'] != 'OK':
+            raise UpdateUserError(result[0])
+
 
 class UserService:
 
-    def __init__(self, repo: UserRepository) -> None:
+    def __init__(
+        self,
+        repo: UserRepository,
+        hasher: PasswordHasher,
+    ) -> None:
         self.repo = repo
+        self.hasher = hasher
 
     async def authenticate_user(
         self,
@@ -143,13 +219,20 @@ class UserService:
         user = await self.get_by_username(username)
         if user is None:
             return None
-        if not verify_password(password, user.password_digest):
+        if not await self.hasher.verify(password, user.password_digest):
             return None
         return user
 
     async def signup(self, input: SignupUserInput):
-        a_input = AddUserInput.from_input(input)
+        digest = await self.hasher.hash(input.password)
+        a_input = AddUserInput.from_input(input, digest)
         await self.repo.add(a_input)
 
     async def get_by_username(self, username: str):
         return await self.repo.get_by_username(username)
+
+    async def revoke_tokens(self, username: str):
+        '''
+        Invalidate all tokens issued to the user so far.
+        '''
+        await self.repo.bump_token_version(username)
@@ -1,8 +1,17 @@
 from typing import Protocol, Annotated
+from enum import Enum
+from collections import Counter
+from datetime import datetime, timezone
 from pydantic import BaseModel, Field
+import asyncio
+import hashlib
+import json
 from vote.domain.user import User
-from vote.domain.topic import Topic, Option
+from vote.domain.topic import Topic, Option, TopicStage, TopicRepository
 from surrealdb import Surreal
+from vote.events import TallyBroker
+from vote.metrics import instrumented
+from vote.singleflight import SingleFlight
 
 
 class Vote(BaseModel):
@@ -17,9 +26,110 @@ class CreateVoteInput(BaseModel):
     option_id: str
 
 
+# the app and DB clocks may differ a bit, wait for the DB to consider a
+# topic ended before freezing its result
+FREEZE_RETRY_DELAY = 0.5
+FREEZE_RETRIES = 20
+
+
+class VoteConfig(BaseModel):
+    # max number of votes written in one transaction by `add_many`
+    batch_size: int = 500
+    # write votes of concurrent `POST /vote/` in one transaction
+    group_commit: bool = False
+    # seconds to collect votes before writing them
+    group_commit_window: float = 0.005
+    # max number of votes written together, written immediately once reached
+    group_commit_size: int = 200
+
+
+class BatchVoteInput(BaseModel):
+    username: str
+    topic_id: str
+    option_id: str
+
+
+class BatchVoteStatus(str, Enum):
+    OK = 'OK'
+    DUPLICATED = 'DUPLICATED'
+    TOPIC_NOT_FOUND = 'TOPIC_NOT_FOUND'
+    NOT_IN_PROGRESS = 'NOT_IN_PROGRESS'
+    INVALID_OPTION = 'INVALID_OPTION'
+    INVALID_INPUT = 'INVALID_INPUT'
+
+
+class BatchVoteResult(BaseModel):
+    index: int
+    status: BatchVoteStatus
+
+
+def result_checksum(topic_id: str, counts: dict[str, int]) -> str:
+    raw = json.dumps([topic_id, sorted(counts.items())], separators=(',', ':'))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class VoteResult(BaseModel):
+    '''
+    Final result of an ended topic, stored once when it ends.
+    '''
+    topic_id: str
+    # vote count of every option, including the ones nobody voted for
+    counts: dict[str, int]
+    total: int
+    # options with the most votes, empty if nobody voted
+    winners: list[str]
+    # of topic id and counts, equal for equal results
+    checksum: str
+    computed_at: datetime
+
+    @classmethod
+    def build(cls, topic: Topic, tally: dict[str, int]) -> 'VoteResult':
+        counts = {o.id: tally.get(o.id, 0) for o in topic.options}
+        total = sum(counts.values())
+        most = max(counts.values(), default=0)
+        return cls(
+            topic_id=topic.id,
+            counts=counts,
+            total=total,
+            winners=[id for id, n in counts.items() if total and n == most],
+            checksum=result_checksum(topic.id, counts),
+            computed_at=datetime.now(timezone.utc),
+        )
+
+
 class DuplicatedVoteError(Exception):
-    # TODO: add param
-    pass
+
+    def __init__(self, username: str, topic_id: str) -> None:
+        self.username = username
+        self.topic_id = topic_id
+
+
+class TopicNotFoundError(Exception):
+
+    def __init__(self, topic_id: str) -> None:
+        self.topic_id = topic_id
+
+
+class TopicNotEndedError(Exception):
+    '''
+    The DB doesn't consider the topic ended yet, its clock may be behind
+    the app's.
+    '''
+
+    def __init__(self, topic_id: str) -> None:
+        self.topic_id = topic_id
+
+
+class VoteNotAllowedError(Exception):
+
+    def __init__(self, stage: TopicStage) -> None:
+        self.stage = stage
+
+
+class InvalidOptionError(Exception):
+
+    def __init__(self, option_id: str) -> None:
+        self.option_id = option_id
 
 
 class AddVoteError(Exception):
@@ -28,12 +138,18 @@ class AddVoteError(Exception):
         self.err = err
 
 
-class InitVoteError(Exception):
+class RecountVoteError(Exception):
 
     def __init__(self, err: list[dict]) -> None:
         self.err = err
 
 
+class SaveVoteResultError(Exception):
+
+    def __init__(self, err: dict) -> None:
+        self.err = err
+
+
 class VoteRepository(Protocol):
 
     async def add(self, username: str, input: CreateVoteInput):
@@ -48,36 +164,123 @@ class VoteRepository(Protocol):
     async def get_all(self) -> list[Vote]:
         ...
 
+    async def get_by_user_and_topic(
+        self,
+        username: str,
+        topic_id: str,
+    ) -> Vote | None:
+        ...
+
+    async def list_by_user(self, username: str) -> list[Vote]:
+        ...
+
+    async def get_tally(self, topic_id: str) -> dict[str, int]:
+        ...
+
+    async def get_final_tally(self, topic: Topic) -> dict[str, int]:
+        ...
+
+    async def recount(self, topic_id: str | None = None):
+        ...
+
+    async def add_many(
+        self,
+        votes: list[BatchVoteInput],
+    ) -> list[BatchVoteStatus]:
+        ...
+
+    async def get_result(self, topic_id: str) -> VoteResult | None:
+        ...
+
+    async def add_result(self, result: VoteResult) -> VoteResult:
+        ...
+
+    async def replace_result(self, result: VoteResult):
+        ...
+
+
+# name of the unique (username, topic_id) index on vote
+DUPLICATED_VOTE_INDEX = 'topic_id_index'
+
+
+def is_duplicated_vote(results: list[dict]) -> bool:
+    return any(f'`{DUPLICATED_VOTE_INDEX}`' in r.get('detail', '')
+               for r in results)
+
+
+# thrown by `closed_guard`
+VOTE_CLOSED = 'VOTE_CLOSED'
+# thrown by `get_final_tally` if the topic hasn't ended by the DB clock
+VOTE_OPEN = 'VOTE_OPEN'
+
+
+def record_key(id: str) -> str:
+    '''
+    Key of a record id, e.g. `abc` of `topic:abc`.
+    '''
+    return id.partition(':')[2]
+
+
+def ends_at_of(topic_key: str) -> str:
+    # read the record directly instead of scanning the table
+    return f"(SELECT VALUE ends_at FROM type::thing('topic', {topic_key}))[0]"
+
+
+def closed_guard(topic_id: str, topic_key: str) -> str:
+    '''
+    Statement which fails the transaction if the topic has ended or its
+    result is stored, `topic_id` and `topic_key` (see `record_key`) are
+    query variables. Votes checked against a topic still in progress may
+    be written after it ends, they would be missing from the stored result.
+    '''
+    return f'''
+    IF time::now() > {ends_at_of(topic_key)}
+        OR (SELECT id FROM type::thing('vote_result', {topic_id})) {{
+        THROW '{VOTE_CLOSED}';
+    }};
+    '''
+
+
+def is_closed_topic(results: list[dict]) -> bool:
+    return any(VOTE_CLOSED in r.get('detail', '') for r in results)
 
+
+def is_open_topic(results: list[dict]) -> bool:
+    return any(VOTE_OPEN in r.get('detail', '') for r in results)
+
+
+@instrumented('vote')
 class VoteRepositoryImpl:
 
     def __init__(self, db: Surreal) -> None:
         self.db = db
 
-    async def init_db(self):
-        results = await self.db.query('''
-        DEFINE TABLE vote;
-        DEFINE FIELD username ON TABLE vote TYPE string
-            ASSERT $value != None;
-        DEFINE FIELD topic_id ON TABLE vote TYPE string
-            ASSERT $value != None;
-        DEFINE FIELD option_id ON TABLE vote TYPE string
-            ASSERT $value != None;
-
-        DEFINE INDEX topic_id_index ON TABLE vote COLUMNS username, topic_id UNIQUE;
-        ''')
-        if not all(r['status'] == 'OK' for r in results):
-            raise InitVoteError(results)
-
     async def add(self, username: str, input: CreateVoteInput):
         input_dict = input.dict()
         input_dict['username'] = username
-        result = await self.db.query(
-            'CREATE vote CONTENT $vote;',
-            {'vote': input_dict},
+        # keep the tally in the same transaction as the vote
+        results = await self.db.query(
+            f'''
+            BEGIN TRANSACTION;
+            {closed_guard('$vote.topic_id', '$topic_key')}
+            CREATE vote CONTENT $vote;
+            UPDATE type::thing('vote_tally', [$vote.topic_id, $vote.option_id])
+                SET topic_id = $vote.topic_id,
+                    option_id = $vote.option_id,
+                    count += 1;
+            COMMIT TRANSACTION;
+            ''',
+            {
+                'vote': input_dict,
+                'topic_key': record_key(input.topic_id),
+            },
         )
-        if result[0]['status'] != 'OK':
-            raise AddVoteError(result[0])
+        if not all(r['status'] == 'OK' for r in results):
+            if is_duplicated_vote(results):
+                raise DuplicatedVoteError(username, input.topic_id)
+            if is_closed_topic(results):
+                raise VoteNotAllowedError(TopicStage.ENDED)
+            raise AddVoteError(results[0])
 
     async def get_by_id(self, id: str) -> Vote | None:
         ...
@@ -88,21 +291,364 @@ class VoteRepositoryImpl:
     async def get_all(self) -> list[Vote]:
         results = await self.db.query('SELECT * FROM vote;')
         vote_records = results[0]['result']
-        print(vote_records)
         return [Vote.parse_obj(v) for v in vote_records]
 
+    async def get_by_user_and_topic(
+        self,
+        username: str,
+        topic_id: str,
+    ) -> Vote | None:
+        results = await self.db.query(
+            '''
+            SELECT * FROM vote
+                WHERE username = $username AND topic_id = $topic_id;
+            ''',
+            {
+                'username': username,
+                'topic_id': topic_id,
+            },
+        )
+        result = results[0]['result']
+        if len(result) == 0:
+            return None
+        return Vote.parse_obj(result[0])
+
+    async def list_by_user(self, username: str) -> list[Vote]:
+        results = await self.db.query(
+            'SELECT * FROM vote WHERE username = $username;',
+            {'username': username},
+        )
+        return [Vote.parse_obj(v) for v in results[0]['result']]
+
+    async def get_tally(self, topic_id: str) -> dict[str, int]:
+        results = await self.db.query(
+            'SELECT option_id, count FROM vote_tally WHERE topic_id = $topic_id;',
+            {'topic_id': topic_id},
+        )
+        return {r['option_id']: r['count'] for r in results[0]['result']}
+
+    async def get_final_tally(self, topic: Topic) -> dict[str, int]:
+        '''
+        Tally of an ended topic once no vote can change it anymore. Votes
+        starting after this are rejected by `closed_guard`, and votes in
+        flight conflict with it, since every tally row of the topic is
+        written here.
+        '''
+        statements = [
+            'BEGIN TRANSACTION;',
+            f'''
+            IF time::now() <= {ends_at_of('$topic_key')} {{
+                THROW '{VOTE_OPEN}';
+            }};
+            ''',
+        ]
+        vars = {'topic_id': topic.id, 'topic_key': record_key(topic.id)}
+        for i, option in enumerate(topic.options):
+            statements.append(f'''
+                UPDATE type::thing('vote_tally', [$topic_id, $o{i}])
+                    SET topic_id = $topic_id, option_id = $o{i}, count += 0;
+                ''')
+            vars[f'o{i}'] = option.id
+        statements.append('COMMIT TRANSACTION;')
+        results = await self.db.query('\n'.join(statements), vars)
+        if not all(r['status'] == 'OK' for r in results):
+            if is_open_topic(results):
+                raise TopicNotEndedError(topic.id)
+            raise SaveVoteResultError(results[0])
+        return {
+            r['result'][0]['option_id']: r['result'][0]['count']
+            for r in results[1:]
+        }
+
+    async def recount(self, topic_id: str | None = None):
+        '''
+        Rebuild tallies from the vote table, for one topic or all of them.
+        Votes cast while recounting may be missed, run it on a quiet topic.
+        '''
+        where = '' if topic_id is None else 'WHERE topic_id = $topic_id'
+        results = await self.db.query(
+            f'''
+            SELECT topic_id, option_id, count() AS count FROM vote {where}
+                GROUP BY topic_id, option_id;
+            ''',
+            {'topic_id': topic_id},
+        )
+        if results[0]['status'] != 'OK':
+            raise RecountVoteError(results)
+        statements = [
+            'BEGIN TRANSACTION;',
+            f'DELETE vote_tally {where};',
+        ]
+        vars = {'topic_id': topic_id}
+        for i, r in enumerate(results[0]['result']):
+            statements.append(f'''
+                UPDATE type::thing('vote_tally', [$t{i}, $o{i}])
+                    SET topic_id = $t{i}, option_id = $o{i}, count = $c{i};
+                ''')
+            vars |= {
+                f't{i}': r['topic_id'],
+                f'o{i}': r['option_id'],
+                f'c{i}': r['count'],
+            }
+        statements.append('COMMIT TRANSACTION;')
+        results = await self.db.query('\n'.join(statements), vars)
+        if not all(r['status'] == 'OK' for r in results):
+            raise RecountVoteError(results)
+
+    async def add_many(
+        self,
+        votes: list[BatchVoteInput],
+    ) -> list[BatchVoteStatus]:
+        '''
+        Add votes in one transaction, return `OK`, `DUPLICATED` or
+        `NOT_IN_PROGRESS` (the topic has ended meanwhile) for each of them.
+        '''
+        topic_ids = list({v.topic_id for v in votes})
+        usernames = list({v.username for v in votes})
+        results = await self.db.query(
+            '''
+            SELECT username, topic_id FROM vote
+                WHERE topic_id INSIDE $topic_ids
+                    AND username INSIDE $usernames;
+            ''',
+            {
+                'topic_ids': topic_ids,
+                'usernames': usernames,
+            },
+        )
+        if results[0]['status'] != 'OK':
+            raise AddVoteError(results[0])
+        voted = {(r['username'], r['topic_id']) for r in results[0]['result']}
+        statuses = []
+        new_votes = []
+        for v in votes:
+            if (v.username, v.topic_id) in voted:
+                statuses.append(BatchVoteStatus.DUPLICATED)
+                continue
+            voted.add((v.username, v.topic_id))
+            statuses.append(BatchVoteStatus.OK)
+            new_votes.append(v)
+        if not new_votes:
+            return statuses
+        statements = ['BEGIN TRANSACTION;']
+        vars = {'votes': [v.dict() for v in new_votes]}
+        for i, topic_id in enumerate({v.topic_id for v in new_votes}):
+            statements.append(closed_guard(f'$topic{i}', f'$key{i}'))
+            vars[f'topic{i}'] = topic_id
+            vars[f'key{i}'] = record_key(topic_id)
+        statements.append('INSERT INTO vote $votes;')
+        tally = Counter((v.topic_id, v.option_id) for v in new_votes)
+        for i, ((topic_id, option_id), n) in enumerate(tally.items()):
+            statements.append(f'''
+                UPDATE type::thing('vote_tally', [$t{i}, $o{i}])
+                    SET topic_id = $t{i}, option_id = $o{i}, count += $n{i};
+                ''')
+            vars |= {f't{i}': topic_id, f'o{i}': option_id, f'n{i}': n}
+        statements.append('COMMIT TRANSACTION;')
+        results = await self.db.query('\n'.join(statements), vars)
+        if all(r['status'] == 'OK' for r in results):
+            return statuses
+        if not is_duplicated_vote(results) and not is_closed_topic(results):
+            raise AddVoteError(results[0])
+        # someone voted concurrently or a topic has ended, fallback to one
+        # by one
+        for i, v in enumerate(votes):
+            if statuses[i] != BatchVoteStatus.OK:
+                continue
+            input = CreateVoteInput(topic_id=v.topic_id, option_id=v.option_id)
+            try:
+                await self.add(v.username, input)
+            except DuplicatedVoteError:
+                statuses[i] = BatchVoteStatus.DUPLICATED
+            except VoteNotAllowedError:
+                statuses[i] = BatchVoteStatus.NOT_IN_PROGRESS
+        return statuses
+
+    async def get_result(self, topic_id: str) -> VoteResult | None:
+        results = await self.db.query(
+            "SELECT * FROM type::thing('vote_result', $topic_id);",
+            {'topic_id': topic_id},
+        )
+        result = results[0]['result']
+        if len(result) == 0:
+            return None
+        return VoteResult.parse_obj(result[0])
+
+    async def add_result(self, result: VoteResult) -> VoteResult:
+        '''
+        Store a result unless the topic already has one, and return the
+        stored one.
+        '''
+        content = result.dict()
+        content['computed_at'] = content['computed_at'].isoformat()
+        results = await self.db.query(
+            "CREATE type::thing('vote_result', $result.topic_id) CONTENT $result;",
+            {'result': content},
+        )
+        if results[0]['status'] == 'OK':
+            return result
+        stored = await self.get_result(result.topic_id)
+        if stored is None:
+            raise SaveVoteResultError(results[0])
+        return stored
+
+    async def replace_result(self, result: VoteResult):
+        content = result.dict()
+        content['computed_at'] = content['computed_at'].isoformat()
+        results = await self.db.query(
+            "UPDATE type::thing('vote_result', $result.topic_id) CONTENT $result;",
+            {'result': content},
+        )
+        if results[0]['status'] != 'OK':
+            raise SaveVoteResultError(results[0])
+
 
 class VoteService:
 
-    def __init__(self, repo: VoteRepository) -> None:
+    def __init__(
+        self,
+        repo: VoteRepository,
+        topic_repo: TopicRepository,
+        events: TallyBroker | None = None,
+        config: VoteConfig = VoteConfig(),
+        flight: SingleFlight | None = None,
+    ) -> None:
         self.repo = repo
+        self.topic_repo = topic_repo
+        self.events = events
+        self.config = config
+        self.flight = flight
 
     async def get_all(self) -> list[Vote]:
         return await self.repo.get_all()
 
+    async def get_by_user_and_topic(
+        self,
+        username: str,
+        topic_id: str,
+    ) -> Vote | None:
+        return await self.repo.get_by_user_and_topic(username, topic_id)
+
+    async def list_by_user(self, username: str) -> list[Vote]:
+        return await self.repo.list_by_user(username)
+
+    async def get_tally(self, topic_id: str) -> dict[str, int]:
+        '''
+        Vote count of each option which has been voted.
+        '''
+        if self.flight is None:
+            return await self.repo.get_tally(topic_id)
+        tally = await self.flight.do(
+            'vote.get_tally',
+            topic_id,
+            lambda: self.repo.get_tally(topic_id),
+        )
+        return dict(tally)
+
+    async def freeze_result(self, topic: Topic) -> VoteResult:
+        '''
+        Store the result of an ended topic. It's kept as is afterwards, even
+        if called again.
+        '''
+        for attempt in range(FREEZE_RETRIES):
+            try:
+                tally = await self.repo.get_final_tally(topic)
+                break
+            except TopicNotEndedError:
+                if attempt == FREEZE_RETRIES - 1:
+                    raise
+                await asyncio.sleep(FREEZE_RETRY_DELAY)
+        return await self.repo.add_result(VoteResult.build(topic, tally))
+
+    async def get_result(self, topic: Topic) -> VoteResult:
+        '''
+        Result of an ended topic. Topics which ended while the app was down
+        don't have one yet, it's stored on the first read.
+        '''
+        if self.flight is None:
+            return await self._get_result(topic)
+        return await self.flight.do(
+            'vote.get_result',
+            topic.id,
+            lambda: self._get_result(topic),
+        )
+
+    async def _get_result(self, topic: Topic) -> VoteResult:
+        result = await self.repo.get_result(topic.id)
+        if result is None:
+            result = await self.freeze_result(topic)
+        return result
+
+    async def recompute_result(
+        self,
+        topic: Topic,
+    ) -> tuple[VoteResult, VoteResult | None]:
+        '''
+        Recount votes of an ended topic and replace its stored result.
+        Return the new result and the replaced one, for audits.
+        '''
+        old = await self.repo.get_result(topic.id)
+        await self.repo.recount(topic.id)
+        tally = await self.repo.get_tally(topic.id)
+        result = VoteResult.build(topic, tally)
+        await self.repo.replace_result(result)
+        return result, old
+
+    async def recount(self, topic_id: str | None = None):
+        await self.repo.recount(topic_id)
+
     async def add(self, username: str, input: CreateVoteInput):
-        votes = await self.repo.get_all()
-        if any(v.username == username and v.topic_id == input.topic_id
-               for v in votes):
-            raise DuplicatedVoteError()
+        '''
+        Cast a vote. Duplicated votes are rejected by the unique index
+        instead of a lookup, so concurrent requests can't both succeed.
+        '''
+        topic = await self.topic_repo.get_by_id(input.topic_id)
+        if topic is None:
+            raise TopicNotFoundError(input.topic_id)
+        if topic.stage != TopicStage.IN_PROGRESS:
+            raise VoteNotAllowedError(topic.stage)
+        if all(o.id != input.option_id for o in topic.options):
+            raise InvalidOptionError(input.option_id)
         await self.repo.add(username, input)
+        if self.events is not None:
+            self.events.publish(input.topic_id, input.option_id)
+
+    async def add_many(
+        self,
+        inputs: list[BatchVoteInput],
+    ) -> list[BatchVoteResult]:
+        '''
+        Import votes cast somewhere else, e.g. paper ballots. Each topic is
+        only loaded once, valid votes are written in chunks.
+        '''
+        topics: dict[str, Topic | None] = {}
+        for topic_id in {v.topic_id for v in inputs}:
+            topics[topic_id] = await self.topic_repo.get_by_id(topic_id)
+        results = []
+        valid: list[tuple[int, BatchVoteInput]] = []
+        seen: set[tuple[str, str]] = set()
+        for i, v in enumerate(inputs):
+            topic = topics[v.topic_id]
+            if (v.username, v.topic_id) in seen:
+                status = BatchVoteStatus.DUPLICATED
+            elif topic is None:
+                status = BatchVoteStatus.TOPIC_NOT_FOUND
+            elif topic.stage != TopicStage.IN_PROGRESS:
+                status = BatchVoteStatus.NOT_IN_PROGRESS
+            elif all(o.id != v.option_id for o in topic.options):
+                status = BatchVoteStatus.INVALID_OPTION
+            else:
+                seen.add((v.username, v.topic_id))
+                valid.append((i, v))
+                continue
+            results.append(BatchVoteResult(index=i, status=status))
+        size = self.config.batch_size
+        for start in range(0, len(valid), size):
+            chunk = valid[start:start + size]
+            statuses = await self.repo.add_many([v for _, v in chunk])
+            for (i, v), status in zip(chunk, statuses):
+                results.append(BatchVoteResult(index=i, status=status))
+                if status == BatchVoteStatus.OK and self.events is not None:
+                    self.events.publish(v.topic_id, v.option_id)
+        results.sort(key=lambda r: r.index)
+        return results
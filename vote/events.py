@@ -0,0 +1,106 @@
+from typing import Callable, Iterator
+from contextlib import contextmanager
+from pydantic import BaseModel
+import asyncio
+
+
+class StreamConfig(BaseModel):
+    # min seconds between two pushed deltas, votes in between are merged
+    min_interval: float = 0.2
+    # seconds between two keep-alive comments
+    heartbeat: float = 15.0
+    # seconds between two full tallies read from DB, this also covers
+    # votes cast by other processes
+    resync_interval: float = 30.0
+
+
+class TallyBrokerStats(BaseModel):
+    topics: int
+    subscribers: int
+    published: int
+
+
+class TallyChannel:
+    '''
+    Vote counts of one topic since the channel was opened. Subscribers
+    diff `counts` with what they have seen, so a slow subscriber gets one
+    merged delta instead of a growing backlog.
+    '''
+
+    def __init__(self) -> None:
+        self.counts: dict[str, int] = {}
+        self.version = 0
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+
+    def publish(self, option_id: str, delta: int = 1):
+        self.counts[option_id] = self.counts.get(option_id, 0) + delta
+        self.version += 1
+        # wake up all current waiters
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self, version: int):
+        '''
+        Wait until there is something newer than `version`.
+        '''
+        if self.version == version:
+            await self._changed.wait()
+
+    def diff(self, seen: dict[str, int]) -> dict[str, int]:
+        '''
+        Counts changed since `seen`, `seen` is updated inplace.
+        '''
+        delta = {}
+        for option_id, count in self.counts.items():
+            d = count - seen.get(option_id, 0)
+            if d:
+                delta[option_id] = d
+                seen[option_id] = count
+        return delta
+
+
+class TallyBroker:
+    '''
+    In-process fan-out of vote counts, one channel per watched topic.
+    '''
+
+    def __init__(self) -> None:
+        self._channels: dict[str, TallyChannel] = {}
+        self._published = 0
+        # called with every published vote, e.g. to tell other processes
+        self.on_publish: Callable[[str, str, int], None] | None = None
+
+    def publish(
+        self,
+        topic_id: str,
+        option_id: str,
+        delta: int = 1,
+        notify: bool = True,
+    ):
+        if notify and self.on_publish is not None:
+            self.on_publish(topic_id, option_id, delta)
+        channel = self._channels.get(topic_id)
+        if channel is not None:
+            channel.publish(option_id, delta)
+            self._published += 1
+
+    @contextmanager
+    def subscribe(self, topic_id: str) -> Iterator[TallyChannel]:
+        channel = self._channels.get(topic_id)
+        if channel is None:
+            channel = self._channels[topic_id] = TallyChannel()
+        channel.subscribers += 1
+        try:
+            yield channel
+        finally:
+            channel.subscribers -= 1
+            if channel.subscribers == 0:
+                del self._channels[topic_id]
+
+    def stats(self) -> TallyBrokerStats:
+        return TallyBrokerStats(
+            topics=len(self._channels),
+            subscribers=sum(c.subscribers for c in self._channels.values()),
+            published=self._published,
+        )
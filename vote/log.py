@@ -0,0 +1,135 @@
+'''
+Structured logging. Records carry the id of the request they belong to,
+and are written by a background thread so the event loop never blocks
+on stderr.
+'''
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Literal
+from pydantic import BaseModel
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+
+# id of the request being handled, `None` in background tasks
+request_id: ContextVar[str | None] = ContextVar('request_id', default=None)
+
+# parameter names whose values never go into logs
+SENSITIVE_KEYS = frozenset({
+    'password',
+    'password_digest',
+    'secret_key',
+    'token',
+    'access_token',
+})
+# longer strings / collections are summarized
+MAX_VALUE_LENGTH = 64
+
+
+class LogConfig(BaseModel):
+    level: str = 'INFO'
+    # "json" for log collectors, "text" for humans
+    format: Literal['json', 'text'] = 'json'
+    # log every request with its status and duration
+    access: bool = True
+
+
+def redact(value: Any, key: str | None = None) -> Any:
+    '''
+    Make query parameters safe and small enough to log.
+    '''
+    if key is not None and key in SENSITIVE_KEYS:
+        return '***'
+    if isinstance(value, dict):
+        return {k: redact(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        if len(value) > 8:
+            return f'<{type(value).__name__} of {len(value)}>'
+        return [redact(v) for v in value]
+    if isinstance(value, str) and len(value) > MAX_VALUE_LENGTH:
+        return value[:MAX_VALUE_LENGTH] + '...'
+    return value
+
+
+class RequestIdFilter(logging.Filter):
+    '''
+    Capture the request id in the thread which logs the record.
+    '''
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    '''
+    Format records with their `extra={'fields': {...}}` as a JSON object
+    or a `key=value` line.
+    '''
+
+    def __init__(self, format: Literal['json', 'text']) -> None:
+        super().__init__()
+        self.format_type = format
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, 'fields', {})
+        ts = datetime.fromtimestamp(record.created, timezone.utc)
+        rid = getattr(record, 'request_id', None)
+        if self.format_type == 'json':
+            entry = {
+                'ts': ts.isoformat(),
+                'level': record.levelname,
+                'logger': record.name,
+                'msg': record.getMessage(),
+                'request_id': rid,
+                **fields,
+            }
+            if record.exc_info:
+                entry['exc'] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        line = (f'{ts.isoformat()} {record.levelname} {record.name} '
+                f'[{rid or "-"}] {record.getMessage()}')
+        if fields:
+            pairs = (f'{k}={json.dumps(v, default=str)}'
+                     for k, v in fields.items())
+            line += ' ' + ' '.join(pairs)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+_listener: logging.handlers.QueueListener | None = None
+_handler: logging.Handler | None = None
+
+
+def setup_logging(config: LogConfig):
+    '''
+    Route all records through a queue to a stderr writer thread. Safe to
+    call again, the previous setup is replaced.
+    '''
+    global _listener, _handler
+    root = logging.getLogger()
+    if _listener is not None:
+        _listener.stop()
+        root.removeHandler(_handler)
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(q)
+    # QueueHandler formats before enqueueing, the writer prints as is
+    handler.setFormatter(StructuredFormatter(config.format))
+    handler.addFilter(RequestIdFilter())
+    writer = logging.StreamHandler()
+    writer.setFormatter(logging.Formatter('%(message)s'))
+    listener = logging.handlers.QueueListener(q, writer)
+    listener.start()
+    root.addHandler(handler)
+    root.setLevel(config.level)
+    if _listener is None:
+        atexit.register(_stop)
+    _listener, _handler = listener, handler
+
+
+def _stop():
+    if _listener is not None:
+        _listener.stop()
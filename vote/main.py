@@ -1,5 +1,9 @@
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, Request, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+import asyncio
+import signal
 from vote.api import (
     user,
     auth,
@@ -7,26 +11,163 @@ from vote.api import (
     topic,
     healthz,
     comment,
+    metrics,
 )
+from vote.api import (
+    acquire_topic_repository,
+    acquire_vote_repository,
+    freeze_results,
+    warm_up_topic_cache,
+)
+from vote.api.metrics import MetricsMiddleware, collect_metrics
+from vote.api.tracing import TracingMiddleware
+from vote.api.admission import Admission, AdmissionMiddleware
+from vote.api.serialization import FastJSONResponse
+from vote.config import get_vote_config, reload_vote_config, watch_vote_config
 from vote.api.auth import get_current_user
-from vote.domain.user import User
+from vote.db import SurrealPool, PoolTimeoutError, create_pool, migrate
+from vote.cache import TTLCache
+from vote.scheduler import StageScheduler
+from vote.events import TallyBroker
+from vote.singleflight import SingleFlight
+from vote.writer import VoteWriter
+from vote.broadcast import Broadcast, share_cache, share_tallies
+from vote.metrics import LoopLagMonitor, SharedMetrics
+from vote.log import setup_logging
+from vote.domain.user import User, PasswordHasher
 from typing import Annotated
 
 
-def create_app():
-    app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    cfg = get_vote_config()
+    pool = create_pool(cfg.db)
+    await pool.open()
+    if app.state.run_migrations and isinstance(pool, SurrealPool):
+        async with pool.acquire() as db:
+            await migrate(db)
+    app.state.db_pool = pool
+    hasher = PasswordHasher(cfg.password)
+    app.state.password_hasher = hasher
+    app.state.topic_cache = TTLCache(
+        cfg.cache.topic_size,
+        cfg.cache.topic_ttl,
+    )
+    app.state.token_cache = TTLCache(
+        cfg.auth.cache_size,
+        cfg.auth.cache_ttl,
+    )
+    app.state.user_cache = TTLCache(
+        cfg.auth.cache_size,
+        cfg.auth.cache_ttl,
+    )
+    app.state.tally_broker = TallyBroker()
+    app.state.single_flight = SingleFlight()
+    broadcast = None
+    if cfg.server.workers != 1:
+        broadcast = Broadcast(cfg.server.broadcast_dir)
+        await broadcast.open()
+        share_cache(broadcast, 'topic', app.state.topic_cache)
+        share_cache(broadcast, 'user', app.state.user_cache)
+        share_tallies(broadcast, app.state.tally_broker)
+    app.state.broadcast = broadcast
+    writer = None
+    if cfg.vote.group_commit:
+        writer = VoteWriter(
+            lambda: acquire_vote_repository(app),
+            cfg.vote.group_commit_window,
+            cfg.vote.group_commit_size,
+        )
+        writer.start()
+    app.state.vote_writer = writer
+    loop_monitor = LoopLagMonitor(cfg.metrics.loop_lag_interval)
+    loop_monitor.start()
+    app.state.loop_monitor = loop_monitor
+    shared_metrics = None
+    if broadcast is not None:
+        # scrapes land on any worker
+        shared_metrics = SharedMetrics(
+            cfg.server.broadcast_dir,
+            cfg.metrics.share_interval,
+            lambda: collect_metrics(app),
+        )
+        shared_metrics.start()
+    app.state.shared_metrics = shared_metrics
+
+    scheduler = StageScheduler(
+        lambda: acquire_topic_repository(app),
+        lambda topics: freeze_results(app, topics),
+    )
+    await scheduler.start()
+    app.state.stage_scheduler = scheduler
+    # requests are only accepted after startup, so do it here. Afterwards
+    # topics are read through the cache as usual.
+    warm_topics = min(cfg.server.warmup_topics, cfg.cache.topic_size)
+    await warm_up_topic_cache(app, warm_topics)
+    loop = asyncio.get_running_loop()
+    if cfg.reload.sighup:
+        loop.add_signal_handler(signal.SIGHUP, reload_vote_config)
+    watcher = None
+    if cfg.reload.watch:
+        watcher = asyncio.create_task(watch_vote_config(cfg.reload.interval))
+    app.state.ready = True
+    try:
+        yield
+    finally:
+        app.state.ready = False
+        if watcher is not None:
+            watcher.cancel()
+        if cfg.reload.sighup:
+            loop.remove_signal_handler(signal.SIGHUP)
+        await scheduler.stop()
+        if writer is not None:
+            await writer.stop()
+        if shared_metrics is not None:
+            await shared_metrics.stop()
+        await loop_monitor.stop()
+        if broadcast is not None:
+            await broadcast.close()
+        await pool.close()
+        hasher.close()
+
+
+async def pool_timeout_handler(request: Request, exc: PoolTimeoutError):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={'detail': 'Database is busy'},
+        headers={'Retry-After': str(max(1, round(exc.timeout)))},
+    )
+
+
+def create_app(run_migrations: bool = True):
+    '''
+    Pending migrations are run on startup unless `run_migrations` is off,
+    e.g. when `python -m vote.cli serve` has run them already.
+    '''
+    cfg = get_vote_config()
+    setup_logging(cfg.log)
+    app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+    app.state.run_migrations = run_migrations
+    app.add_exception_handler(PoolTimeoutError, pool_timeout_handler)
+    app.state.admission = Admission(cfg.admission)
+    # inside CORS, so rejections still have CORS headers
+    app.add_middleware(AdmissionMiddleware, admission=app.state.admission)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=['*'],
         allow_methods=['*'],
         allow_credentials=True,
     )
+    app.add_middleware(MetricsMiddleware)
+    # outermost, so logs of the other middlewares have the request id
+    app.add_middleware(TracingMiddleware, access_log=cfg.log.access)
     app.include_router(auth.router, prefix='/auth')
     app.include_router(user.router, prefix='/user')
     app.include_router(vote.router, prefix='/vote')
     app.include_router(topic.router, prefix='/topic')
     app.include_router(healthz.router, prefix='/healthz')
     app.include_router(comment.router, prefix='/comment')
+    app.include_router(metrics.router, prefix='/metrics')
 
     @app.get('/me')
     async def get_me(user: Annotated[
@@ -36,3 +177,10 @@ def create_app():
         return user
 
     return app
+
+
+def create_worker_app():
+    '''
+    App of the workers started by `python -m vote.cli serve`.
+    '''
+    return create_app(run_migrations=False)
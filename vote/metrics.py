@@ -0,0 +1,417 @@
+'''
+Minimal Prometheus metrics, rendered in the text exposition format.
+Counters and histograms are process-wide like the ones of
+`prometheus_client`, gauges are read from app state when scraped.
+'''
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Iterable
+from pydantic import BaseModel
+import asyncio
+import inspect
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# latency buckets in seconds
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class MetricsConfig(BaseModel):
+    # seconds between two event loop lag samples
+    loop_lag_interval: float = 0.5
+    # with several workers, seconds between two snapshots of a worker's
+    # metrics written for the others to serve
+    share_interval: float = 5.0
+
+
+def _escape(value: str) -> str:
+    value = value.replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"')
+
+
+# added to every series, see `set_const_labels`
+_const_labels = ''
+
+
+def set_const_labels(**labels: str):
+    '''
+    Labels of every series of this process, e.g. the worker when several
+    workers serve one port.
+    '''
+    global _const_labels
+    _const_labels = ','.join(f'{n}="{_escape(v)}"' for n, v in labels.items())
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if _const_labels:
+        pairs.append(_const_labels)
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+
+    type = 'untyped'
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labels: tuple[str, ...] = (),
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def header(self) -> list[str]:
+        return [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        return self.header() + self.samples()
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labels: tuple[str, ...] = (),
+    ) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [
+            f'{self.name}{_labels(self.labels, k)} {_number(v)}'
+            for k, v in self._values.items()
+        ]
+
+
+class Gauge(Metric):
+    '''
+    Values are set right before rendering, see `render_metrics`.
+    '''
+
+    type = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        values: dict[tuple, float] | None = None,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.values = values or {}
+
+    def samples(self) -> list[str]:
+        return [
+            f'{self.name}{_labels(self.labels, k)} {_number(v)}'
+            for k, v in self.values.items()
+        ]
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # per label values: count of each bucket (not cumulative), sum
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = ([0] * (len(self.buckets) + 1),
+                                            [0.0])
+        counts, total = entry
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for k, (counts, total) in self._values.items():
+            cumulative = 0
+            for le, n in zip((*self.buckets, float('inf')), counts):
+                cumulative += n
+                le = _labels(self.labels, k, f'le="{_number(le)}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            labels = _labels(self.labels, k)
+            lines.append(f'{self.name}_sum{labels} {_number(total[0])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+# header and samples of each metric by name
+Snapshot = dict[str, tuple[list[str], list[str]]]
+
+
+def snapshot(metrics: Iterable[Metric]) -> Snapshot:
+    return {m.name: (m.header(), m.samples()) for m in metrics}
+
+
+def render_metrics(
+        metrics: Iterable[Metric],
+        others: Iterable[Snapshot] = (),
+) -> str:
+    '''
+    Render metrics of this process, samples of the same metrics of other
+    processes are put under the same header.
+    '''
+    merged = snapshot(metrics)
+    for other in others:
+        for name, (header, samples) in other.items():
+            if name in merged:
+                merged[name][1].extend(samples)
+            else:
+                merged[name] = (header, list(samples))
+    lines = []
+    for header, samples in merged.values():
+        lines.extend(header)
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+HTTP_REQUESTS = Counter(
+    'vote_http_requests_total',
+    'HTTP requests by route template and status code.',
+    ('method', 'route', 'status'),
+)
+HTTP_REQUEST_DURATION = Histogram(
+    'vote_http_request_duration_seconds',
+    'HTTP request latency by route template and status code.',
+    ('method', 'route', 'status'),
+)
+DB_QUERY_DURATION = Histogram(
+    'vote_db_query_duration_seconds',
+    'DB query latency by repository operation.',
+    ('operation', ),
+)
+DB_QUERY_ERRORS = Counter(
+    'vote_db_query_errors_total',
+    'DB queries which raised or returned an error status.',
+    ('operation', ),
+)
+EVENT_LOOP_LAG = Histogram(
+    'vote_event_loop_lag_seconds',
+    'How late the event loop wakes up a sleeping task.',
+)
+VOTE_WRITER_BATCH_SIZE = Histogram(
+    'vote_writer_batch_size',
+    'Votes written in one group commit transaction.',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+ADMISSION_REJECTED = Counter(
+    'vote_admission_rejected_total',
+    'Requests rejected by admission control, by reason and priority.',
+    ('reason', 'priority'),
+)
+SINGLE_FLIGHT_CALLS = Counter(
+    'vote_single_flight_calls_total',
+    'Reads which went through single-flight, by operation.',
+    ('operation', ),
+)
+SINGLE_FLIGHT_COALESCED = Counter(
+    'vote_single_flight_coalesced_total',
+    'Reads which got the result of a concurrent identical read.',
+    ('operation', ),
+)
+
+# repository operation of the running query, e.g. `vote.get_all`
+db_operation: ContextVar[str] = ContextVar('db_operation', default='other')
+
+
+def instrumented(prefix: str, timed: bool = False):
+    '''
+    Label queries of every public coroutine method of a repository class
+    with `<prefix>.<method>`. With `timed`, each call is also recorded as
+    one query, for backends which don't send queries through
+    `InstrumentedSurreal`.
+    '''
+
+    def wrap(name: str, fn):
+
+        @wraps(fn)
+        async def method(*args, **kwargs):
+            token = db_operation.set(name)
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                if timed:
+                    DB_QUERY_ERRORS.inc(name)
+                raise
+            finally:
+                if timed:
+                    DB_QUERY_DURATION.observe(
+                        time.perf_counter() - start,
+                        name,
+                    )
+                db_operation.reset(token)
+
+        return method
+
+    def decorate(cls):
+        for name, fn in list(vars(cls).items()):
+            if name.startswith('_') or not inspect.iscoroutinefunction(fn):
+                continue
+            setattr(cls, name, wrap(f'{prefix}.{name}', fn))
+        return cls
+
+    return decorate
+
+
+class LoopLagMonitor:
+    '''
+    Sleep for `interval` repeatedly, and record how much longer than that
+    it actually took. Large lags mean something blocks the event loop.
+    '''
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.lag = 0.0
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, time.perf_counter() - start - self.interval)
+            EVENT_LOOP_LAG.observe(self.lag)
+
+
+class SharedMetrics:
+    '''
+    Metrics of the workers of one server. Each worker writes a snapshot of
+    its metrics to `{directory}/{pid}.metrics` every `interval` seconds,
+    so a scrape of any worker can return all of them, told apart by the
+    `worker` label. Snapshots of the other workers are up to `interval`
+    seconds old.
+    '''
+
+    def __init__(
+        self,
+        directory: str,
+        interval: float,
+        collect: Callable[[], Iterable[Metric]],
+    ) -> None:
+        self.directory = directory
+        self.interval = interval
+        self.collect = collect
+        self.path = os.path.join(directory, f'{os.getpid()}.metrics')
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        set_const_labels(worker=str(os.getpid()))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def others(self) -> list[Snapshot]:
+        '''
+        Latest snapshots of the other workers.
+        '''
+        snapshots = []
+        # older ones are left by workers which crashed
+        stale_at = time.time() - 3 * self.interval
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.metrics') or path == self.path:
+                continue
+            try:
+                if os.stat(path).st_mtime < stale_at:
+                    os.unlink(path)
+                    continue
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # removed by its worker meanwhile
+                continue
+        return snapshots
+
+    def _write(self):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(snapshot(self.collect()), f)
+        # readers never see a partial file
+        os.replace(tmp, self.path)
+
+    async def _run(self):
+        while True:
+            try:
+                self._write()
+            except Exception:
+                logger.exception('failed to write metrics snapshot')
+            await asyncio.sleep(self.interval)
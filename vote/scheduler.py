@@ -0,0 +1,121 @@
+from typing import AsyncContextManager, Awaitable, Callable
+from datetime import datetime, timezone
+import asyncio
+import heapq
+import logging
+import time
+from vote.domain.topic import Topic, TopicRepository, TopicStage
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait before retrying a failed refresh
+RETRY_DELAY = 1.0
+
+
+class StageScheduler:
+    '''
+    Move topics to their next stage right at `starts_at` / `ends_at`.
+    Upcoming deadlines are kept in a min-heap so stages are only
+    refreshed when some topic actually changes. `on_ended` is called with
+    topics which have just ended.
+    '''
+
+    def __init__(
+        self,
+        open_repo: Callable[[], AsyncContextManager[TopicRepository]],
+        on_ended: Callable[[list[Topic]], Awaitable[None]] | None = None,
+    ) -> None:
+        self.open_repo = open_repo
+        self.on_ended = on_ended
+        self._heap: list[tuple[float, str]] = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def schedule(
+        self,
+        topic_id: str,
+        starts_at: datetime,
+        ends_at: datetime,
+    ):
+        '''
+        Add deadlines of a created / updated topic. Outdated deadlines can
+        be left in the heap, the topic is just refreshed again. Deadlines
+        which have passed already are due right away.
+        '''
+        now = time.time()
+        for at in (starts_at, ends_at):
+            heapq.heappush(self._heap, (max(at.timestamp(), now), topic_id))
+        self._wakeup.set()
+
+    async def rebuild(self):
+        '''
+        Load deadlines of all topics, outdated stages are refreshed
+        immediately.
+        '''
+        async with self.open_repo() as repo:
+            await repo.refresh_stages(datetime.now(timezone.utc))
+            topics = await repo.get_all()
+        now = time.time()
+        heap = []
+        for t in topics:
+            for at in (t.starts_at, t.ends_at):
+                if at.timestamp() > now:
+                    heap.append((at.timestamp(), t.id))
+        heapq.heapify(heap)
+        self._heap = heap
+        self._wakeup.set()
+
+    async def start(self):
+        await self.rebuild()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def _pop_due(self) -> set[str]:
+        now = time.time()
+        due = set()
+        while self._heap and self._heap[0][0] <= now:
+            due.add(heapq.heappop(self._heap)[1])
+        return due
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = None
+            if self._heap:
+                timeout = max(0, self._heap[0][0] - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            due = self._pop_due()
+            if not due:
+                continue
+            try:
+                await self._refresh(due)
+            except Exception:
+                logger.exception('failed to refresh topic stages')
+                retry_at = time.time() + RETRY_DELAY
+                for topic_id in due:
+                    heapq.heappush(self._heap, (retry_at, topic_id))
+
+    async def _refresh(self, due: set[str]):
+        ended = []
+        async with self.open_repo() as repo:
+            await repo.refresh_stages(datetime.now(timezone.utc))
+            if self.on_ended is None:
+                return
+            for topic_id in due:
+                topic = await repo.get_by_id(topic_id)
+                if topic is not None and topic.stage == TopicStage.ENDED:
+                    ended.append(topic)
+        if ended:
+            await self.on_ended(ended)
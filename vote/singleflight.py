@@ -0,0 +1,65 @@
+'''
+Coalesce concurrent identical reads into one call.
+'''
+from typing import Awaitable, Callable, Hashable, TypeVar
+import asyncio
+from vote.metrics import SINGLE_FLIGHT_CALLS, SINGLE_FLIGHT_COALESCED
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+    '''
+    While a call of `op` with some key is running, other callers with the
+    same key wait for its result (or exception) instead of calling again.
+
+    The first caller runs the call in its own task, so it keeps using the
+    DB connection of its own request. If it's cancelled, one of the
+    waiting callers runs the call again.
+    '''
+
+    def __init__(self) -> None:
+        self._calls: dict[tuple[str, Hashable], asyncio.Future] = {}
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(
+        self,
+        op: str,
+        key: Hashable,
+        fn: Callable[[], Awaitable[T]],
+    ) -> T:
+        SINGLE_FLIGHT_CALLS.inc(op)
+        k = (op, key)
+        while (call := self._calls.get(k)) is not None:
+            try:
+                # don't let cancellation of this caller cancel the call
+                result = await asyncio.shield(call)
+            except asyncio.CancelledError:
+                if not call.cancelled():
+                    raise
+                # the caller running it was cancelled, run it again
+                continue
+            except Exception:
+                SINGLE_FLIGHT_COALESCED.inc(op)
+                raise
+            SINGLE_FLIGHT_COALESCED.inc(op)
+            return result
+        call = asyncio.get_running_loop().create_future()
+        self._calls[k] = call
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except Exception as e:
+            call.set_exception(e)
+            # mark it retrieved, nobody may be waiting
+            call.exception()
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            del self._calls[k]
@@ -0,0 +1,209 @@
+'''
+Group commit of votes: many `POST /vote/` share one transaction.
+'''
+from typing import AsyncContextManager, Callable
+import asyncio
+import logging
+from vote.domain.vote import (
+    Vote,
+    CreateVoteInput,
+    BatchVoteInput,
+    BatchVoteStatus,
+    DuplicatedVoteError,
+    VoteNotAllowedError,
+    VoteRepository,
+    VoteResult,
+)
+from vote.domain.topic import Topic, TopicStage
+from vote.metrics import VOTE_WRITER_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait before reconnecting after a failed write
+RETRY_DELAY = 1.0
+
+
+class VoteWriter:
+    '''
+    Collect votes for up to `window` seconds or `size` votes, and write
+    them in one transaction with `VoteRepository.add_many`. Each caller
+    gets the result of its own vote.
+
+    The writer keeps its own connection, so requests holding all the
+    other connections can't starve it.
+    '''
+
+    def __init__(
+        self,
+        open_repo: Callable[[], AsyncContextManager[VoteRepository]],
+        window: float,
+        size: int,
+    ) -> None:
+        self.open_repo = open_repo
+        self.window = window
+        self.size = size
+        self._pending: list[tuple[BatchVoteInput, asyncio.Future]] = []
+        self._arrived = asyncio.Event()
+        self._full = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task | None = None
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        '''
+        Stop collecting, and write votes which are still pending. A write
+        in progress isn't interrupted, its votes may be committed already.
+        '''
+        if self._task is None:
+            return
+        self._stopping = True
+        # wake it up without waiting for the window
+        self._arrived.set()
+        self._full.set()
+        await self._task
+        self._task = None
+
+    async def add(self, username: str, input: CreateVoteInput):
+        '''
+        Same as `VoteRepository.add`, wait until the vote is written.
+        '''
+        vote = BatchVoteInput(
+            username=username,
+            topic_id=input.topic_id,
+            option_id=input.option_id,
+        )
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((vote, future))
+        self._arrived.set()
+        if len(self._pending) >= self.size:
+            self._full.set()
+        status = await future
+        if status == BatchVoteStatus.DUPLICATED:
+            raise DuplicatedVoteError(username, input.topic_id)
+        if status == BatchVoteStatus.NOT_IN_PROGRESS:
+            raise VoteNotAllowedError(TopicStage.ENDED)
+
+    async def _run(self):
+        while True:
+            try:
+                async with self.open_repo() as repo:
+                    while self._pending or not self._stopping:
+                        await self._arrived.wait()
+                        if (len(self._pending) < self.size
+                                and not self._stopping):
+                            try:
+                                await asyncio.wait_for(
+                                    self._full.wait(),
+                                    self.window,
+                                )
+                            except asyncio.TimeoutError:
+                                pass
+                        await self._flush(repo)
+                return
+            except Exception as e:
+                logger.exception('failed to write votes')
+                # don't keep callers waiting while the DB is down
+                self._fail_pending(e)
+                if self._stopping:
+                    return
+                await asyncio.sleep(RETRY_DELAY)
+
+    async def _flush(self, repo: VoteRepository):
+        batch = self._pending[:self.size]
+        del self._pending[:self.size]
+        if len(self._pending) < self.size:
+            self._full.clear()
+        if not self._pending:
+            self._arrived.clear()
+        # callers which went away don't get their votes written
+        batch = [(v, f) for v, f in batch if not f.cancelled()]
+        if not batch:
+            return
+        VOTE_WRITER_BATCH_SIZE.observe(len(batch))
+        try:
+            statuses = await repo.add_many([v for v, _ in batch])
+        except BaseException as e:
+            for _, f in batch:
+                _fail(f, e)
+            raise
+        for (_, f), status in zip(batch, statuses):
+            if not f.done():
+                f.set_result(status)
+
+    def _fail_pending(self, e: BaseException):
+        pending, self._pending = self._pending, []
+        self._arrived.clear()
+        self._full.clear()
+        for _, f in pending:
+            _fail(f, e)
+
+
+def _fail(future: asyncio.Future, e: BaseException):
+    if future.done():
+        return
+    if isinstance(e, asyncio.CancelledError):
+        future.cancel()
+    else:
+        future.set_exception(e)
+
+
+class GroupCommitVoteRepository:
+    '''
+    Vote repository whose `add` goes through a `VoteWriter`, everything
+    else goes to the underlying repository.
+    '''
+
+    def __init__(self, repo: VoteRepository, writer: VoteWriter) -> None:
+        self.repo = repo
+        self.writer = writer
+
+    async def add(self, username: str, input: CreateVoteInput):
+        await self.writer.add(username, input)
+
+    async def get_by_id(self, id: str) -> Vote | None:
+        return await self.repo.get_by_id(id)
+
+    async def save(self, topic: Vote):
+        await self.repo.save(topic)
+
+    async def get_all(self) -> list[Vote]:
+        return await self.repo.get_all()
+
+    async def get_by_user_and_topic(
+        self,
+        username: str,
+        topic_id: str,
+    ) -> Vote | None:
+        return await self.repo.get_by_user_and_topic(username, topic_id)
+
+    async def list_by_user(self, username: str) -> list[Vote]:
+        return await self.repo.list_by_user(username)
+
+    async def get_tally(self, topic_id: str) -> dict[str, int]:
+        return await self.repo.get_tally(topic_id)
+
+    async def get_final_tally(self, topic: Topic) -> dict[str, int]:
+        return await self.repo.get_final_tally(topic)
+
+    async def recount(self, topic_id: str | None = None):
+        await self.repo.recount(topic_id)
+
+    async def add_many(
+        self,
+        votes: list[BatchVoteInput],
+    ) -> list[BatchVoteStatus]:
+        return await self.repo.add_many(votes)
+
+    async def get_result(self, topic_id: str) -> VoteResult | None:
+        return await self.repo.get_result(topic_id)
+
+    async def add_result(self, result: VoteResult) -> VoteResult:
+        return await self.repo.add_result(result)
+
+    async def replace_result(self, result: VoteResult):
+        await self.repo.replace_result(result)